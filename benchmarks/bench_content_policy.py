@@ -0,0 +1,126 @@
+"""
+Microbenchmark of the tenant content policy.
+
+Compares the compiled ContentScanner of llama-proxy against checking every
+rule separately on the lowercased message, the way enforce_tenant_policy
+used to work, on requests with many large messages that pass all rules.
+
+Usage: python benchmarks/bench_content_policy.py [--messages 50] [--length 19000]
+"""
+
+import argparse
+import random
+import re
+import string
+import time
+
+from llama_proxy_module import load_llama_proxy
+
+
+def random_words(rng: random.Random, length: int) -> str:
+    words = []
+    size = 0
+    while size < length:
+        word = "".join(
+            rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9))
+        )
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)[:length]
+
+
+def make_rules(rng: random.Random, keyword_count: int, regex_count: int) -> list[dict]:
+    rules = [{"name": "sensitive-password", "keyword": "password"}]
+    for index in range(keyword_count - 1):
+        keyword = "".join(
+            rng.choice(string.ascii_lowercase) for _ in range(rng.randint(7, 12))
+        )
+        rules.append({"name": f"keyword-{index}", "keyword": keyword})
+    for index in range(regex_count):
+        rules.append(
+            {"name": f"regex-{index}", "regex": rf"\bticket-{index}-\d{{6}}\b"}
+        )
+    return rules
+
+
+def per_rule_policy(rules: list[dict], max_length: int):
+    """Baseline: lowercase each message and check every rule on its own."""
+    keywords = [rule["keyword"] for rule in rules if "keyword" in rule]
+    regexes = [
+        re.compile(rule["regex"], re.IGNORECASE) for rule in rules if "regex" in rule
+    ]
+
+    def enforce(payload: dict) -> bool:
+        for msg in payload["messages"]:
+            content = msg.get("content", "").lower()
+            for keyword in keywords:
+                if keyword in content:
+                    return False
+            for regex in regexes:
+                if regex.search(content):
+                    return False
+            if len(content) > max_length:
+                return False
+        return True
+
+    return enforce
+
+
+def compiled_policy(proxy, rules: list[dict], max_length: int):
+    scanner = proxy.ContentScanner(rules, max_length)
+
+    def enforce(payload: dict) -> bool:
+        for msg in payload["messages"]:
+            if scanner.scan(proxy.message_text(msg)) is not None:
+                return False
+        return True
+
+    return enforce
+
+
+def time_per_call(enforce, payload: dict, repeat: int) -> float:
+    assert enforce(payload), "benchmark payload must pass all rules"
+    start = time.perf_counter()
+    for _ in range(repeat):
+        enforce(payload)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the content policy.")
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--length", type=int, default=19000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    proxy = load_llama_proxy()
+    rng = random.Random(args.seed)
+    payload = {
+        "messages": [
+            {"role": "user", "content": random_words(rng, args.length)}
+            for _ in range(args.messages)
+        ]
+    }
+    size_mb = args.messages * args.length / 1e6
+    engine = "pyahocorasick" if proxy.ahocorasick is not None else "trie regex"
+    print(
+        f"Payload: {args.messages} messages, {size_mb:.2f} MB, keyword engine: {engine}"
+    )
+    print(
+        f"{'keywords':>8} {'regexes':>8} {'per-rule ms':>12} {'compiled ms':>12} {'speedup':>8}"
+    )
+    for keyword_count, regex_count in ((1, 0), (10, 2), (50, 5), (200, 10)):
+        rules = make_rules(rng, keyword_count, regex_count)
+        baseline = time_per_call(per_rule_policy(rules, 20000), payload, args.repeat)
+        compiled = time_per_call(
+            compiled_policy(proxy, rules, 20000), payload, args.repeat
+        )
+        print(
+            f"{keyword_count:>8} {regex_count:>8} {baseline * 1e3:>12.2f} "
+            f"{compiled * 1e3:>12.2f} {baseline / compiled:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
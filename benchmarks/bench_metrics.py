@@ -0,0 +1,64 @@
+"""
+Microbenchmark of recording llama-proxy metrics on the hot path.
+
+Measures the cost per event of observing a histogram and increasing a
+counter, with the labels the proxy uses, including the time.perf_counter()
+calls around the measured code.
+
+Usage: python benchmarks/bench_metrics.py [--events 1000000]
+"""
+
+import argparse
+import random
+import time
+
+from llama_proxy_module import load_llama_proxy
+
+
+def time_per_event(record, values: list, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for value in values:
+            record(value)
+        best = min(best, (time.perf_counter() - start) / len(values))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark metric recording.")
+    parser.add_argument("--events", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    proxy = load_llama_proxy()
+    rng = random.Random(args.seed)
+    values = [rng.expovariate(2.0) for _ in range(args.events)]
+    histogram = proxy.Histogram("bench_seconds", "Benchmark", proxy.LATENCY_BUCKETS)
+    tool_histogram = proxy.TOOL_LATENCY
+    counter = proxy.TOKENS
+    perf_counter = time.perf_counter
+
+    def timed(value):
+        started = perf_counter()
+        tool_histogram.observe(perf_counter() - started, ("file_content",))
+
+    cases = [
+        ("histogram observe", lambda value: histogram.observe(value)),
+        (
+            "labelled observe",
+            lambda value: tool_histogram.observe(value, ("file_content",)),
+        ),
+        ("labelled counter inc", lambda value: counter.inc(("client", "prompt"), 3)),
+        ("timed tool observe", timed),
+        ("empty call", lambda value: None),
+    ]
+    print(f"{'event':>22} {'ns/event':>10}")
+    for name, record in cases:
+        cost = time_per_event(record, values, args.repeat)
+        print(f"{name:>22} {cost * 1e9:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Throughput of the multiply service per request format, in pairs per second.
+
+Starts webservices/multiply.py in pooled mode and multiplies random pairs
+over one keep-alive connection: one pair per GET /multiply request, and
+batches of --sizes pairs per POST /multiply/batch, as JSON and as raw
+float64 vectors. With --no-numpy the server runs with NumPy hidden, to
+measure the array module fallback.
+
+Usage: python benchmarks/bench_multiply_batch.py [--sizes 1000,100000,1000000]
+       [--scalar-requests 5000] [--no-numpy]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import struct
+import subprocess
+import sys
+import time
+
+from load_multiply import MULTIPLY_PATH, wait_until_healthy
+
+# Runs the service as __main__ with "import numpy" failing
+WITHOUT_NUMPY = (
+    "import runpy, sys; sys.modules['numpy'] = None; "
+    "runpy.run_path(sys.argv[1], run_name='__main__')"
+)
+
+
+def spawn_server(port: int, numpy: bool) -> subprocess.Popen:
+    env = dict(os.environ, PORT=str(port))
+    command = [sys.executable, str(MULTIPLY_PATH)]
+    if not numpy:
+        command = [sys.executable, "-c", WITHOUT_NUMPY, str(MULTIPLY_PATH)]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+    try:
+        wait_until_healthy(port)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process
+
+
+def post(connection, body: bytes, content_type: str) -> bytes:
+    connection.request(
+        "POST", "/multiply/batch", body=body, headers={"Content-Type": content_type}
+    )
+    response = connection.getresponse()
+    data = response.read()
+    if response.status != 200:
+        raise RuntimeError(f"{response.status}: {data[:200]}")
+    return data
+
+
+def scalar(connection, a: list[float], b: list[float]) -> float:
+    started = time.perf_counter()
+    for x, y in zip(a, b):
+        connection.request("GET", f"/multiply?a={x}&b={y}")
+        response = connection.getresponse()
+        json.loads(response.read())
+    return time.perf_counter() - started
+
+
+def batch_json(connection, a: list[float], b: list[float]) -> float:
+    started = time.perf_counter()
+    body = json.dumps({"a": a, "b": b}).encode("utf-8")
+    json.loads(post(connection, body, "application/json"))
+    return time.perf_counter() - started
+
+
+def batch_binary(connection, a: list[float], b: list[float]) -> float:
+    started = time.perf_counter()
+    body = struct.pack(f"<{len(a)}d", *a) + struct.pack(f"<{len(b)}d", *b)
+    post(connection, body, "application/octet-stream")
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batch multiplication.")
+    parser.add_argument("--port", type=int, default=18085)
+    parser.add_argument(
+        "--sizes",
+        type=lambda value: [int(size) for size in value.split(",") if size],
+        default=[1000, 100000, 1000000],
+    )
+    parser.add_argument("--scalar-requests", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-numpy", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    process = spawn_server(args.port, numpy=not args.no_numpy)
+    connection = http.client.HTTPConnection("127.0.0.1", args.port, timeout=60)
+    try:
+        print(f"{'format':>14} {'pairs':>9} {'seconds':>9} {'pairs/s':>12}")
+        cases = [("scalar GET", scalar, args.scalar_requests)]
+        for size in args.sizes:
+            cases += [("batch json", batch_json, size)]
+            cases += [("batch binary", batch_binary, size)]
+        for name, run, size in cases:
+            a = [rng.uniform(-1e3, 1e3) for _ in range(size)]
+            b = [rng.uniform(-1e3, 1e3) for _ in range(size)]
+            seconds = min(run(connection, a, b) for _ in range(args.repeat))
+            print(f"{name:>14} {size:>9} {seconds:>9.4f} {size / seconds:>12.0f}")
+    finally:
+        connection.close()
+        process.terminate()
+        process.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Benchmark of the per-iteration CPU cost of the llama-proxy tool loop.
+
+Every tool loop iteration parses a backend response, finds the tool calls
+in it and serializes the updated request for the next backend call. This
+compares the current code path (parse once into a BackendReply, tools
+spliced in pre-serialized) against the previous one (json parsing,
+tools_matched called twice with its prints and the whole body including
+tools serialized again).
+
+Usage: python benchmarks/bench_proxy_hot_path.py [--iterations 2000]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import time
+from pathlib import Path
+
+from llama_proxy_module import load_llama_proxy
+
+TEST_DATA_DIR = Path(__file__).resolve().parent.parent / "test_data"
+
+
+def make_conversation(tool_results: int) -> list[dict]:
+    documents = [path.read_text() for path in sorted(TEST_DATA_DIR.iterdir())]
+    messages = [
+        {"role": "system", "content": "You are friendly and very concise."},
+        {"role": "user", "content": "What can you tell me about Axel?"},
+    ]
+    for index in range(tool_results):
+        messages.append(
+            {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": f"call_{index}",
+                        "type": "function",
+                        "function": {"name": "file_content", "arguments": "{}"},
+                    }
+                ],
+            }
+        )
+        messages.append(
+            {
+                "role": "tool",
+                "tool_call_id": f"call_{index}",
+                "name": "file_content",
+                "content": documents[index % len(documents)],
+            }
+        )
+    return messages
+
+
+def make_backend_response() -> bytes:
+    tool_calls = [
+        {
+            "id": "call_a",
+            "type": "function",
+            "function": {"name": "list_directory", "arguments": "{}"},
+        },
+        {
+            "id": "call_b",
+            "type": "function",
+            "function": {
+                "name": "file_content",
+                "arguments": '{"file_name": "axel.txt"}',
+            },
+        },
+    ]
+    return json.dumps(
+        {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "model": "Qwen/Qwen2.5-14B-Instruct-AWQ",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": None,
+                        "tool_calls": tool_calls,
+                    },
+                    "finish_reason": "tool_calls",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": 2048,
+                "completion_tokens": 48,
+                "total_tokens": 2096,
+            },
+        }
+    ).encode()
+
+
+def legacy_tools_matched(tools: list[dict], response_json: dict) -> list[dict]:
+    """The previous tools_matched, including its prints."""
+    tool_names = {tool["function"]["name"] for tool in tools}
+    print("Available tool names:", tool_names)
+    message = response_json["choices"][0]["message"]
+    tool_calls = message["tool_calls"]
+    called_tools = {tool["function"]["name"] for tool in tool_calls}
+    print("Called tools in response:", called_tools)
+    matched = called_tools & tool_names
+    full_matched_calls = [
+        call["function"] for call in tool_calls if call["function"]["name"] in matched
+    ]
+    print("Extracted tool calls:", tool_calls)
+    return full_matched_calls
+
+
+def legacy_iteration(proxy, content: bytes, body: dict) -> bytes:
+    response_json = json.loads(content)
+    if legacy_tools_matched(proxy.tools, response_json):
+        legacy_tools_matched(proxy.tools, response_json)
+    return json.dumps({**body, "tools": proxy.tools}).encode()
+
+
+def current_iteration(proxy, content: bytes, body: dict) -> bytes:
+    proxy.parse_backend_reply(200, content)
+    return proxy.encode_backend_body(body)
+
+
+def cpu_time_per_iteration(
+    iteration, proxy, content: bytes, body: dict, count: int
+) -> float:
+    # Prints go to an in-memory buffer, so terminal speed does not skew the result
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.process_time()
+        for _ in range(count):
+            iteration(proxy, content, body)
+        return (time.process_time() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the proxy tool loop hot path."
+    )
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    proxy = load_llama_proxy()
+    content = make_backend_response()
+    codec = "orjson" if proxy.orjson is not None else "json"
+    print(f"JSON codec: {codec}")
+    print(
+        f"{'tool results':>12} {'body KB':>8} {'before us':>10} {'after us':>10} {'speedup':>8}"
+    )
+    for tool_results in (0, 2, 8):
+        body = {
+            "model": "Qwen/Qwen2.5-14B-Instruct-AWQ",
+            "messages": make_conversation(tool_results),
+        }
+        size_kb = len(proxy.encode_backend_body(body)) / 1024
+        before = cpu_time_per_iteration(
+            legacy_iteration, proxy, content, body, args.iterations
+        )
+        after = cpu_time_per_iteration(
+            current_iteration, proxy, content, body, args.iterations
+        )
+        print(
+            f"{tool_results:>12} {size_kb:>8.1f} {before * 1e6:>10.1f} "
+            f"{after * 1e6:>10.1f} {before / after:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+import importlib.util
+import sys
+from pathlib import Path
+
+LLAMA_PROXY_PATH = (
+    Path(__file__).resolve().parent.parent / "webservices" / "llama-proxy.py"
+)
+
+
+def load_llama_proxy():
+    """
+    Import webservices/llama-proxy.py as a module.
+    The service file name contains a dash, so it cannot be imported by name.
+    """
+    if "llama_proxy" in sys.modules:
+        return sys.modules["llama_proxy"]
+    spec = importlib.util.spec_from_file_location("llama_proxy", LLAMA_PROXY_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["llama_proxy"] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,192 @@
+"""
+Load test of the multiply service, comparing its serving modes.
+
+Starts webservices/multiply.py once per serving mode, the legacy
+single-threaded HTTP/1.0 server and the pooled HTTP/1.1 keep-alive server,
+and runs the same closed-loop load against each: a fixed number of client
+threads sending GET /multiply back to back, each over its own connection
+which is reused when the server allows it. Reports requests per second,
+latency percentiles and errors per mode.
+
+With --slow-clients, that many extra connections send half a request line
+and then hold the connection open, like a client on a bad network. The
+legacy server serves one connection at a time, so they block every other
+caller; requests time out after --timeout seconds and count as errors.
+
+Usage: python benchmarks/load_multiply.py [--modes legacy,pooled]
+       [--concurrency 16] [--duration 10] [--slow-clients 1]
+"""
+
+import argparse
+import http.client
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+MULTIPLY_PATH = REPO_DIR / "webservices" / "multiply.py"
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float | None:
+    """Return a nearest-rank percentile of sorted values."""
+    if not sorted_values:
+        return None
+    index = min(
+        len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1)
+    )
+    return sorted_values[index]
+
+
+def summarize(sorted_values: list[float]) -> dict:
+    if not sorted_values:
+        return {}
+    return {
+        "mean": round(sum(sorted_values) / len(sorted_values) * 1000, 2),
+        "p50": round(percentile(sorted_values, 0.50) * 1000, 2),
+        "p95": round(percentile(sorted_values, 0.95) * 1000, 2),
+        "p99": round(percentile(sorted_values, 0.99) * 1000, 2),
+        "max": round(sorted_values[-1] * 1000, 2),
+    }
+
+
+def wait_until_healthy(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            # The legacy server has no /health, any answer means it is up
+            connection.request("GET", "/multiply?a=1&b=1")
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"multiply on port {port} did not start within {timeout} s")
+
+
+def spawn_server(mode: str, port: int, workers: int) -> subprocess.Popen:
+    env = dict(os.environ, SERVER_MODE=mode, PORT=str(port), WORKERS=str(workers))
+    process = subprocess.Popen(
+        [sys.executable, str(MULTIPLY_PATH)], env=env, stdout=subprocess.DEVNULL
+    )
+    try:
+        wait_until_healthy(port)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process
+
+
+def hold_slow_connections(port: int, count: int) -> list[socket.socket]:
+    """Open connections that send an incomplete request and then wait."""
+    connections = []
+    for _ in range(count):
+        connection = socket.create_connection(("127.0.0.1", port))
+        connection.sendall(b"GET /multiply?a=1&b=2 HT")
+        connections.append(connection)
+    return connections
+
+
+def client(port: int, args, deadline: float, latencies: list, errors: list, seed):
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=args.timeout)
+    while time.monotonic() < deadline:
+        path = f"/multiply?a={rng.uniform(-1e3, 1e3)}&b={rng.uniform(-1e3, 1e3)}"
+        started = time.perf_counter()
+        try:
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+            else:
+                latencies.append(time.perf_counter() - started)
+            if response.will_close:
+                connection.close()
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            connection.close()
+    connection.close()
+
+
+def run_mode(mode: str, port: int, args) -> dict:
+    process = spawn_server(mode, port, args.workers)
+    slow = hold_slow_connections(port, args.slow_clients)
+    latencies, errors = [], []
+    try:
+        deadline = time.monotonic() + args.duration
+        started = time.perf_counter()
+        threads = [
+            threading.Thread(
+                target=client,
+                args=(port, args, deadline, latencies, errors, args.seed + index),
+            )
+            for index in range(args.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        for connection in slow:
+            connection.close()
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    latencies.sort()
+    return {
+        "mode": mode,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": summarize(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the multiply service.")
+    parser.add_argument(
+        "--modes",
+        type=lambda value: [mode for mode in value.split(",") if mode],
+        default=["legacy", "pooled"],
+    )
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--slow-clients", type=int, default=0)
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=2.0,
+        help="Seconds before a request counts as failed.",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    results = [
+        run_mode(mode, args.port + index, args) for index, mode in enumerate(args.modes)
+    ]
+    print(
+        f"{'mode':>8} {'requests':>9} {'errors':>7} {'rps':>9} "
+        f"{'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+    )
+    for result in results:
+        latency = result["latency_ms"]
+        print(
+            f"{result['mode']:>8} {result['requests']:>9} {result['errors']:>7} "
+            f"{result['rps']:>9} {latency.get('p50', '-'):>8} "
+            f"{latency.get('p99', '-'):>8} {latency.get('max', '-'):>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+"""
+Load test of llama-proxy, against the mock vLLM backend.
+
+Runs closed-loop load (a fixed number of clients sending requests back to
+back) or open-loop load (requests arriving at a fixed average rate with
+Poisson inter-arrival times, whether or not earlier ones finished) and
+reports throughput, latency percentiles and the CPU time the proxy spent
+per request, read from /proc. Open-loop latencies are measured from the
+scheduled arrival time, so a stalled proxy is not hidden by the driver
+waiting for it.
+
+With --spawn the mock backend and the proxy are started locally, with the
+policies and test data of this repository, and stopped afterwards. The
+policies get an extra "bench" tenant that may use every tool and has no
+rate or concurrency limit, so the proxy is measured rather than the limits.
+The prompts repeat, so the spawned proxy runs with single-flight coalescing
+of identical requests off, unless --coalesce is given, and every request
+reaches the backend.
+Results are written as JSON, and compared against an earlier result file
+with --compare.
+
+Usage: python benchmarks/load_proxy.py --spawn [--mode closed --concurrency 16]
+       [--mode open --rps 50] [--duration 30] [--stream] [--tool-ratio 0.2]
+       [--coalesce] [--output results.json] [--compare previous.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+BENCHMARKS_DIR = REPO_DIR / "benchmarks"
+PROMPTS = [
+    "What is the capital of the Netherlands?",
+    "Summarize the plot of Hamlet in one sentence.",
+    "Write a haiku about Kubernetes.",
+    "Explain what a reverse proxy does.",
+]
+TOOL_PROMPT = "Please use tools to tell me about Axel."
+BENCH_POLICY = """---
+tools:
+  list_directory:
+    allowed: true
+    allowed_directories:
+      - test_data
+  time_now:
+    allowed: true
+  file_content:
+    allowed: true
+    allowed_files:
+      - "*"
+  search_documents:
+    allowed: true
+    allowed_files:
+      - "*"
+limits:
+  priority: interactive
+"""
+
+
+def cpu_seconds(pid: int) -> float:
+    """Return the user and system CPU time of a process, from /proc."""
+    with open(f"/proc/{pid}/stat") as stat:
+        # The command name may contain spaces, the fields follow its ")"
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float | None:
+    """Return a nearest-rank percentile of sorted values."""
+    if not sorted_values:
+        return None
+    index = min(
+        len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1)
+    )
+    return sorted_values[index]
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_body(args, rng: random.Random) -> dict:
+    prompt = TOOL_PROMPT if rng.random() < args.tool_ratio else rng.choice(PROMPTS)
+    body = {
+        "model": "mock",
+        "messages": [
+            {"role": "system", "content": "You are friendly and very concise."},
+            {"role": "user", "content": prompt},
+        ],
+    }
+    if args.temperature is not None:
+        body["temperature"] = args.temperature
+    if args.stream:
+        body["stream"] = True
+        body["stream_options"] = {"include_usage": True}
+    return body
+
+
+class Recorder:
+    """Collects the outcome of every request sent during the measurement."""
+
+    def __init__(self):
+        self.latencies = []
+        self.first_byte = []
+        self.status_codes = {}
+        self.errors = {}
+        self.measuring = False
+
+    def record(self, started: float, first_byte: float | None, status: int):
+        if not self.measuring:
+            return
+        self.latencies.append(time.perf_counter() - started)
+        if first_byte is not None:
+            self.first_byte.append(first_byte - started)
+        self.status_codes[str(status)] = self.status_codes.get(str(status), 0) + 1
+
+    def error(self, error: Exception):
+        if self.measuring:
+            name = type(error).__name__
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+
+async def send(client: httpx.AsyncClient, args, body: dict, started: float, recorder):
+    """Send a request and record its latency, from the started time."""
+    headers = {"authorization": args.authorization}
+    try:
+        if args.stream:
+            async with client.stream(
+                "POST", args.path, json=body, headers=headers
+            ) as response:
+                first_byte = None
+                async for _ in response.aiter_bytes():
+                    if first_byte is None:
+                        first_byte = time.perf_counter()
+            recorder.record(started, first_byte, response.status_code)
+        else:
+            response = await client.post(args.path, json=body, headers=headers)
+            recorder.record(started, None, response.status_code)
+    except httpx.HTTPError as e:
+        recorder.error(e)
+
+
+async def closed_loop(client, args, recorder, deadline: float, rng):
+    async def worker():
+        while time.perf_counter() < deadline:
+            await send(
+                client, args, make_body(args, rng), time.perf_counter(), recorder
+            )
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+
+async def open_loop(client, args, recorder, deadline: float, rng):
+    pending = set()
+    skipped = 0
+    next_arrival = time.perf_counter()
+    while next_arrival < deadline:
+        delay = next_arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if len(pending) >= args.max_outstanding:
+            skipped += 1
+        else:
+            task = asyncio.create_task(
+                send(client, args, make_body(args, rng), next_arrival, recorder)
+            )
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        next_arrival += rng.expovariate(args.rps)
+    if pending:
+        await asyncio.wait(pending)
+    return skipped
+
+
+async def run_load(args, proxy_pid: int | None) -> dict:
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(
+        base_url=args.url, limits=limits, timeout=args.timeout
+    ) as client:
+        if args.warmup:
+            warmup_deadline = time.perf_counter() + args.warmup
+            await closed_loop(client, args, recorder, warmup_deadline, rng)
+
+        recorder.measuring = True
+        cpu_before = cpu_seconds(proxy_pid) if proxy_pid else None
+        started = time.perf_counter()
+        deadline = started + args.duration
+        skipped = 0
+        if args.mode == "closed":
+            await closed_loop(client, args, recorder, deadline, rng)
+        else:
+            skipped = await open_loop(client, args, recorder, deadline, rng)
+        elapsed = time.perf_counter() - started
+        cpu_after = cpu_seconds(proxy_pid) if proxy_pid else None
+        recorder.measuring = False
+
+    latencies = sorted(recorder.latencies)
+    first_byte = sorted(recorder.first_byte)
+    completed = len(latencies)
+    result = {
+        "requests": completed,
+        "elapsed_seconds": round(elapsed, 3),
+        "rps": round(completed / elapsed, 2) if elapsed else 0.0,
+        "status_codes": recorder.status_codes,
+        "errors": recorder.errors,
+        "skipped": skipped,
+        "latency_ms": summarize(latencies),
+    }
+    if first_byte:
+        result["first_byte_ms"] = summarize(first_byte)
+    if cpu_before is not None and completed:
+        cpu = cpu_after - cpu_before
+        result["proxy_cpu_seconds"] = round(cpu, 3)
+        result["proxy_cpu_ms_per_request"] = round(cpu * 1000 / completed, 3)
+    return result
+
+
+def summarize(sorted_values: list[float]) -> dict:
+    if not sorted_values:
+        return {}
+    return {
+        "mean": round(sum(sorted_values) / len(sorted_values) * 1000, 2),
+        "p50": round(percentile(sorted_values, 0.50) * 1000, 2),
+        "p95": round(percentile(sorted_values, 0.95) * 1000, 2),
+        "p99": round(percentile(sorted_values, 0.99) * 1000, 2),
+        "max": round(sorted_values[-1] * 1000, 2),
+    }
+
+
+def wait_until_healthy(url: str, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not become healthy within {timeout} seconds")
+
+
+def spawn_services(args, work_dir: str) -> list[subprocess.Popen]:
+    """Start the mock backend and the proxy, returning their processes."""
+    policies_dir = os.path.join(work_dir, "policies")
+    shutil.copytree(REPO_DIR / "policies", policies_dir)
+    Path(policies_dir, "bench.yml").write_text(BENCH_POLICY)
+    mock = subprocess.Popen(
+        [
+            sys.executable,
+            str(BENCHMARKS_DIR / "mock_vllm.py"),
+            "--port",
+            str(args.mock_port),
+            *args.mock_args.split(),
+        ]
+    )
+    env = dict(
+        os.environ,
+        LLAMA_BACKEND=f"http://127.0.0.1:{args.mock_port}/v1/chat/completions",
+        POLICIES_DIR=policies_dir,
+        TEST_DATA_DIR=str(REPO_DIR / "test_data"),
+        DATA_DIR=os.path.join(work_dir, "data"),
+        SINGLE_FLIGHT_ENABLED="true" if args.coalesce else "false",
+        LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"),
+    )
+    proxy = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "llama-proxy:app",
+            "--app-dir",
+            str(REPO_DIR / "webservices"),
+            "--port",
+            str(args.proxy_port),
+            "--log-level",
+            "warning",
+            "--no-access-log",
+        ],
+        env=env,
+    )
+    processes = [mock, proxy]
+    try:
+        wait_until_healthy(f"http://127.0.0.1:{args.mock_port}/health")
+        wait_until_healthy(f"http://127.0.0.1:{args.proxy_port}/health")
+    except RuntimeError:
+        stop_services(processes)
+        raise
+    return processes
+
+
+def stop_services(processes: list[subprocess.Popen]):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def print_comparison(current: dict, previous: dict):
+    print(f"Compared with {previous.get('commit')} ({previous.get('timestamp')}):")
+    rows = [("rps", ("rps",))]
+    rows += [(f"latency {key}", ("latency_ms", key)) for key in ("p50", "p95", "p99")]
+    rows.append(("proxy cpu ms/req", ("proxy_cpu_ms_per_request",)))
+    for name, path in rows:
+        values = []
+        for result in (previous["results"], current["results"]):
+            for key in path:
+                result = result.get(key, {}) if isinstance(result, dict) else None
+            values.append(result if isinstance(result, (int, float)) else None)
+        before, after = values
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"  {name:>18}: {before:>10} -> {after:>10} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test llama-proxy.")
+    parser.add_argument("--url", help="Base URL of a running proxy.")
+    parser.add_argument("--path", default="/v1/chat/completions")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rps", type=float, default=50.0)
+    parser.add_argument("--max-outstanding", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--tool-ratio", type=float, default=0.2)
+    parser.add_argument("--temperature", type=float)
+    parser.add_argument("--authorization", default="bench")
+    parser.add_argument("--proxy-pid", type=int, help="Measure the CPU of this pid.")
+    parser.add_argument("--spawn", action="store_true")
+    parser.add_argument(
+        "--coalesce",
+        action="store_true",
+        help="Let the spawned proxy merge identical requests in flight.",
+    )
+    parser.add_argument("--proxy-port", type=int, default=18080)
+    parser.add_argument("--mock-port", type=int, default=18081)
+    parser.add_argument(
+        "--mock-args", default="", help="Extra arguments for mock_vllm.py."
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="A result file to compare against.")
+    args = parser.parse_args()
+
+    if not args.spawn and not args.url:
+        parser.error("either --url or --spawn is required")
+    processes = []
+    proxy_pid = args.proxy_pid
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.spawn:
+            processes = spawn_services(args, work_dir)
+            proxy_pid = processes[1].pid
+            args.url = f"http://127.0.0.1:{args.proxy_port}"
+        try:
+            results = asyncio.run(run_load(args, proxy_pid))
+        finally:
+            stop_services(processes)
+
+    config = {
+        key: getattr(args, key)
+        for key in (
+            "mode",
+            "concurrency",
+            "rps",
+            "duration",
+            "stream",
+            "tool_ratio",
+            "temperature",
+            "authorization",
+            "mock_args",
+            "coalesce",
+        )
+    }
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": config,
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2) + "\n")
+    if args.compare:
+        print_comparison(report, json.loads(Path(args.compare).read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+OpenAI-compatible mock of the vLLM backend, for load testing llama-proxy
+without a GPU.
+
+Serves /v1/chat/completions, buffered and streamed, and /health. Responses
+are delayed by a configurable latency distribution. Conversations whose
+first user message contains the tool marker get a scripted sequence of tool
+calls, one per turn, before the final answer. A share of requests can be
+failed with a 500 or stalled to exercise retries and timeouts.
+
+Latency distributions:
+    constant:SECONDS
+    uniform:LOW,HIGH
+    exponential:MEAN
+    lognormal:MEDIAN,SIGMA
+
+Usage: python benchmarks/mock_vllm.py [--port 8001] [--latency lognormal:0.2,0.5]
+       [--token-delay 0.01] [--script time_now,list_directory,file_content]
+       [--error-rate 0.01] [--stall-rate 0.001]
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+TOOL_MARKER = "use tools"
+TOOL_ARGUMENTS = {
+    "time_now": {},
+    "list_directory": {},
+    "file_content": {"file_name": "axel.txt"},
+    "search_documents": {"query": "history of Axel"},
+}
+
+
+def latency_sampler(spec: str):
+    """
+    Build a function returning random delays from a distribution spec.
+    Args:
+        spec (str): The distribution and its parameters, such as "uniform:0.1,0.3".
+    Returns:
+        Callable[[], float]: Returns a delay in seconds.
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",") if value]
+    if kind == "constant":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "exponential":
+        return lambda: random.expovariate(1 / values[0])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def first_user_message(messages: list[dict]) -> str:
+    for message in messages:
+        if message.get("role") == "user":
+            return str(message.get("content") or "")
+    return ""
+
+
+def tool_turns(messages: list[dict]) -> int:
+    """Count the assistant turns of a conversation that called tools."""
+    return sum(
+        1
+        for message in messages
+        if message.get("role") == "assistant" and message.get("tool_calls")
+    )
+
+
+def create_app(args) -> FastAPI:
+    app = FastAPI()
+    sample_latency = latency_sampler(args.latency)
+    stats = {"requests": 0, "streamed": 0, "tool_calls": 0, "errors": 0, "stalls": 0}
+
+    def next_message(messages: list[dict]) -> dict:
+        turn = tool_turns(messages)
+        if TOOL_MARKER in first_user_message(messages) and turn < len(args.script):
+            name = args.script[turn]
+            stats["tool_calls"] += 1
+            call = {
+                "id": f"call_{uuid.uuid4().hex[:12]}",
+                "type": "function",
+                "function": {
+                    "name": name,
+                    "arguments": json.dumps(TOOL_ARGUMENTS.get(name, {})),
+                },
+            }
+            return {"role": "assistant", "content": None, "tool_calls": [call]}
+        words = " ".join(["lorem"] * args.completion_tokens)
+        return {"role": "assistant", "content": words}
+
+    def usage(messages: list[dict], message: dict) -> dict:
+        prompt_tokens = len(json.dumps(messages)) // 4
+        completion_tokens = (
+            args.completion_tokens
+            if message.get("content")
+            else len(json.dumps(message)) // 4
+        )
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        if random.random() < args.stall_rate:
+            stats["stalls"] += 1
+            await asyncio.sleep(args.stall_seconds)
+        if random.random() < args.error_rate:
+            stats["errors"] += 1
+            return JSONResponse(status_code=500, content={"error": "injected failure"})
+
+        messages = body.get("messages") or []
+        message = next_message(messages)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        finish_reason = "tool_calls" if message.get("tool_calls") else "stop"
+
+        if not body.get("stream"):
+            await asyncio.sleep(sample_latency())
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": [
+                    {"index": 0, "message": message, "finish_reason": finish_reason}
+                ],
+                "usage": usage(messages, message),
+            }
+
+        stats["streamed"] += 1
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+
+        async def events():
+            def chunk(delta: dict, finish: str | None = None) -> str:
+                data = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+                }
+                return f"data: {json.dumps(data)}\n\n"
+
+            # Time to first token
+            await asyncio.sleep(sample_latency())
+            yield chunk({"role": "assistant"})
+            if message.get("tool_calls"):
+                call = message["tool_calls"][0]
+                yield chunk(
+                    {
+                        "tool_calls": [
+                            {
+                                "index": 0,
+                                "id": call["id"],
+                                "type": "function",
+                                "function": {"name": call["function"]["name"]},
+                            }
+                        ]
+                    }
+                )
+                yield chunk(
+                    {
+                        "tool_calls": [
+                            {
+                                "index": 0,
+                                "function": {
+                                    "arguments": call["function"]["arguments"]
+                                },
+                            }
+                        ]
+                    }
+                )
+            else:
+                for word in message["content"].split(" "):
+                    if args.token_delay:
+                        await asyncio.sleep(args.token_delay)
+                    yield chunk({"content": word + " "})
+            yield chunk({}, finish_reason)
+            if include_usage:
+                data = {
+                    "id": completion_id,
+                    "choices": [],
+                    "usage": usage(messages, message),
+                }
+                yield f"data: {json.dumps(data)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mock vLLM backend.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", default="constant:0.05")
+    parser.add_argument(
+        "--token-delay",
+        type=float,
+        default=0.0,
+        help="Delay between streamed tokens, in seconds.",
+    )
+    parser.add_argument("--completion-tokens", type=int, default=32)
+    parser.add_argument(
+        "--script",
+        type=lambda value: [name for name in value.split(",") if name],
+        default=["time_now", "list_directory", "file_content"],
+        help="Tool called in each turn of a tool conversation, comma separated.",
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--stall-rate", type=float, default=0.0)
+    parser.add_argument("--stall-seconds", type=float, default=30.0)
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,53 +1,279 @@
+import argparse
+import http.client
 import json
-import urllib.request
+import sys
+import threading
+import time
 
+CHARS_PER_TOKEN = 4
+MESSAGE_TOKEN_OVERHEAD = 4
+# Errors of a reused keep-alive connection that the server closed while idle
+STALE_CONNECTION_ERRORS = (
+    BrokenPipeError,
+    ConnectionResetError,
+    http.client.RemoteDisconnected,
+)
 
-def main():
-    print("=== LLaMA Proxy Python Client ===")
 
-    # Get server IP and port
-    host = "192.168.49.2"
-    port = input(
-        "Enter proxy port (e.g., 32307, run `minikube service llama-proxy --url` when in doubt): "
-    ).strip()
-    truncate = (
-        input("Truncate long responses? (y/n, default n): ").strip().lower() == "y"
+def estimate_tokens(message: dict) -> int:
+    """Estimate the tokens of a chat message, without a tokenizer."""
+    return len(message.get("content") or "") // CHARS_PER_TOKEN + MESSAGE_TOKEN_OVERHEAD
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float | None:
+    """Return a nearest-rank percentile of sorted values."""
+    if not sorted_values:
+        return None
+    index = min(
+        len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1)
     )
-    url = f"http://{host}:{port}/v1/chat/completions"
+    return sorted_values[index]
 
-    print("\nType your queries below. Type 'exit' to quit.\n")
 
+class ChatSession:
+    """
+    A conversation with the proxy over one persistent HTTP connection.
+    The conversation history is sent with every question. The oldest turns
+    are dropped when the history exceeds the token budget; the system prompt
+    and the latest question are always kept.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.connection = http.client.HTTPConnection(
+            args.host, args.port, timeout=args.timeout
+        )
+        self.system = (
+            [{"role": "system", "content": args.system}] if args.system else []
+        )
+        self.history = []
+
+    def trim_history(self):
+        budget = self.args.max_history_tokens - sum(map(estimate_tokens, self.system))
+        tokens = sum(map(estimate_tokens, self.history))
+        while len(self.history) > 1 and tokens > budget:
+            tokens -= estimate_tokens(self.history.pop(0))
+        # A conversation sent to the model starts with a user message
+        while len(self.history) > 1 and self.history[0]["role"] != "user":
+            self.history.pop(0)
+
+    def send(self, body: bytes) -> http.client.HTTPResponse:
+        headers = {
+            "Content-Type": "application/json",
+            "authorization": self.args.authorization,
+        }
+        reused = self.connection.sock is not None
+        try:
+            self.connection.request(
+                "POST", "/v1/chat/completions", body=body, headers=headers
+            )
+            return self.connection.getresponse()
+        except STALE_CONNECTION_ERRORS:
+            if not reused:
+                raise
+            # The proxy closed the idle connection, reconnect once
+            self.connection.close()
+            self.connection.request(
+                "POST", "/v1/chat/completions", body=body, headers=headers
+            )
+            return self.connection.getresponse()
+
+    def ask(self, question: str, output=None) -> dict:
+        """
+        Ask a question and read the answer, streamed or at once.
+        Args:
+            question (str): The user message.
+            output: Stream to write the answer to as it arrives, or None.
+        Returns:
+            dict: The answer, the time to the first token and the total time
+                in seconds, or the error.
+        """
+        self.history.append({"role": "user", "content": question})
+        self.trim_history()
+        body = {
+            "model": self.args.model,
+            "messages": self.system + self.history,
+            "stream": self.args.stream,
+        }
+        started = time.perf_counter()
+        result = {"ok": False}
+        try:
+            response = self.send(json.dumps(body).encode("utf-8"))
+            if response.status != 200:
+                result["error"] = f"HTTP {response.status}: {response.read().decode()}"
+            elif self.args.stream:
+                self.read_stream(response, started, result, output)
+            else:
+                data = json.loads(response.read())
+                result["ttft"] = time.perf_counter() - started
+                choices = data.get("choices") or [{}]
+                result["content"] = choices[0].get("message", {}).get("content") or ""
+                result["details"] = choices[0]
+                result["ok"] = True
+                if output:
+                    output.write(result["content"])
+        except (http.client.HTTPException, OSError, ValueError) as e:
+            self.connection.close()
+            result["error"] = f"{type(e).__name__}: {e}"
+        result["total"] = time.perf_counter() - started
+        if result["ok"]:
+            self.history.append({"role": "assistant", "content": result["content"]})
+        else:
+            # Do not send the unanswered question again with the next one
+            self.history.pop()
+        return result
+
+    @staticmethod
+    def read_stream(response, started: float, result: dict, output):
+        parts = []
+        for line in response:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+            chunk = json.loads(data)
+            if "error" in chunk:
+                response.read()
+                result["error"] = str(chunk["error"])
+                return
+            for choice in chunk.get("choices") or []:
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    if not parts:
+                        result["ttft"] = time.perf_counter() - started
+                    parts.append(content)
+                    if output:
+                        output.write(content)
+                        output.flush()
+                if choice.get("finish_reason"):
+                    result["details"] = {"finish_reason": choice["finish_reason"]}
+            if chunk.get("usage"):
+                result.setdefault("details", {})["usage"] = chunk["usage"]
+        response.read()
+        result["content"] = "".join(parts)
+        result.setdefault("ttft", time.perf_counter() - started)
+        result["ok"] = True
+
+
+def interactive(args):
+    session = ChatSession(args)
+    print("\nType your queries below. Type 'exit' to quit.\n")
     while True:
         user_input = input("You: ").strip()
         if user_input.lower() == "exit":
             print("Exiting client.")
             break
+        if not user_input:
+            continue
 
-        # Build request payload
-        payload = json.dumps(
-            {
-                "model": "Qwen/Qwen2.5-14B-Instruct-AWQ",
-                "messages": [{"role": "user", "content": user_input}],
-            }
-        ).encode("utf-8")
+        sys.stdout.write("LLaMA: ")
+        result = session.ask(user_input, sys.stdout)
+        if not result["ok"]:
+            print(f"ERROR: {result['error']}\n")
+        elif args.truncate:
+            print("\n")
+        else:
+            print(f"\n{json.dumps(result.get('details', {}))}\n")
 
-        headers = {"Content-Type": "application/json", "authorization": "client"}
 
-        response = urllib.request.Request(
-            url, data=payload, headers=headers, method="POST"
-        )
+def replay_session(args, prompts: list[str], results: list):
+    session = ChatSession(args)
+    for prompt in prompts:
+        results.append(session.ask(prompt))
 
-        with urllib.request.urlopen(response) as http_response:
-            data = json.loads(http_response.read().decode("utf-8"))
-            choices = data.get("choices", [])
-            if choices:
-                if truncate:
-                    content = choices[0].get("message", {}).get("content", "")
-                else:
-                    content = choices[0]
-                print(f"LLaMA: {content}\n")
-            else:
-                print(f"LLaMA: {json.dumps(data)}\n")
+
+def replay(args):
+    """
+    Replay the prompts of a file, one per line, in concurrent sessions.
+    Every session sends all prompts as one conversation. Prints the latency
+    statistics over all sessions.
+    """
+    with open(args.replay, encoding="utf-8") as f:
+        prompts = [line.strip() for line in f if line.strip()]
+    results = []
+    started = time.perf_counter()
+    threads = [
+        threading.Thread(target=replay_session, args=(args, prompts, results))
+        for _ in range(args.sessions)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    succeeded = [result for result in results if result["ok"]]
+    print(
+        f"{len(results)} requests in {elapsed:.2f} s over {args.sessions} sessions: "
+        f"{len(succeeded) / elapsed:.2f} rps, {len(results) - len(succeeded)} errors"
+    )
+    for key, name in (("ttft", "time to first token"), ("total", "total time")):
+        values = sorted(result[key] for result in succeeded)
+        if values:
+            print(
+                f"{name:>20}: "
+                + ", ".join(
+                    f"p{round(fraction * 100)} {percentile(values, fraction) * 1000:.0f} ms"
+                    for fraction in (0.5, 0.9, 0.95, 0.99)
+                )
+            )
+    errors = {}
+    for result in results:
+        if not result["ok"]:
+            errors[result["error"]] = errors.get(result["error"], 0) + 1
+    for error, count in errors.items():
+        print(f"{count:>6} x {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLaMA Proxy Python Client")
+    parser.add_argument("--host", default="192.168.49.2")
+    parser.add_argument("--port", help="Proxy port, asked for when not given.")
+    parser.add_argument("--authorization", default="client")
+    parser.add_argument("--model", default="Qwen/Qwen2.5-14B-Instruct-AWQ")
+    parser.add_argument("--system", help="System prompt of the conversation.")
+    parser.add_argument(
+        "--max-history-tokens",
+        type=int,
+        default=6000,
+        help="Estimated tokens of conversation history sent with a question.",
+    )
+    parser.add_argument(
+        "--no-stream",
+        dest="stream",
+        action="store_false",
+        help="Wait for the whole answer instead of streaming it.",
+    )
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument(
+        "--replay",
+        help="File of prompts, one per line, to send without interaction.",
+    )
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        default=1,
+        help="Concurrent sessions replaying the prompts.",
+    )
+    args = parser.parse_args()
+
+    if args.replay:
+        if not args.port:
+            parser.error("--port is required with --replay")
+        replay(args)
+        return
+
+    print("=== LLaMA Proxy Python Client ===")
+    if not args.port:
+        args.port = input(
+            "Enter proxy port (e.g., 32307, run `minikube service llama-proxy --url` when in doubt): "
+        ).strip()
+    args.truncate = (
+        input("Truncate long responses? (y/n, default n): ").strip().lower() == "y"
+    )
+    interactive(args)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,12 @@
+import http.client
 import json
 import os
+import random
+import threading
 import time
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from urllib.parse import urlparse
 
 LLAMA_URL = os.getenv(
     "LLAMA_URL", "http://llama-proxy.default.svc.cluster.local:80/v1/chat/completions"
@@ -11,64 +15,300 @@ PROMPT = os.getenv(
     "PROMPT", "Hello, what can you tell me about the city of Axel in the Netherlands?"
 )
 INTERVAL = int(os.getenv("INTERVAL", "90"))  # seconds
+# Load scenario, as a JSON file or inline JSON; without one PROMPT is sent
+# every INTERVAL seconds
+SCENARIO_FILE = os.getenv("SCENARIO_FILE")
+SCENARIO = os.getenv("SCENARIO")
 
+# Errors of a reused keep-alive connection that the server closed while idle
+STALE_CONNECTION_ERRORS = (
+    BrokenPipeError,
+    ConnectionResetError,
+    http.client.RemoteDisconnected,
+)
+
+DEFAULT_SCENARIO = {
+    "arrival": "constant",
+    "concurrency": 4,
+    "timeout": 120,
+    "repeat": True,
+    "stages": [{"rps": 1 / INTERVAL, "duration": 3600}],
+    "requests": [{"name": "axel", "prompt": PROMPT, "authorization": "ping"}],
+}
 
-def extract_final_message(raw_text: str) -> str:
+
+def load_scenario() -> dict:
     """
-    Extracts the final assistant message from LLaMA chat output.
+    Load the load scenario.
+    A scenario has the keys:
+        arrival: "poisson" or "constant" inter-arrival times.
+        concurrency: Maximum requests in flight; arrivals beyond it are dropped.
+        timeout: Seconds a request may take.
+        repeat: Whether to start again after the last stage.
+        stages: List of {"rps", "duration"}, run in order to ramp up the load.
+        requests: List of {"name", "prompt", "authorization", "weight",
+            "max_tokens", "model"}, picked at random by weight.
+    Returns:
+        dict: The scenario, with defaults for missing keys.
     """
-    marker = "<|channel|>final<|message|>"
-    if marker in raw_text:
-        return raw_text.split(marker)[-1].strip()
-    return raw_text.strip()  # fallback to full text if marker missing
-
-
-def ping_llama():
-    try:
-        # Prepare OpenAI-style chat request
-        payload = json.dumps(
-            {
-                "model": "Qwen/Qwen2.5-14B-Instruct-AWQ",
-                "messages": [
-                    {"role": "system", "content": "You are friendly and very concise."},
-                    {"role": "user", "content": PROMPT},
-                ],
-            }
-        ).encode("utf-8")
-
-        headers = {"Content-Type": "application/json", "authorization": "ping"}
-
-        req = urllib.request.Request(
-            LLAMA_URL,
-            data=payload,
-            headers=headers,
-            method="POST",
-        )
+    scenario = dict(DEFAULT_SCENARIO)
+    if SCENARIO_FILE:
+        with open(SCENARIO_FILE, encoding="utf-8") as f:
+            scenario.update(json.load(f))
+    elif SCENARIO:
+        scenario.update(json.loads(SCENARIO))
+    if scenario["arrival"] not in ("poisson", "constant"):
+        raise ValueError(f"Unknown arrival process: {scenario['arrival']}")
+    if not scenario["stages"] or not scenario["requests"]:
+        raise ValueError("A scenario needs at least one stage and one request.")
+    for index, request in enumerate(scenario["requests"]):
+        if not isinstance(request, dict) or "prompt" not in request:
+            raise ValueError(f"Scenario request {index} has no prompt: {request}")
+        request.setdefault("name", f"request-{index}")
+        request.setdefault("authorization", "ping")
+        request.setdefault("weight", 1)
+    return scenario
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float | None:
+    """Return a nearest-rank percentile of sorted values."""
+    if not sorted_values:
+        return None
+    index = min(
+        len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1)
+    )
+    return sorted_values[index]
+
+
+def request_body(request: dict) -> bytes:
+    body = {
+        "model": request.get("model", "Qwen/Qwen2.5-14B-Instruct-AWQ"),
+        "messages": [
+            {"role": "system", "content": "You are friendly and very concise."},
+            {"role": "user", "content": request["prompt"]},
+        ],
+    }
+    if "max_tokens" in request:
+        body["max_tokens"] = request["max_tokens"]
+    return json.dumps(body).encode("utf-8")
 
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            data = json.load(resp)
 
-            # Extract assistant message
-            choices = data.get("choices", [])
-            if choices:
-                assistant_msg = choices[0].get("message", {}).get("content", "").strip()
+class Stage:
+    """
+    Results of one load stage.
+    Requests are attributed to the stage that scheduled them, also when they
+    finish after it ended.
+    """
+
+    def __init__(self, number: int, rps: float, duration: float):
+        self.number = number
+        self.rps = rps
+        self.duration = duration
+        self.sent = 0
+        self.dropped = 0
+        self.pending = 0
+        self.latencies = []
+        self.errors = {}
+        self.scheduled = False
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+
+    def start_request(self):
+        with self.lock:
+            self.sent += 1
+            self.pending += 1
+
+    def finish_request(self, latency: float, error: str | None):
+        with self.lock:
+            self.pending -= 1
+            if error is None:
+                self.latencies.append(latency)
             else:
-                assistant_msg = "No response"
+                self.errors[error] = self.errors.get(error, 0) + 1
+            self.finished.notify_all()
+
+    def drop_request(self):
+        with self.lock:
+            self.dropped += 1
+
+    def end_scheduling(self):
+        with self.lock:
+            self.scheduled = True
+            self.finished.notify_all()
+
+    def wait(self):
+        with self.lock:
+            self.finished.wait_for(lambda: self.scheduled and not self.pending)
+
+    def report(self) -> dict:
+        """
+        Summarize the stage.
+        Returns:
+            dict: The offered and achieved rates, error rate, dropped arrivals,
+                latency percentiles in seconds and the errors by kind.
+        """
+        latencies = sorted(self.latencies)
+        failed = sum(self.errors.values())
+        return {
+            "stage": self.number,
+            "offered_rps": round(self.rps, 3),
+            "achieved_rps": round(len(latencies) / self.duration, 3),
+            "sent": self.sent,
+            "succeeded": len(latencies),
+            "failed": failed,
+            "dropped": self.dropped,
+            "error_rate": round(failed / self.sent, 4) if self.sent else 0.0,
+            "latency": {
+                "p50": percentile(latencies, 0.50),
+                "p90": percentile(latencies, 0.90),
+                "p99": percentile(latencies, 0.99),
+                "max": latencies[-1] if latencies else None,
+            },
+            "errors": self.errors,
+        }
+
+
+class LoadGenerator:
+    """
+    Open-loop load generator.
+    Requests are sent at the scheduled arrival times whether or not earlier
+    requests finished, so a slow proxy does not slow down the load, and
+    latencies are measured from the scheduled arrival. At most "concurrency"
+    requests are in flight; arrivals beyond that are dropped and counted.
+    Requests are sent from a pool of "concurrency" threads, each keeping
+    its own persistent connection.
+    """
+
+    def __init__(self, scenario: dict):
+        self.scenario = scenario
+        self.url = urlparse(LLAMA_URL)
+        self.slots = threading.BoundedSemaphore(scenario["concurrency"])
+        self.executor = ThreadPoolExecutor(
+            max_workers=scenario["concurrency"], thread_name_prefix="load"
+        )
+        self.local = threading.local()
+        self.requests = scenario["requests"]
+        self.weights = [request["weight"] for request in self.requests]
+        self.bodies = [request_body(request) for request in self.requests]
+
+    def connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection_class = (
+                http.client.HTTPSConnection
+                if self.url.scheme == "https"
+                else http.client.HTTPConnection
+            )
+            connection = connection_class(
+                self.url.hostname, self.url.port, timeout=self.scenario["timeout"]
+            )
+            self.local.connection = connection
+        return connection
+
+    def send(self, index: int) -> str | None:
+        """
+        Send a request of the scenario and read the response.
+        Returns:
+            str | None: The kind of error, or None on success.
+        """
+        request = self.requests[index]
+        connection = self.connection()
+        headers = {
+            "Content-Type": "application/json",
+            "authorization": request["authorization"],
+        }
+        reused = connection.sock is not None
+        try:
+            try:
+                response = self.post(connection, index, headers)
+            except STALE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+                # The proxy closed the idle connection, reconnect once
+                connection.close()
+                response = self.post(connection, index, headers)
+            response.read()
+            if response.status != 200:
+                return f"HTTP {response.status}"
+            return None
+        except (http.client.HTTPException, OSError) as e:
+            connection.close()
+            return type(e).__name__
+
+    def post(self, connection, index: int, headers: dict) -> http.client.HTTPResponse:
+        connection.request(
+            "POST", self.url.path or "/", body=self.bodies[index], headers=headers
+        )
+        return connection.getresponse()
+
+    def fire(self, stage: Stage, index: int, arrival: float):
+        try:
+            error = self.send(index)
+            stage.finish_request(time.perf_counter() - arrival, error)
+        finally:
+            self.slots.release()
+
+    def run_stage(self, stage: Stage):
+        poisson = self.scenario["arrival"] == "poisson"
+        start = time.perf_counter()
+        end = start + stage.duration
+        arrival = start
+        if not poisson and stage.rps > 0:
+            # The first constant arrival is at the start of the stage
+            arrival -= 1 / stage.rps
+        while stage.rps > 0:
+            gap = random.expovariate(stage.rps) if poisson else 1 / stage.rps
+            arrival += gap
+            if arrival >= end:
+                break
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if not self.slots.acquire(blocking=False):
+                stage.drop_request()
+                continue
+            index = random.choices(range(len(self.requests)), self.weights)[0]
+            stage.start_request()
+            self.executor.submit(self.fire, stage, index, arrival)
+        remaining = end - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+        stage.end_scheduling()
+
+
+def log(message: str):
+    print(f"[{datetime.now(timezone.utc).isoformat()}] {message}", flush=True)
 
-        assistant_msg = extract_final_message(assistant_msg)
-        log_entry = f"[{datetime.now(timezone.utc).isoformat()}] {assistant_msg}"
-        print(log_entry, flush=True)
 
-    except Exception as e:
-        error_msg = f"[{datetime.now(timezone.utc).isoformat()}] ERROR: {e}"
-        print(error_msg, flush=True)
+def report_stages(stages: list[Stage]):
+    for stage in stages:
+        stage.wait()
+        log(f"STAGE {json.dumps(stage.report())}")
 
 
 def main():
-    print("Starting LLaMA ping service...", flush=True)
+    scenario = load_scenario()
+    generator = LoadGenerator(scenario)
+    log(
+        f"Starting load generator: {scenario['arrival']} arrivals, "
+        f"{len(scenario['stages'])} stages, concurrency {scenario['concurrency']}"
+    )
     while True:
-        ping_llama()
-        time.sleep(INTERVAL)
+        stages = [
+            Stage(number, stage["rps"], stage["duration"])
+            for number, stage in enumerate(scenario["stages"], start=1)
+        ]
+        reporter = threading.Thread(target=report_stages, args=(stages,))
+        reporter.start()
+        for stage in stages:
+            log(f"Stage {stage.number}: {stage.rps} rps for {stage.duration} s")
+            generator.run_stage(stage)
+        reporter.join()
+        if not scenario["repeat"]:
+            break
+    log("Scenario finished")
+    # Stay up, a restarted pod would run the scenario again
+    threading.Event().wait()
 
 
 if __name__ == "__main__":
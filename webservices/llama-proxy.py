@@ -1,19 +1,185 @@
+import asyncio
+import contextvars
+import fnmatch
+import glob
+import gzip
+import hashlib
 import json
+import logging
+import math
+import mmap
 import os
+import queue
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import NamedTuple
+from urllib.parse import urlsplit, urlunsplit
 
 import httpx
 import uvicorn
 import yaml
 from fastapi import FastAPI, Request, Response
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 
-app = FastAPI()
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Configuration
+# A single backend URL, or a comma separated list to balance requests over
 LLAMA_BACKEND = os.getenv(
     "LLAMA_BACKEND", "http://host.minikube.internal:39443/v1/chat/completions"
 )
+LLAMA_BACKENDS = [url.strip() for url in LLAMA_BACKEND.split(",") if url.strip()]
+
+# Health checking and circuit breaking of the backends
+BACKEND_HEALTH_INTERVAL = float(os.getenv("BACKEND_HEALTH_INTERVAL", "5"))
+BACKEND_HEALTH_TIMEOUT = float(os.getenv("BACKEND_HEALTH_TIMEOUT", "2"))
+BACKEND_FAILURE_THRESHOLD = int(os.getenv("BACKEND_FAILURE_THRESHOLD", "3"))
+BACKEND_OPEN_SECONDS = float(os.getenv("BACKEND_OPEN_SECONDS", "15"))
+BACKEND_RETRIES = int(os.getenv("BACKEND_RETRIES", "1"))
+# Errors raised before the request reached the backend. Only these are
+# retried, a generation is not idempotent
+BACKEND_RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# Warm-up of the backends at startup, so their prefix cache holds the system
+# prompt and tool definitions every request starts with
+BACKEND_WARMUP = os.getenv("BACKEND_WARMUP", "true").lower() == "true"
+WARMUP_SYSTEM_PROMPT = os.getenv(
+    "WARMUP_SYSTEM_PROMPT", "You are friendly and very concise."
+)
+WARMUP_MODEL = os.getenv("WARMUP_MODEL")
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "300"))
+
+# Shared backend connection pool, all values can be tuned through the environment
+BACKEND_MAX_CONNECTIONS = int(os.getenv("BACKEND_MAX_CONNECTIONS", "100"))
+BACKEND_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("BACKEND_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+BACKEND_KEEPALIVE_EXPIRY = float(os.getenv("BACKEND_KEEPALIVE_EXPIRY", "30"))
+BACKEND_CONNECT_TIMEOUT = float(os.getenv("BACKEND_CONNECT_TIMEOUT", "5"))
+BACKEND_READ_TIMEOUT = float(os.getenv("BACKEND_READ_TIMEOUT", "60"))
+BACKEND_WRITE_TIMEOUT = float(os.getenv("BACKEND_WRITE_TIMEOUT", "10"))
+BACKEND_POOL_TIMEOUT = float(os.getenv("BACKEND_POOL_TIMEOUT", "5"))
+
+# Policy files are compiled in memory and reloaded when they change on disk
+POLICIES_DIR = os.getenv("POLICIES_DIR", "/app/policies")
+POLICY_RELOAD_INTERVAL = float(os.getenv("POLICY_RELOAD_INTERVAL", "10"))
+DEFAULT_POLICY_USER = "defaults"
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+CONTENT_RULES_FILE = os.getenv(
+    "CONTENT_RULES_FILE", os.path.join(POLICIES_DIR, "content", "rules.yml")
+)
+DEFAULT_MAX_CONTENT_LENGTH = 20000
+
+# Admission control, per tenant limits are set in the policy files
+PROXY_MAX_CONCURRENCY = int(os.getenv("PROXY_MAX_CONCURRENCY", "32"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+# Lower values are admitted first when requests have to wait for a slot
+PRIORITY_CLASSES = {"interactive": 0, "batch": 1, "background": 2}
+
+TEST_DATA_DIR = os.getenv("TEST_DATA_DIR", "/app/test_data")
+# Most bytes file_content returns in one call, ranges and passages included
+FILE_CONTENT_MAX_BYTES = int(os.getenv("FILE_CONTENT_MAX_BYTES", "8192"))
+# Documents are split into passages of about this size for query retrieval
+PASSAGE_CHARS = int(os.getenv("PASSAGE_CHARS", "800"))
+PASSAGE_DEFAULT_TOP_K = 3
+PASSAGE_MAX_TOP_K = 10
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Directory of the files the proxy writes. It lives in the container, so
+# the files are lost on restart unless a volume is mounted here
+DATA_DIR = os.getenv("DATA_DIR", "/app/data")
+# Inverted index of the documents for search_documents, rebuilt on start
+# when the file is missing
+SEARCH_INDEX_PATH = os.getenv(
+    "SEARCH_INDEX_PATH", os.path.join(DATA_DIR, "search-index.json.gz")
+)
+SEARCH_INDEX_REFRESH_INTERVAL = float(os.getenv("SEARCH_INDEX_REFRESH_INTERVAL", "30"))
+SEARCH_INDEX_FORMAT = 1
+SEARCH_DEFAULT_TOP_K = 5
+SEARCH_MAX_TOP_K = 20
+
+# Tools doing blocking I/O run on a bounded thread pool, off the event loop
+TOOL_MAX_WORKERS = int(os.getenv("TOOL_MAX_WORKERS", "8"))
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "10"))
+BLOCKING_TOOLS = {"list_directory", "file_content", "search_documents"}
+# Tools that also get the policy of the user, to scope their results
+POLICY_SCOPED_TOOLS = {"search_documents"}
+
+# Compaction of the prompt during the tool loop. The budget covers the messages
+# and tool definitions, and leaves room for the completion in --max-model-len
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "12000"))
+TOOL_RESULT_MAX_TOKENS = int(os.getenv("TOOL_RESULT_MAX_TOKENS", "3000"))
+# Identical tool results shorter than this are cheaper to repeat than to refer to
+DEDUPLICATE_MIN_CHARS = 256
+CHARS_PER_TOKEN = 4
+MESSAGE_TOKEN_OVERHEAD = 4
+ELIDED_PREFIX = "[Tool result elided"
+
+# Opt-in cache of final responses to deterministic chat completion requests
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR")
+# Entries kept on disk, and seconds between sweeps of expired and excess ones
+RESPONSE_CACHE_DISK_MAX_ENTRIES = int(
+    os.getenv("RESPONSE_CACHE_DISK_MAX_ENTRIES", "10000")
+)
+RESPONSE_CACHE_SWEEP_INTERVAL = float(os.getenv("RESPONSE_CACHE_SWEEP_INTERVAL", "60"))
+RESPONSE_CACHE_HEADER = "x-response-cache"
+# Concurrent identical requests share a single upstream execution
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+# Batch endpoint: the requests a batch may hold and how many run at once
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "10000"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+# Times a batch request over the rate limit is retried after Retry-After
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "3"))
+# Request fields that do not influence the generated response
+UNCACHED_REQUEST_FIELDS = {"stream", "stream_options", "user"}
+
+# Structured logs, written to stdout as JSON lines by a background thread
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json", or "text" for plain lines like the proxy used to print
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_MAX_FIELD_LENGTH = int(os.getenv("LOG_MAX_FIELD_LENGTH", "2000"))
+# Share of requests whose debug payloads, such as request bodies, are logged
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.01"))
+REQUEST_ID_HEADER = "x-request-id"
+
+# Prometheus metrics, label sets beyond the limit are folded into "other"
+METRICS_MAX_SERIES = int(os.getenv("METRICS_MAX_SERIES", "500"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+POLICY_LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01)
+TOOL_LOOP_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 12, 16)
+
+# Memory-bounded cache of file_content and list_directory results
+TOOL_CACHE_MAX_BYTES = int(os.getenv("TOOL_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+TOOL_CACHE_MAX_ENTRY_BYTES = int(
+    os.getenv("TOOL_CACHE_MAX_ENTRY_BYTES", str(4 * 1024 * 1024))
+)
 
 tools = [
     {
@@ -37,7 +203,9 @@ tools = [
         "type": "function",
         "function": {
             "name": "file_content",
-            "description": "Returns the content",
+            "description": """Returns the content of a file. Pass a query to get only the
+                                passages most relevant to it, or a line or byte range to read
+                                part of the file. Long content is truncated.""",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -45,56 +213,264 @@ tools = [
                         "type": "string",
                         "description": """Name of the file to read content from,
                           files can be listed using list_directory tool""",
-                    }
+                    },
+                    "query": {
+                        "type": "string",
+                        "description": "Return only the passages most relevant to this query",
+                    },
+                    "top_k": {
+                        "type": "integer",
+                        "description": "Number of passages to return for a query, 3 by default",
+                    },
+                    "start_line": {
+                        "type": "integer",
+                        "description": "First line to return, counting from 1",
+                    },
+                    "end_line": {
+                        "type": "integer",
+                        "description": "Last line to return, inclusive",
+                    },
+                    "offset": {
+                        "type": "integer",
+                        "description": "First byte to return, counting from 0",
+                    },
+                    "length": {
+                        "type": "integer",
+                        "description": "Number of bytes to return from offset",
+                    },
+                },
+                "required": ["file_name"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "search_documents",
+            "description": """Searches all files for passages relevant to a query, and returns
+                                the best matching passages with their file name and line numbers.""",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "Words to search the files for",
+                    },
+                    "top_k": {
+                        "type": "integer",
+                        "description": "Number of passages to return, 5 by default",
+                    },
                 },
+                "required": ["query"],
             },
         },
     },
 ]
 
 
-def get_tools() -> list[dict]:
-    tool_registry = {
-        "time_now": time_now,
-        "list_directory": list_directory,
-        "file_content": file_content,
-    }
-    return tool_registry
+TOOL_NAMES = frozenset(tool["function"]["name"] for tool in tools)
+
+
+if orjson is not None:
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+else:
+
+    def json_dumps(value) -> bytes:
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode()
+
+    json_loads = json.loads
+
+
+# The correlation ID of the request being handled, and whether its debug
+# payloads are logged
+request_id_var = contextvars.ContextVar("request_id", default=None)
+debug_sampled_var = contextvars.ContextVar("debug_sampled", default=False)
+
+
+def truncate(value: str, limit: int = LOG_MAX_FIELD_LENGTH) -> str:
+    """Shorten a log value to limit characters, noting how much was cut."""
+    if len(value) <= limit:
+        return value
+    return f"{value[:limit]}... ({len(value) - limit} more characters)"
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as single-line JSON objects, with their fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname.lower(),
+            "message": truncate(record.getMessage()),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for name, value in getattr(record, "fields", {}).items():
+            if isinstance(value, str):
+                value = truncate(value)
+            elif not isinstance(value, (int, float, bool, list, type(None))):
+                value = truncate(str(value))
+            entry[name] = value
+        if record.exc_info:
+            entry["exception"] = truncate(self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Format log records as plain lines, the message followed by its fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        parts = [truncate(record.getMessage())]
+        if getattr(record, "request_id", None):
+            parts.append(f"request_id={record.request_id}")
+        for name, value in getattr(record, "fields", {}).items():
+            parts.append(f"{name}={truncate(str(value))}")
+        line = " ".join(parts)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hand log records to the background writer without blocking.
+
+    Records are formatted and written by the listener thread, so logging
+    costs the event loop a queue put. When the queue is full the record is
+    dropped and counted, rather than stalling requests on stdout.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting is left to the listener, only the context is captured here
+        record.request_id = request_id_var.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def create_logger() -> tuple[logging.Logger, DroppingQueueHandler, QueueListener]:
+    """
+    Create the proxy logger and the listener writing its records to stdout.
+    The listener is started and stopped by the lifespan of the app.
+    """
+    writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(TextFormatter() if LOG_FORMAT == "text" else JsonFormatter())
+    handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    proxy_logger = logging.getLogger("llama-proxy")
+    proxy_logger.setLevel(LOG_LEVEL)
+    proxy_logger.addHandler(handler)
+    proxy_logger.propagate = False
+    return proxy_logger, handler, QueueListener(handler.queue, writer)
+
+
+logger, log_handler, log_listener = create_logger()
+
+
+def log_event(level: int, message: str, **fields):
+    """
+    Log a message with structured fields.
+    Args:
+        level (int): The logging level, such as logging.INFO.
+        message (str): The message, which should not vary between events.
+        **fields: Values describing the event, long strings are truncated.
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={"fields": fields})
+
+
+def log_debug_payload(message: str, payload):
+    """
+    Log a debug payload, such as a request body, for sampled requests only.
+    The payload is serialized right away, so later changes to it do not race
+    with the writer thread.
+    """
+    if debug_sampled_var.get() and logger.isEnabledFor(logging.DEBUG):
+        serialized = json_dumps(payload)
+        if isinstance(serialized, bytes):
+            serialized = serialized.decode("utf-8", "replace")
+        log_event(logging.DEBUG, message, payload=serialized)
+
 
+# The tools are the same for every request, so they are serialized only once
+TOOLS_JSON = json_dumps(tools)
 
-def tools_matched(
-    tools: list[dict], response_json: dict
-) -> list[str:str, str : dict[str:str]]:
+
+def encode_backend_body(body: dict) -> bytes:
+    """
+    Serialize a request body for the backend, with the tools spliced in.
+    The body is serialized without its "tools" field and the pre-serialized
+    tools are appended, so the static tool definitions are not encoded again
+    for every backend call.
+    Args:
+        body (dict): The request body, without tools.
+    Returns:
+        bytes: The JSON body to send to the backend.
     """
-    Extracts and matches tool calls from a response JSON against a list of available tools.
+    encoded = json_dumps({k: v for k, v in body.items() if k != "tools"})
+    if encoded == b"{}":
+        return b'{"tools":' + TOOLS_JSON + b"}"
+    return encoded[:-1] + b',"tools":' + TOOLS_JSON + b"}"
+
+
+def tools_matched(message: dict) -> list[dict]:
+    """
+    Extracts the tool calls of an assistant message that match an available tool.
 
     Args:
-        tools (list[dict]): A list of dictionaries representing available tools,
-                            where each dictionary contains a 'function' key with a 'name'.
-        response_json (dict): A dictionary representing the response JSON,
-                              which contains a 'choices' key with a 'message' that includes 'tool_calls'.
+        message (dict): The assistant message, which may include 'tool_calls'.
 
     Returns:
-        list[str:str, str : dict[str:str]]: A list of matched tool function dictionaries
-                                             that were called in the response.
-
-    Prints:
-        - Available tool names.
-        - Called tools in the response.
-        - Extracted tool calls.
-    """
-    tool_names = {tool["function"]["name"] for tool in tools}
-    print("Available tool names:", tool_names)
-    message = response_json["choices"][0]["message"]
-    tool_calls = message["tool_calls"]
-    called_tools = {tool["function"]["name"] for tool in tool_calls}
-    print("Called tools in response:", called_tools)
-    matched = called_tools & tool_names
-    full_matched_calls = [
-        call["function"] for call in tool_calls if call["function"]["name"] in matched
+        list[dict]: A list of the matched tool calls, each with its 'id' and
+                    'function' dictionary, in the order they were called.
+    """
+    return [
+        call
+        for call in message.get("tool_calls") or ()
+        if call.get("function", {}).get("name") in TOOL_NAMES
     ]
-    print("Extracted tool calls:", tool_calls)
-    return full_matched_calls
+
+
+class BackendReply(NamedTuple):
+    """A backend response, parsed once."""
+
+    status_code: int
+    content: bytes
+    message: dict
+    tool_calls: list[dict]
+    usage: dict
+
+
+def parse_backend_reply(status_code: int, content: bytes) -> BackendReply:
+    """
+    Parse a backend chat completion response into a BackendReply.
+    Responses that are not a chat completion, such as errors, get an empty
+    message and no tool calls.
+    Args:
+        status_code (int): The HTTP status code of the backend response.
+        content (bytes): The raw body of the backend response.
+    Returns:
+        BackendReply: The parsed view of the response.
+    """
+    try:
+        data = json_loads(content)
+    except ValueError:
+        data = None
+    message = {}
+    usage = {}
+    if isinstance(data, dict):
+        choices = data.get("choices") or [{}]
+        message = choices[0].get("message") or {}
+        usage = data.get("usage") or {}
+    return BackendReply(status_code, content, message, tools_matched(message), usage)
 
 
 def time_now() -> str:
@@ -109,42 +485,627 @@ def time_now() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
+class ToolResultCache:
+    """
+    LRU cache of tool results read from disk, bounded by their size in bytes.
+
+    Entries are keyed on path and stored with the modification time and size
+    of the path. Every lookup compares those against a fresh stat, so results
+    are reloaded as soon as the file or directory changes. Results larger
+    than max_entry_bytes are never cached, so a single large file can not
+    evict everything else. Lookups are thread safe, since tools run on the
+    tool thread pool.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries: OrderedDict[str, tuple[tuple[int, int], object, int]] = (
+            OrderedDict()
+        )
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, path: str, load, size_of, key: str | None = None):
+        """
+        Return the cached result for a path, loading it if missing or stale.
+        Args:
+            path (str): The path the result was read from.
+            load (Callable[[], object]): Reads the result from disk.
+            size_of (Callable[[object], int]): Returns the size of a result in bytes.
+            key (str | None): The cache key, to cache several results derived
+                from the same path. Defaults to the path.
+        Returns:
+            object: The result of load for the current version of the path.
+        """
+        key = key or path
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        result = load()
+        nbytes = size_of(result)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            if nbytes <= self.max_entry_bytes:
+                self.entries[key] = (version, result, nbytes)
+                self.size += nbytes
+                while self.size > self.max_bytes:
+                    _, (_, _, evicted) = self.entries.popitem(last=False)
+                    self.size -= evicted
+                    self.evictions += 1
+        return result
+
+    def stats(self) -> dict:
+        """Return the hit, miss and eviction counters and the current size."""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+tool_cache = ToolResultCache(TOOL_CACHE_MAX_BYTES, TOOL_CACHE_MAX_ENTRY_BYTES)
+
+
+def read_text_file(file_path: str) -> str:
+    """Read a text file from disk."""
+    with open(file_path, "r") as f:
+        return f.read()
+
+
 def list_directory() -> list[str]:
     """
     List the contents of the specified directory.
 
     This function retrieves a list of the names of the entries in the directory
-    given by the path "/app/test_data". The entries are returned as a list of
-    strings.
+    given by TEST_DATA_DIR ("/app/test_data" by default). The entries are
+    returned as a list of strings, served from the tool cache while the
+    directory is unchanged.
 
     Returns:
         list[str]: A list containing the names of the entries in the directory.
     """
-    return os.listdir("/app/test_data")
+    return tool_cache.get(
+        TEST_DATA_DIR,
+        lambda: os.listdir(TEST_DATA_DIR),
+        lambda names: sum(len(name) for name in names),
+    )
+
+
+def read_file_range(file_path: str, start: int, end: int) -> bytes:
+    """
+    Read the bytes in [start, end) of a file through mmap.
+    Only the pages of the range are read, not the whole file.
+    """
+    if start >= end or os.path.getsize(file_path) == 0:
+        return b""
+    with (
+        open(file_path, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+    ):
+        return mapped[start:end]
+
+
+def build_line_offsets(file_path: str) -> array:
+    """Return the byte offset of the start of every line of a file, and its size."""
+    offsets = array("q", [0])
+    size = os.path.getsize(file_path)
+    if size:
+        with (
+            open(file_path, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+        ):
+            position = mapped.find(b"\n")
+            while position != -1:
+                offsets.append(position + 1)
+                position = mapped.find(b"\n", position + 1)
+    if offsets[-1] != size:
+        offsets.append(size)
+    return offsets
+
+
+def line_offsets(file_path: str) -> array:
+    """Return the line offsets of a file, served from the tool cache."""
+    return tool_cache.get(
+        file_path,
+        lambda: build_line_offsets(file_path),
+        lambda offsets: offsets.itemsize * len(offsets),
+        key=f"{file_path}#lines",
+    )
+
+
+def tokenize(text: str) -> list[str]:
+    """Split text into lowercase word terms for passage retrieval."""
+    return re.findall(r"\w+", text.lower())
+
+
+class Passage(NamedTuple):
+    """A chunk of a document, with its term frequencies for retrieval."""
+
+    start_line: int
+    end_line: int
+    text: str
+    terms: dict[str, int]
+    length: int
+
+
+def make_passage(lines: list[str], start_line: int) -> Passage:
+    text = "".join(lines).strip()
+    terms = {}
+    words = tokenize(text)
+    for word in words:
+        terms[word] = terms.get(word, 0) + 1
+    return Passage(start_line, start_line + len(lines) - 1, text, terms, len(words))
+
+
+def split_passages(text: str) -> list[Passage]:
+    """
+    Split a document into passages of about PASSAGE_CHARS characters.
+    Passages end at paragraph breaks where possible, and at line breaks
+    otherwise, so they can be quoted with their line numbers.
+    """
+    passages = []
+    lines = []
+    size = 0
+    start_line = 1
+    for number, line in enumerate(text.splitlines(keepends=True), start=1):
+        if not lines and not line.strip():
+            start_line = number + 1
+            continue
+        lines.append(line)
+        size += len(line)
+        paragraph_end = not line.strip()
+        if size >= PASSAGE_CHARS or (paragraph_end and size >= PASSAGE_CHARS // 2):
+            passages.append(make_passage(lines, start_line))
+            lines, size, start_line = [], 0, number + 1
+    if any(line.strip() for line in lines):
+        passages.append(make_passage(lines, start_line))
+    return passages
+
+
+def file_passages(file_path: str) -> list[Passage]:
+    """Return the passages of a file, served from the tool cache."""
+    return tool_cache.get(
+        file_path,
+        lambda: split_passages(read_text_file(file_path)),
+        lambda passages: sum(len(passage.text) * 2 for passage in passages),
+        key=f"{file_path}#passages",
+    )
+
+
+def warm_passages(directory: str = TEST_DATA_DIR):
+    """Split every document into passages ahead of the first query."""
+    for file_name in os.listdir(directory):
+        file_path = os.path.join(directory, file_name)
+        if os.path.isfile(file_path):
+            file_passages(file_path)
+
+
+def rank_passages(passages: list[Passage], query: str, top_k: int) -> list[Passage]:
+    """
+    Return the top_k passages most relevant to a query, ranked with BM25.
+    Passages that share no term with the query are never returned.
+    """
+    query_terms = set(tokenize(query))
+    if not passages or not query_terms:
+        return []
+    average_length = sum(passage.length for passage in passages) / len(passages)
+    document_frequency = {
+        term: sum(1 for passage in passages if term in passage.terms)
+        for term in query_terms
+    }
+    scored = []
+    for index, passage in enumerate(passages):
+        score = 0.0
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * passage.length / (average_length or 1))
+        for term in query_terms:
+            frequency = passage.terms.get(term)
+            if not frequency:
+                continue
+            df = document_frequency[term]
+            idf = math.log(1 + (len(passages) - df + 0.5) / (df + 0.5))
+            score += idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        if score > 0:
+            scored.append((score, -index, passage))
+    scored.sort(reverse=True)
+    return [passage for _, _, passage in scored[:top_k]]
+
+
+def cap_content(content: bytes, hint: str) -> str:
+    """Decode file content, truncated to FILE_CONTENT_MAX_BYTES with a hint."""
+    if len(content) <= FILE_CONTENT_MAX_BYTES:
+        return content.decode("utf-8", "replace")
+    text = content[:FILE_CONTENT_MAX_BYTES].decode("utf-8", "ignore")
+    return f"{text}\n[Truncated at {FILE_CONTENT_MAX_BYTES} bytes, {hint}]"
+
+
+def int_argument(arguments: dict, name: str) -> int | None:
+    """Return an optional integer tool argument, rejecting other values."""
+    value = arguments.get(name)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise TypeError(f"{name} must be an integer")
+    try:
+        return int(value)
+    except (ValueError, OverflowError):
+        raise ValueError(f"{name} must be an integer") from None
 
 
 def file_content(arguments: dict) -> str:
     """
-    Retrieve the content of a specified file.
+    Retrieve the content of a specified file, or part of it.
 
     This function takes a dictionary of arguments, extracts the file name,
     constructs the full file path, and attempts to read the file's content.
-    If the file exists, its content is returned as a string. If the file
+    With a "query" only the "top_k" passages most relevant to it are
+    returned, with their line numbers. With "start_line" and "end_line", or
+    "offset" and "length", only that range is read, through mmap. Otherwise
+    the whole file is returned, served from the tool cache while the file is
+    unchanged. Every result is capped at FILE_CONTENT_MAX_BYTES. If the file
     does not exist, a "File not found" message is returned.
 
     Args:
         arguments (dict): A dictionary containing the key "file_name"
-                          which specifies the name of the file to read.
+                          which specifies the name of the file to read, and
+                          the optional query and range arguments.
 
     Returns:
-        str: The content of the file if found, otherwise "File not found".
+        str: The requested content of the file if found, otherwise "File not found".
     """
     file_name = arguments["file_name"]
-    file_path = os.path.join("/app/test_data/", file_name)
-    if os.path.isfile(file_path):
-        with open(file_path, "r") as f:
-            return f.read()
-    return "File not found"
+    file_path = os.path.join(TEST_DATA_DIR, file_name)
+    if not os.path.isfile(file_path):
+        return "File not found"
+
+    query = arguments.get("query")
+    if query:
+        top_k = int_argument(arguments, "top_k") or PASSAGE_DEFAULT_TOP_K
+        top_k = max(1, min(top_k, PASSAGE_MAX_TOP_K))
+        passages = rank_passages(file_passages(file_path), str(query), top_k)
+        if not passages:
+            return "No passages match the query."
+        content = "\n\n".join(
+            f"[lines {passage.start_line}-{passage.end_line}]\n{passage.text}"
+            for passage in passages
+        )
+        return cap_content(content.encode("utf-8"), "ask for fewer passages")
+
+    start_line = int_argument(arguments, "start_line")
+    end_line = int_argument(arguments, "end_line")
+    if start_line is not None or end_line is not None:
+        offsets = line_offsets(file_path)
+        line_count = len(offsets) - 1
+        first = max(1, start_line or 1)
+        last = min(line_count, end_line if end_line is not None else line_count)
+        if first > last:
+            return f"No lines in that range, the file has {line_count} lines."
+        start, end = offsets[first - 1], offsets[last]
+        end = min(end, start + FILE_CONTENT_MAX_BYTES + 1)
+        # The line the content is cut in
+        next_line = bisect_right(offsets, start + FILE_CONTENT_MAX_BYTES)
+        content = read_file_range(file_path, start, end)
+        return cap_content(content, f"continue at start_line={next_line}")
+
+    offset = int_argument(arguments, "offset")
+    length = int_argument(arguments, "length")
+    if offset is not None or length is not None:
+        start = max(0, offset or 0)
+        size = os.path.getsize(file_path)
+        end = size if length is None else min(size, start + max(0, length))
+        end = min(end, start + FILE_CONTENT_MAX_BYTES + 1)
+        content = read_file_range(file_path, start, end)
+        next_offset = start + FILE_CONTENT_MAX_BYTES
+        return cap_content(content, f"continue at offset={next_offset}")
+
+    content = tool_cache.get(
+        file_path,
+        lambda: read_text_file(file_path),
+        lambda content: len(content.encode("utf-8")),
+    )
+    if len(content) * 4 <= FILE_CONTENT_MAX_BYTES:
+        return content
+    return cap_content(
+        content.encode("utf-8"), "read the rest with start_line or a query"
+    )
+
+
+class DocumentIndex:
+    """
+    Inverted index of the passages of the documents in a directory.
+
+    Postings map every term to the passages containing it, with its
+    frequency there, for BM25 ranking. Documents are versioned by their
+    modification time and size, so a refresh only reads the files that
+    changed and drops the ones that were removed. The index is persisted as
+    gzipped JSON holding the postings and the line numbers of every passage;
+    passage text is read from the files when it is returned. Access is
+    locked, since searches run on the tool thread pool.
+    """
+
+    def __init__(self, directory: str, path: str | None):
+        self.directory = directory
+        self.path = path
+        # File name -> (mtime_ns, size) and the ids of its passages
+        self.documents: dict[str, tuple[list[int], list[int]]] = {}
+        # Passage id -> file name, start line, end line, length in terms
+        self.passages: dict[int, tuple[str, int, int, int]] = {}
+        self.postings: dict[str, dict[int, int]] = {}
+        self.total_length = 0
+        self.next_id = 0
+        self.ready = False
+        self.lock = threading.Lock()
+
+    def add_document(self, file_name: str, version: list[int], passages: list[Passage]):
+        """Add a document and its passages to the postings."""
+        ids = []
+        for passage in passages:
+            passage_id = self.next_id
+            self.next_id += 1
+            self.passages[passage_id] = (
+                file_name,
+                passage.start_line,
+                passage.end_line,
+                passage.length,
+            )
+            for term, frequency in passage.terms.items():
+                self.postings.setdefault(term, {})[passage_id] = frequency
+            self.total_length += passage.length
+            ids.append(passage_id)
+        self.documents[file_name] = (list(version), ids)
+
+    def remove_documents(self, file_names: list[str]):
+        """Remove documents and their passages, in one pass over the postings."""
+        removed = set()
+        for file_name in file_names:
+            removed.update(self.documents.pop(file_name)[1])
+        if not removed:
+            return
+        for passage_id in removed:
+            self.total_length -= self.passages.pop(passage_id)[3]
+        for term in list(self.postings):
+            posting = self.postings[term]
+            if len(posting) < len(removed):
+                stale = [passage_id for passage_id in posting if passage_id in removed]
+            else:
+                stale = [passage_id for passage_id in removed if passage_id in posting]
+            for passage_id in stale:
+                del posting[passage_id]
+            if not posting:
+                del self.postings[term]
+
+    def refresh(self) -> bool:
+        """
+        Bring the index up to date with the directory.
+        Returns:
+            bool: Whether any document was added, changed or removed.
+        """
+        found = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    found[entry.name] = [stat.st_mtime_ns, stat.st_size]
+        with self.lock:
+            stale = [
+                file_name
+                for file_name, (version, _) in self.documents.items()
+                if found.get(file_name) != version
+            ]
+            self.remove_documents(stale)
+            missing = [name for name in found if name not in self.documents]
+        for file_name in missing:
+            try:
+                text = read_text_file(os.path.join(self.directory, file_name))
+            except (OSError, UnicodeDecodeError) as e:
+                log_event(
+                    logging.WARNING, "Error indexing file", file=file_name, error=str(e)
+                )
+                continue
+            passages = split_passages(text)
+            with self.lock:
+                self.add_document(file_name, found[file_name], passages)
+        return bool(stale or missing)
+
+    def load(self) -> bool:
+        """Load the persisted index, if it was built for the same directory."""
+        if not self.path:
+            return False
+        try:
+            with gzip.open(self.path, "rb") as f:
+                data = json_loads(f.read())
+        except (OSError, ValueError):
+            return False
+        if (
+            not isinstance(data, dict)
+            or data.get("format") != SEARCH_INDEX_FORMAT
+            or data.get("directory") != self.directory
+        ):
+            return False
+        with self.lock:
+            self.documents = {
+                file_name: (version, ids)
+                for file_name, (version, ids) in data["documents"].items()
+            }
+            self.passages = {
+                passage_id: (file_name, start_line, end_line, length)
+                for passage_id, file_name, start_line, end_line, length in data[
+                    "passages"
+                ]
+            }
+            # Postings are stored flat, as passage id, frequency, passage id, ...
+            self.postings = {
+                term: dict(zip(flat[::2], flat[1::2]))
+                for term, flat in data["postings"].items()
+            }
+            self.total_length = sum(passage[3] for passage in self.passages.values())
+            self.next_id = max(self.passages, default=-1) + 1
+        return True
+
+    def save(self):
+        """Persist the index atomically."""
+        if not self.path:
+            return
+        with self.lock:
+            data = {
+                "format": SEARCH_INDEX_FORMAT,
+                "directory": self.directory,
+                "documents": self.documents,
+                "passages": [
+                    [passage_id, *passage]
+                    for passage_id, passage in self.passages.items()
+                ],
+                "postings": {
+                    term: [value for item in posting.items() for value in item]
+                    for term, posting in self.postings.items()
+                },
+            }
+            content = json_dumps(data)
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(gzip.compress(content, compresslevel=5))
+        os.replace(tmp_path, self.path)
+
+    def build(self):
+        """Load the persisted index, catch up with the directory and save it."""
+        loaded = self.load()
+        changed = self.refresh()
+        if changed or not loaded:
+            self.save()
+        self.ready = True
+        log_event(
+            logging.INFO,
+            "Search index ready",
+            documents=len(self.documents),
+            passages=len(self.passages),
+            loaded_from_disk=loaded,
+        )
+
+    def search(
+        self, query: str, top_k: int, allowed_files: re.Pattern | None = None
+    ) -> list[tuple[float, str, int, int]]:
+        """
+        Return the passages most relevant to a query, ranked with BM25.
+        Args:
+            query (str): The words to search for.
+            top_k (int): The maximum number of passages to return.
+            allowed_files (re.Pattern | None): Only passages of files matching
+                this pattern are returned.
+        Returns:
+            list[tuple[float, str, int, int]]: The score, file name, start line
+            and end line of the best passages, best first.
+        """
+        terms = set(tokenize(query))
+        with self.lock:
+            count = len(self.passages)
+            if not count or not terms:
+                return []
+            average_length = self.total_length / count or 1
+            scores = {}
+            for term in terms:
+                posting = self.postings.get(term)
+                if not posting:
+                    continue
+                df = len(posting)
+                idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+                for passage_id, frequency in posting.items():
+                    length = self.passages[passage_id][3]
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+                    score = idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+                    scores[passage_id] = scores.get(passage_id, 0.0) + score
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+            results = []
+            for passage_id, score in ranked:
+                file_name, start_line, end_line = self.passages[passage_id][:3]
+                if path_allowed(allowed_files, file_name):
+                    results.append((score, file_name, start_line, end_line))
+                    if len(results) == top_k:
+                        break
+            return results
+
+    def stats(self) -> dict:
+        """Return the size of the index."""
+        with self.lock:
+            return {
+                "ready": self.ready,
+                "documents": len(self.documents),
+                "passages": len(self.passages),
+                "terms": len(self.postings),
+            }
+
+
+document_index = DocumentIndex(TEST_DATA_DIR, SEARCH_INDEX_PATH)
+
+
+def search_documents(arguments: dict, tool_policy: "ToolPolicy | None" = None) -> str:
+    """
+    Search all documents for the passages most relevant to a query.
+
+    Passages are ranked with BM25 over the document index, and only passages
+    of files the user may read, by the allowed_files globs of their
+    search_documents policy, are returned. Every passage is returned with its
+    file name and line numbers, so the model can read around it with
+    file_content. The result is capped at FILE_CONTENT_MAX_BYTES.
+
+    Args:
+        arguments (dict): A dictionary containing the key "query", and
+                          optionally "top_k".
+        tool_policy (ToolPolicy | None): The search_documents policy of the user.
+
+    Returns:
+        str: The matching passages, or a message saying there are none.
+    """
+    query = str(arguments.get("query") or "")
+    top_k = int_argument(arguments, "top_k") or SEARCH_DEFAULT_TOP_K
+    top_k = max(1, min(top_k, SEARCH_MAX_TOP_K))
+    allowed_files = tool_policy.allowed_files if tool_policy is not None else None
+    results = document_index.search(query, top_k, allowed_files)
+    if not results:
+        return "No documents match the query."
+    sections = []
+    for _, file_name, start_line, end_line in results:
+        file_path = os.path.join(TEST_DATA_DIR, file_name)
+        try:
+            offsets = line_offsets(file_path)
+            content = read_file_range(
+                file_path,
+                offsets[start_line - 1],
+                offsets[min(end_line, len(offsets) - 1)],
+            )
+        except (OSError, IndexError):
+            # Changed or removed since it was indexed, the next refresh catches up
+            continue
+        text = content.decode("utf-8", "replace").strip()
+        sections.append(f"[{file_name}, lines {start_line}-{end_line}]\n{text}")
+    if not sections:
+        return "No documents match the query."
+    return cap_content("\n\n".join(sections).encode("utf-8"), "ask for fewer passages")
+
+
+TOOL_REGISTRY = {
+    "time_now": time_now,
+    "list_directory": list_directory,
+    "file_content": file_content,
+    "search_documents": search_documents,
+}
 
 
 def add_system_message(messages: list[dict], new_content: str):
@@ -180,162 +1141,2487 @@ def add_system_message(messages: list[dict], new_content: str):
     return messages
 
 
-async def llama_request(backend, body) -> httpx.Response:
+def create_backend_client() -> httpx.AsyncClient:
     """
-    Make an asynchronous HTTP POST request to a Llama backend service.
-    Args:
-        backend (str): The URL of the Llama backend service to send the request to.
-        body (dict): The request body to be sent as JSON to the backend service.
+    Create the pooled HTTP client shared by all requests to the Llama backend.
+    Connection limits and per-phase timeouts are taken from the BACKEND_*
+    environment variables, so connections to vLLM are kept alive and reused
+    instead of being set up again for every backend call.
     Returns:
-        httpx.Response: The HTTP response object returned by the backend service.
-    Raises:
-        httpx.TimeoutException: If the request exceeds the 60-second timeout.
-        httpx.RequestError: If there is an error making the HTTP request.
+        httpx.AsyncClient: The client, to be closed when the application stops.
     """
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        llama_response = await client.post(
-            backend,
-            json=body,
-            headers={"Content-Type": "application/json"},
-        )
-    return llama_response
+    limits = httpx.Limits(
+        max_connections=BACKEND_MAX_CONNECTIONS,
+        max_keepalive_connections=BACKEND_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=BACKEND_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        connect=BACKEND_CONNECT_TIMEOUT,
+        read=BACKEND_READ_TIMEOUT,
+        write=BACKEND_WRITE_TIMEOUT,
+        pool=BACKEND_POOL_TIMEOUT,
+    )
+    return httpx.AsyncClient(limits=limits, timeout=timeout)
 
 
-def enforce_user_policy(user_id: str, tool_name) -> tuple[bool, str]:
-    """
-        Enforce user-specific policies for tool usage.
+async def watch_policies(store: "PolicyStore", interval: float):
+    """Periodically reload the policy store when a policy file changed on disk."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(store.reload_if_changed)
+        except Exception as e:
+            log_event(logging.ERROR, "Error reloading policies", error=str(e))
 
-    This function checks if a specified tool is allowed for a given user based on their individual policy file.
-    The policy file is expected to be in YAML format and located in the `/app/policies/` directory, named after the user ID.
 
-    Args:
-        user_id (str): The unique identifier for the user whose policy is being enforced.
-        tool_name (str): The name of the tool for which access is being checked.
+async def watch_backends(
+    pool: "BackendPool", client: httpx.AsyncClient, interval: float
+):
+    """Periodically probe the health of every backend."""
+    while True:
+        try:
+            await pool.probe(client)
+        except Exception as e:
+            log_event(logging.ERROR, "Error probing backends", error=str(e))
+        await asyncio.sleep(interval)
 
-    Returns:
-        tuple[bool, str]: A tuple containing:
-            - allowed (bool): Indicates whether the tool is allowed for the user.
-            - message (str): A message explaining the result; if not allowed, it specifies the reason.
+
+async def watch_documents(index: "DocumentIndex", interval: float):
     """
-    user_policy_yaml = f"/app/policies/{user_id}.yml"
+    Periodically update the search index with the documents that changed.
+    A build that failed at startup is retried until the index is ready.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if not index.ready:
+                await asyncio.to_thread(index.build)
+            elif await asyncio.to_thread(index.refresh):
+                await asyncio.to_thread(index.save)
+        except Exception as e:
+            log_event(logging.ERROR, "Error updating the search index", error=str(e))
 
-    if os.path.isfile(user_policy_yaml):
-        with open(user_policy_yaml, "r") as file:
-            user_policy = yaml.safe_load(file)
-            try:
-                tool_allowed = user_policy["tools"][tool_name].get("allowed", False)
-            except KeyError:
-                print(f"Tool {tool_name} not found in user {user_id} policy.")
-                tool_allowed = False
 
-    if not tool_allowed:
-        reason = "Tool not allowed by user policy."
-    else:
-        reason = None
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Set up shared state on startup and tear it down on shutdown.
+    Opens the pooled backend client, compiles the policy files and starts
+    watching them and the health of the backends, and starts the log writer.
+    The documents are split into passages for file_content queries, and the
+    search index is loaded from disk, brought up to date and watched. The
+    backends are warmed up in the background.
+    The tool thread pool is shut down and the logs are flushed on exit.
+    """
+    log_listener.start()
+    app.state.backend_client = create_backend_client()
+    policy_store.load()
+    try:
+        await asyncio.to_thread(warm_passages)
+        await asyncio.to_thread(document_index.build)
+    except Exception as e:
+        log_event(logging.WARNING, "Error indexing documents", error=str(e))
+    policy_watcher = asyncio.create_task(
+        watch_policies(policy_store, POLICY_RELOAD_INTERVAL)
+    )
+    backend_watcher = asyncio.create_task(
+        watch_backends(backend_pool, app.state.backend_client, BACKEND_HEALTH_INTERVAL)
+    )
+    document_watcher = asyncio.create_task(
+        watch_documents(document_index, SEARCH_INDEX_REFRESH_INTERVAL)
+    )
+    warmup = asyncio.create_task(
+        backend_warmup.run(app.state.backend_client, backend_pool)
+    )
+    try:
+        yield
+    finally:
+        policy_watcher.cancel()
+        backend_watcher.cancel()
+        document_watcher.cancel()
+        warmup.cancel()
+        await app.state.backend_client.aclose()
+        tool_executor.shutdown(wait=False, cancel_futures=True)
+        log_listener.stop()
 
-    return tool_allowed, reason
 
+app = FastAPI(lifespan=lifespan)
 
-def enforce_tenant_policy(payload: dict) -> tuple[bool, str]:
+
+class Metric:
     """
-    Apply inline policy enforcement on the request.
-    Return (allowed: bool, message: str)
+    A Prometheus metric, with a series per set of label values.
+
+    Metrics are only updated from the event loop, so they need no locking.
+    The number of label sets is capped at METRICS_MAX_SERIES, further label
+    sets are recorded under "other" so a bad label can not grow memory.
     """
-    messages = payload.get("messages", [])
-    for msg in messages:
-        content = msg.get("content", "").lower()
-        # Example policies
-        if "password" in content:
-            return (
-                False,
-                "Policy violation: request contains sensitive keyword 'password'.",
-            )
-        if len(content) > 20000:
-            return False, "Policy violation: input too long."
-    return True, "Allowed"
 
+    kind = "untyped"
 
-@app.post("/v1/chat/completions")
-async def proxy_chat_completions(request: Request):
-    """
-    Proxy chat completions to the LLaMA backend.
-    This asynchronous function handles incoming requests for chat completions,
-    enforces tenant policies, and forwards the request to the LLaMA backend.
-    It processes the response, executes any tools specified in the request,
-    and updates the message history accordingly.
-    Args:
-        request (Request): The incoming HTTP request containing the chat completion parameters.
-    Returns:
-        Response: A JSON response containing the chat completion results or an error message.
-    Raises:
-        Exception: Catches and handles exceptions during request processing and tool execution.
-    """
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
 
-    try:
-        # Parse incoming request
-        body = await request.json()
-        user_id = request.headers.get("authorization", "default_user")
-        allowed, reason = enforce_tenant_policy(body)
-        if not allowed:
-            return JSONResponse(status_code=403, content={"error": reason})
+    def bounded(self, series: dict, labels: tuple) -> tuple:
+        """Return the label values to record under, folding new ones past the cap."""
+        if len(series) >= METRICS_MAX_SERIES:
+            return ("other",) * len(self.label_names)
+        return labels
 
-        body["tools"] = tools
+    def samples(self):
+        """Yield the name suffix, label pairs and value of every sample."""
+        return iter(())
 
-        # Forward to actual LLaMA backend
-        llama_response = await llama_request(LLAMA_BACKEND, body)
 
-        llama_response_json = llama_response.json()
+class Counter(Metric):
+    """A Prometheus counter, a value that only goes up."""
 
-        try:
-            while tools_matched(tools, llama_response_json):
-                tool_registry = get_tools()
-                tools_called = tools_matched(tools, llama_response_json)
-                print("Tools called:", tools_called)
-                for tool_call in tools_called:
-                    print(f"Tool {tool_call['name']} called for user {user_id}")
-                    allowed, reason = enforce_user_policy(user_id, tool_call["name"])
-                    if not allowed:
-                        return JSONResponse(
-                            status_code=403, content=f"Forbidden + {reason}"
-                        )
-                    print("Executing tool:", tool_call["name"])
-                    print("With arguments:", tool_call["arguments"])
-                    if tool_call["arguments"] != "{}":
-                        result = tool_registry[tool_call["name"]](
-                            json.loads(tool_call["arguments"])
-                        )
-                    else:
-                        result = tool_registry[tool_call["name"]]()
-                    body["messages"].append(
-                        llama_response_json["choices"][0]["message"]
-                    )
-                    body["messages"].append(
-                        {
-                            "role": "tool",
-                            "name": tool_call["name"],
-                            "content": result,
-                        }
-                    )
-                print("Updated body with tool results:", body)
-                llama_response = await llama_request(LLAMA_BACKEND, body)
-                llama_response_json = llama_response.json()
-        except Exception as e:
-            print(f"Error during tool execution: {str(e)}")
-            pass
+    kind = "counter"
 
-        return Response(
-            content=llama_response.content,
-            status_code=llama_response.status_code,
-            media_type="application/json",
-        )
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        super().__init__(name, documentation, label_names)
+        self.values: dict[tuple, float] = {}
 
-    except Exception:
-        return JSONResponse(status_code=500, content="Server error")
+    def inc(self, labels: tuple = (), amount: float = 1):
+        """Increase the value for a set of label values."""
+        if labels not in self.values:
+            labels = self.bounded(self.values, labels)
+        self.values[labels] = self.values.get(labels, 0) + amount
 
+    def samples(self):
+        for labels, value in self.values.items():
+            yield "", list(zip(self.label_names, labels)), value
 
-@app.get("/health")
-async def health():
-    return {"status": "ok"}
+
+class Gauge(Counter):
+    """A Prometheus gauge, a value that goes up and down."""
+
+    kind = "gauge"
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        """Decrease the value for a set of label values."""
+        self.inc(labels, -amount)
+
+
+class Histogram(Metric):
+    """A Prometheus histogram with fixed buckets, per set of label values."""
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, buckets: tuple, label_names: tuple = ()
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(float(bound) for bound in buckets)
+        # Per label set: the count of every bucket and of +Inf, then the sum
+        self.series: dict[tuple, list] = {}
+
+    def observe(self, value: float, labels: tuple = ()):
+        """Record an observation for a set of label values."""
+        series = self.series.get(labels)
+        if series is None:
+            labels = self.bounded(self.series, labels)
+            series = self.series.setdefault(labels, [0] * (len(self.buckets) + 2))
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for labels, series in self.series.items():
+            pairs = list(zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                yield "_bucket", pairs + [("le", le)], cumulative
+            yield "_count", pairs, cumulative
+            yield "_sum", pairs, series[-1]
+
+
+def escape_label_value(value) -> str:
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics(metrics: list[Metric]) -> str:
+    """
+    Render metrics in the Prometheus text exposition format.
+    Args:
+        metrics (list[Metric]): The metrics to render.
+    Returns:
+        str: The metrics, one sample per line.
+    """
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in metric.samples():
+            label_text = ",".join(
+                f'{name}="{escape_label_value(label)}"' for name, label in labels
+            )
+            if label_text:
+                label_text = "{" + label_text + "}"
+            lines.append(f"{metric.name}{suffix}{label_text} {value}")
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_LATENCY = Histogram(
+    "llama_proxy_request_duration_seconds",
+    "Time from receiving a chat completion request until its response is sent.",
+    LATENCY_BUCKETS,
+    ("mode", "code"),
+)
+TENANT_POLICY_LATENCY = Histogram(
+    "llama_proxy_tenant_policy_duration_seconds",
+    "Time spent checking a request against the content rules.",
+    POLICY_LATENCY_BUCKETS,
+)
+BACKEND_LATENCY = Histogram(
+    "llama_proxy_backend_request_duration_seconds",
+    "Time of a backend call, until the headers for streamed calls.",
+    LATENCY_BUCKETS,
+    ("backend", "outcome"),
+)
+TOOL_LATENCY = Histogram(
+    "llama_proxy_tool_duration_seconds",
+    "Time spent executing a tool.",
+    LATENCY_BUCKETS,
+    ("tool",),
+)
+TOOL_LOOP_DEPTH = Histogram(
+    "llama_proxy_tool_loop_iterations",
+    "Number of tool loop iterations of a chat completion request.",
+    TOOL_LOOP_BUCKETS,
+    ("mode",),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "llama_proxy_requests_in_flight",
+    "Chat completion requests currently being handled.",
+)
+REQUESTS_IN_FLIGHT.inc((), 0)
+POLICY_DENIALS = Counter(
+    "llama_proxy_policy_denials_total",
+    "Requests denied by the tenant content rules or a user tool policy.",
+    ("policy",),
+)
+COMPACTIONS = Counter(
+    "llama_proxy_tool_result_compactions_total",
+    "Tool results truncated, deduplicated or elided to fit the context window.",
+    ("action",),
+)
+TOKENS = Counter(
+    "llama_proxy_tokens_total",
+    "Tokens reported in the usage of backend responses.",
+    ("tenant", "type"),
+)
+LOG_RECORDS_DROPPED = Counter(
+    "llama_proxy_log_records_dropped_total",
+    "Log records dropped because the log writer fell behind.",
+)
+METRICS = [
+    REQUEST_LATENCY,
+    TENANT_POLICY_LATENCY,
+    BACKEND_LATENCY,
+    TOOL_LATENCY,
+    TOOL_LOOP_DEPTH,
+    REQUESTS_IN_FLIGHT,
+    POLICY_DENIALS,
+    COMPACTIONS,
+    TOKENS,
+    LOG_RECORDS_DROPPED,
+]
+
+
+def record_usage(tenant: str, usage: dict | None):
+    """Count the prompt and completion tokens of a backend response."""
+    if usage:
+        TOKENS.inc((tenant, "prompt"), usage.get("prompt_tokens") or 0)
+        TOKENS.inc((tenant, "completion"), usage.get("completion_tokens") or 0)
+
+
+class NoBackendAvailable(Exception):
+    """Raised when every backend is unhealthy or has an open circuit."""
+
+
+class Backend:
+    """
+    A single vLLM backend with its load and circuit breaker state.
+
+    The circuit opens after BACKEND_FAILURE_THRESHOLD consecutive failures,
+    or when an active health probe fails, and the backend is then skipped.
+    After BACKEND_OPEN_SECONDS it goes half-open: one trial request is let
+    through, and its outcome closes or reopens the circuit.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        parts = urlsplit(url)
+        self.health_url = urlunsplit((parts.scheme, parts.netloc, "/health", "", ""))
+        self.outstanding = 0
+        self.failures = 0
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+    def available(self, now: float) -> bool:
+        """Check whether requests may be routed to the backend."""
+        if self.state == "open" and now - self.opened_at >= BACKEND_OPEN_SECONDS:
+            self.state = "half_open"
+            self.trial_in_flight = False
+        if self.state == "half_open":
+            return not self.trial_in_flight
+        return self.state == "closed"
+
+    def acquire(self):
+        """Account for a request sent to the backend."""
+        self.outstanding += 1
+        if self.state == "half_open":
+            self.trial_in_flight = True
+
+    def release(self):
+        """Account for a request to the backend that finished."""
+        self.outstanding -= 1
+
+    def record(self, success: bool):
+        """Update the circuit breaker with the outcome of a request."""
+        self.trial_in_flight = False
+        if success:
+            self.failures = 0
+            self.state = "closed"
+            return
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= BACKEND_FAILURE_THRESHOLD:
+            self.open(f"{self.failures} consecutive failures")
+
+    def open(self, reason: str):
+        """Stop routing requests to the backend until it recovers."""
+        if self.state != "open":
+            log_event(
+                logging.WARNING, "Backend ejected", backend=self.url, reason=reason
+            )
+        self.state = "open"
+        self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        """Return the load and circuit breaker state of the backend."""
+        return {
+            "url": self.url,
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "consecutive_failures": self.failures,
+        }
+
+
+class BackendPool:
+    """
+    The backends requests are balanced over.
+
+    Requests go to the available backend with the least outstanding requests.
+    A request can be pinned to a backend, so all iterations of a tool loop
+    hit the same vLLM instance and its prefix cache.
+    """
+
+    def __init__(self, urls: list[str]):
+        self.backends = [Backend(url) for url in urls]
+        self.probed = False
+
+    def pick(
+        self, pinned: Backend | None = None, exclude: tuple[Backend, ...] = ()
+    ) -> Backend:
+        """Choose the backend for a request, preferring the pinned backend."""
+        now = time.monotonic()
+        if pinned is not None and pinned.available(now):
+            return pinned
+        candidates = [
+            backend
+            for backend in self.backends
+            if backend.available(now) and backend not in exclude
+        ]
+        if not candidates:
+            raise NoBackendAvailable("No backend available")
+        return min(candidates, key=lambda b: (b.outstanding, random.random()))
+
+    async def probe(self, client: httpx.AsyncClient):
+        """Check the /health endpoint of every backend concurrently."""
+
+        async def probe_backend(backend: Backend):
+            try:
+                response = await client.get(
+                    backend.health_url, timeout=BACKEND_HEALTH_TIMEOUT
+                )
+                healthy = response.status_code == 200
+            except httpx.HTTPError:
+                healthy = False
+            if not healthy:
+                backend.open("health check failed")
+            elif backend.state == "open":
+                # Let a real request confirm the recovery before closing
+                backend.state = "half_open"
+                backend.trial_in_flight = False
+
+        await asyncio.gather(*(probe_backend(b) for b in self.backends))
+        self.probed = True
+
+    def reachable(self) -> bool:
+        """Check whether the last health probe found a backend to route to."""
+        now = time.monotonic()
+        return self.probed and any(backend.available(now) for backend in self.backends)
+
+    def stats(self) -> list[dict]:
+        """Return the state of every backend."""
+        return [backend.stats() for backend in self.backends]
+
+
+backend_pool = BackendPool(LLAMA_BACKENDS)
+
+
+class BackendWarmup:
+    """
+    Primes the prefix cache of every backend when the proxy starts.
+
+    Sends each backend a one-token completion for the fixed system prompt
+    with the proxy's tool definitions, the prefix every request starts with,
+    so the first real requests find it in the vLLM prefix cache. Backends
+    that can not be reached yet are retried until WARMUP_TIMEOUT.
+    """
+
+    def __init__(self, enabled: bool):
+        self.state = "pending" if enabled else "disabled"
+        self.duration = None
+        self.error = None
+
+    def body(self) -> dict:
+        body = {
+            "messages": [
+                {"role": "system", "content": WARMUP_SYSTEM_PROMPT},
+                {"role": "user", "content": "Hi"},
+            ],
+            "max_tokens": 1,
+            "temperature": 0,
+        }
+        if WARMUP_MODEL:
+            body["model"] = WARMUP_MODEL
+        return body
+
+    async def warm(self, client: httpx.AsyncClient, backend: "Backend"):
+        """Send the warm-up request to a backend until it answers."""
+        content = encode_backend_body(self.body())
+        deadline = time.monotonic() + WARMUP_TIMEOUT
+        while True:
+            try:
+                response = await client.post(
+                    backend.url,
+                    content=content,
+                    headers={"Content-Type": "application/json"},
+                )
+                if response.status_code < 500:
+                    if response.status_code != 200:
+                        self.error = f"{backend.url} answered {response.status_code}"
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"{backend.url} could not be warmed up")
+            await asyncio.sleep(BACKEND_HEALTH_INTERVAL)
+
+    async def run(self, client: httpx.AsyncClient, pool: "BackendPool"):
+        """Warm up every backend of the pool concurrently."""
+        if self.state == "disabled":
+            return
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(self.warm(client, b) for b in pool.backends))
+            self.state = "done"
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+        self.duration = time.perf_counter() - started
+        log_event(
+            logging.INFO if self.state == "done" else logging.WARNING,
+            "Backend warm-up finished",
+            state=self.state,
+            duration_seconds=round(self.duration, 3),
+            error=self.error,
+        )
+
+    def finished(self) -> bool:
+        return self.state != "pending"
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "duration_seconds": (
+                round(self.duration, 3) if self.duration is not None else None
+            ),
+            "error": self.error,
+        }
+
+
+backend_warmup = BackendWarmup(BACKEND_WARMUP)
+
+
+class BackendSession:
+    """The backend a single client request is pinned to, chosen on first use."""
+
+    def __init__(self, pool: BackendPool):
+        self.pool = pool
+        self.backend: Backend | None = None
+
+
+class ReleasingStream(httpx.AsyncByteStream):
+    """Response stream that releases its backend when the stream is closed."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, backend: Backend):
+        self.stream = stream
+        self.backend = backend
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if self.backend is not None:
+                self.backend.release()
+                self.backend = None
+
+
+async def send_to_backend(
+    client: httpx.AsyncClient, session: BackendSession, body: dict, stream: bool
+) -> httpx.Response:
+    """
+    Send a chat completion request to the backend the session is pinned to.
+    Transport errors and 5xx responses count as failures of the backend.
+    When a backend can not be reached the request is retried on another one,
+    up to BACKEND_RETRIES times, and the session is pinned to that instead.
+    Errors after the request may have reached the backend, such as read
+    timeouts, are not retried, so a generation is never run twice.
+    Args:
+        client (httpx.AsyncClient): The shared, pooled client to send the request with.
+        session (BackendSession): The backend session of the client request.
+        body (dict): The request body to be sent as JSON to the backend service.
+        stream (bool): Whether to return as soon as the headers arrive.
+    Returns:
+        httpx.Response: The response of the backend; closing a streamed
+        response releases the backend.
+    Raises:
+        NoBackendAvailable: If no backend is available.
+        httpx.RequestError: If the last backend tried could not be reached, or
+            the request failed after it was sent.
+    """
+    content = encode_backend_body(body)
+    failed = ()
+    last_error = None
+    for attempt in range(BACKEND_RETRIES + 1):
+        try:
+            backend = session.pool.pick(session.backend, exclude=failed)
+        except NoBackendAvailable:
+            if last_error is not None:
+                # No other backend to retry on, report the original error
+                raise last_error from None
+            raise
+        backend.acquire()
+        started = time.perf_counter()
+        try:
+            backend_request = client.build_request(
+                "POST",
+                backend.url,
+                content=content,
+                headers={"Content-Type": "application/json"},
+            )
+            response = await client.send(backend_request, stream=stream)
+        except httpx.TransportError as e:
+            retryable = isinstance(e, BACKEND_RETRYABLE_ERRORS)
+            BACKEND_LATENCY.observe(
+                time.perf_counter() - started,
+                (backend.url, "unreachable" if retryable else "error"),
+            )
+            backend.release()
+            backend.record(False)
+            session.backend = None
+            if not retryable or attempt == BACKEND_RETRIES:
+                raise
+            failed += (backend,)
+            last_error = e
+            continue
+        except BaseException:
+            backend.release()
+            raise
+        success = response.status_code < 500
+        BACKEND_LATENCY.observe(
+            time.perf_counter() - started, (backend.url, "ok" if success else "error")
+        )
+        backend.record(success)
+        session.backend = backend
+        if stream:
+            response.stream = ReleasingStream(response.stream, backend)
+        else:
+            backend.release()
+        return response
+
+
+async def llama_request(
+    client: httpx.AsyncClient, session: BackendSession, body
+) -> BackendReply:
+    """
+    Make an asynchronous HTTP POST request to a Llama backend service.
+    Args:
+        client (httpx.AsyncClient): The shared, pooled client to send the request with.
+        session (BackendSession): The backend session of the client request.
+        body (dict): The request body to be sent as JSON to the backend service.
+    Returns:
+        BackendReply: The parsed response returned by the backend service.
+    Raises:
+        NoBackendAvailable: If no backend is available.
+        httpx.TimeoutException: If a connect, read, write or pool timeout is exceeded.
+        httpx.RequestError: If there is an error making the HTTP request.
+    """
+    llama_response = await send_to_backend(client, session, body, stream=False)
+    return parse_backend_reply(llama_response.status_code, llama_response.content)
+
+
+class ToolPolicy(NamedTuple):
+    """Compiled policy of one user for one tool."""
+
+    allowed: bool
+    allowed_files: re.Pattern | None
+    allowed_directories: re.Pattern | None
+
+
+def compile_globs(patterns: list[str] | None) -> re.Pattern | None:
+    """
+    Compile a list of glob patterns into a single regular expression.
+    Args:
+        patterns (list[str] | None): Glob patterns as found in a policy file.
+    Returns:
+        re.Pattern | None: A pattern matching any of the globs, or None if
+        the policy does not restrict the tool to specific paths.
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(str(p)) for p in patterns))
+
+
+def compile_user_policy(user_policy: dict | None) -> dict[str, ToolPolicy]:
+    """
+    Compile the tool section of a parsed user policy file.
+    Args:
+        user_policy (dict | None): The parsed YAML policy of a user.
+    Returns:
+        dict[str, ToolPolicy]: The compiled policy of each tool, keyed on tool name.
+    """
+    compiled = {}
+    for tool_name, tool_policy in ((user_policy or {}).get("tools") or {}).items():
+        tool_policy = tool_policy or {}
+        compiled[tool_name] = ToolPolicy(
+            allowed=bool(tool_policy.get("allowed", False)),
+            allowed_files=compile_globs(tool_policy.get("allowed_files")),
+            allowed_directories=compile_globs(tool_policy.get("allowed_directories")),
+        )
+    return compiled
+
+
+class ContentRule(NamedTuple):
+    """A deny rule of the content policy."""
+
+    name: str
+    message: str
+
+
+def keyword_trie_pattern(keywords: list[str]) -> str:
+    """
+    Build a regular expression matching any of the keywords.
+    Keywords are merged into a trie first, so keywords sharing a prefix share
+    the same branch of the expression instead of being tried one by one.
+    Args:
+        keywords (list[str]): The (lowercase) keywords to match.
+    Returns:
+        str: A regular expression matching any of the keywords.
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        branches = [
+            re.escape(char) + build(child) for char, child in node.items() if char
+        ]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        if "" in node:
+            pattern = f"(?:{pattern})?"
+        return pattern
+
+    return build(trie)
+
+
+def message_text(message: dict) -> str:
+    """
+    Return the text of a chat message.
+    Content can be a plain string or a list of OpenAI-style content parts,
+    in which case the text parts are joined. Other parts, such as images,
+    are skipped.
+    """
+    content = message.get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(
+            part.get("text") or ""
+            for part in content
+            if isinstance(part, dict) and part.get("type", "text") == "text"
+        )
+    return ""
+
+
+REGEX_QUANTIFIER = re.compile(r"\{\d*(?:,\d*)?\}")
+REGEX_INLINE_FLAGS = re.compile(r"\(\?[aiLmsux]+\)")
+
+
+def skip_regex_group(regex: str, index: int) -> int:
+    """Return the index after the group or character class starting at index."""
+    depth = 0
+    in_class = False
+    while index < len(regex):
+        char = regex[index]
+        if char == "\\":
+            index += 1
+        elif in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+            # A ] right after the opening bracket, or after ^, is a literal
+            if regex[index + 1 : index + 2] == "^":
+                index += 1
+            if regex[index + 1 : index + 2] == "]":
+                index += 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        index += 1
+        if depth == 0 and not in_class:
+            return index
+    return index
+
+
+def required_literal(regex: str) -> str | None:
+    """
+    Find a literal that every match of a regular expression must contain.
+    Only literals at the top level of the expression qualify, the longest run
+    of at least three characters is returned in lowercase. Used to prefilter
+    regex rules with the keyword matcher, so the expression itself only runs
+    on messages that contain the literal. The expression is scanned as text;
+    anything that is not a plain character, such as a group, a class or an
+    escape sequence, ends a run, and a top-level alternation or the verbose
+    flag gives no literal.
+    Args:
+        regex (str): The regular expression of a content rule.
+    Returns:
+        str | None: The required literal, or None if there is no usable one.
+    """
+    if any("x" in flags.group() for flags in REGEX_INLINE_FLAGS.finditer(regex)):
+        return None
+    runs, run = [], ""
+    index = 0
+    while index < len(regex):
+        char = regex[index]
+        quantifier = REGEX_QUANTIFIER.match(regex, index)
+        if char in "*+?" or quantifier:
+            # The repeated character may be optional, so it ends the run
+            runs.append(run[:-1])
+            run = ""
+            index = quantifier.end() if quantifier else index + 1
+            continue
+        if char == "|":
+            return None
+        if char in "([":
+            runs.append(run)
+            run = ""
+            index = skip_regex_group(regex, index)
+            continue
+        if char == "\\":
+            escaped = regex[index + 1 : index + 2]
+            if escaped and not escaped.isalnum():
+                run += escaped
+            else:
+                runs.append(run)
+                run = ""
+            index += 2
+            continue
+        if char in ".^$":
+            runs.append(run)
+            run = ""
+        else:
+            run += char
+        index += 1
+    runs.append(run)
+    longest = max(runs, key=len).lower()
+    return longest if len(longest) >= 3 else None
+
+
+class ContentScanner:
+    """
+    Compiled content policy checked against every message of a request.
+
+    Keywords, and the literals every match of a regex rule must contain, are
+    merged into a single Aho-Corasick automaton (or a trie-shaped regular
+    expression when pyahocorasick is not installed). Each message is scanned
+    once for all of them, regex rules only run when their literal is found,
+    and the scan stops at the first violation. Regex rules without a usable
+    literal are checked one by one. With only a few literals a plain substring
+    search per literal is cheaper than walking the automaton, so that is used
+    instead.
+    """
+
+    SMALL_RULE_SET = 4
+
+    def __init__(
+        self, rules: list[dict], max_content_length: int = DEFAULT_MAX_CONTENT_LENGTH
+    ):
+        self.max_content_length = max_content_length
+        self.rules: list[ContentRule] = []
+        self.regexes: dict[int, re.Pattern] = {}
+        literals: dict[str, list[int]] = {}
+        unfiltered: list[int] = []
+        for rule in rules:
+            index = len(self.rules)
+            name = rule.get("name") or f"rule-{index}"
+            if "keyword" in rule:
+                keyword = str(rule["keyword"]).lower()
+                default_message = (
+                    f"Policy violation: request contains sensitive keyword '{keyword}'."
+                )
+                literals.setdefault(keyword, []).append(index)
+            elif "regex" in rule:
+                default_message = f"Policy violation: request matches rule '{name}'."
+                self.regexes[index] = re.compile(rule["regex"], re.IGNORECASE)
+                literal = required_literal(rule["regex"])
+                if literal:
+                    literals.setdefault(literal, []).append(index)
+                else:
+                    unfiltered.append(index)
+            else:
+                raise ValueError(f"Content rule {name} needs a keyword or regex.")
+            self.rules.append(ContentRule(name, rule.get("message", default_message)))
+
+        self.literals = literals
+        self.unfiltered = unfiltered
+        self.automaton = None
+        self.literal_pattern = None
+        if len(literals) > self.SMALL_RULE_SET and ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for literal, indices in literals.items():
+                self.automaton.add_word(literal, indices)
+            self.automaton.make_automaton()
+        elif len(literals) > self.SMALL_RULE_SET:
+            self.literal_pattern = re.compile(keyword_trie_pattern(list(literals)))
+
+    @classmethod
+    def from_config(cls, config: dict | None) -> "ContentScanner":
+        """Create a scanner from the parsed content rules file."""
+        config = config or {}
+        return cls(
+            config.get("rules") or [],
+            int(config.get("max_content_length", DEFAULT_MAX_CONTENT_LENGTH)),
+        )
+
+    def literal_hits(self, lowered: str):
+        """Yield the rule indices of every literal found, in order of appearance."""
+        if self.automaton is not None:
+            for _, indices in self.automaton.iter(lowered):
+                yield indices
+        elif self.literal_pattern is not None:
+            for match in self.literal_pattern.finditer(lowered):
+                yield self.literals[match.group()]
+        else:
+            for literal, indices in self.literals.items():
+                if literal in lowered:
+                    yield indices
+
+    def scan(self, text: str) -> ContentRule | None:
+        """Return the first rule the text violates, or None if it is allowed."""
+        if len(text) > self.max_content_length:
+            return ContentRule(
+                "max-content-length", "Policy violation: input too long."
+            )
+        if self.literals:
+            checked = set()
+            for indices in self.literal_hits(text.lower()):
+                for index in indices:
+                    regex = self.regexes.get(index)
+                    if regex is None:
+                        return self.rules[index]
+                    if index not in checked:
+                        checked.add(index)
+                        if regex.search(text):
+                            return self.rules[index]
+        for index in self.unfiltered:
+            if self.regexes[index].search(text):
+                return self.rules[index]
+        return None
+
+
+class TenantLimits(NamedTuple):
+    """Compiled admission limits of a tenant."""
+
+    priority: int
+    requests_per_second: float | None
+    burst: float
+    max_concurrency: int | None
+
+
+def compile_tenant_limits(user_policy: dict | None) -> TenantLimits | None:
+    """
+    Compile the limits section of a parsed user policy file.
+    Args:
+        user_policy (dict | None): The parsed YAML policy of a user.
+    Returns:
+        TenantLimits | None: The compiled limits, or None if the policy has none.
+    """
+    limits = (user_policy or {}).get("limits")
+    if not limits:
+        return None
+    priority = limits.get("priority", "background")
+    if priority not in PRIORITY_CLASSES:
+        raise ValueError(f"Unknown priority class {priority}.")
+    rate = limits.get("requests_per_second")
+    if rate is not None and float(rate) <= 0:
+        raise ValueError(f"requests_per_second must be positive, got {rate}.")
+    concurrency = limits.get("max_concurrency")
+    return TenantLimits(
+        priority=PRIORITY_CLASSES[priority],
+        requests_per_second=float(rate) if rate is not None else None,
+        burst=float(limits.get("burst", max(1.0, float(rate or 1)))),
+        max_concurrency=int(concurrency) if concurrency is not None else None,
+    )
+
+
+class PolicyStore:
+    """
+    In-memory lookup table of all user policies.
+
+    The policy files in the policies directory are parsed once and compiled
+    into a table keyed on (user, tool), together with the admission limits of
+    each user. Users without a policy file fall back to the policy in
+    defaults.yml. The content rules applied to every request are compiled
+    into a ContentScanner alongside them. The table is rebuilt when the
+    modification time of any policy file changes, and swapped in as a whole
+    so lookups never see a half-loaded state.
+    """
+
+    def __init__(self, policies_dir: str, content_rules_file: str):
+        self.policies_dir = policies_dir
+        self.content_rules_file = content_rules_file
+        self.users: frozenset[str] = frozenset()
+        self.tool_policies: dict[tuple[str, str], ToolPolicy] = {}
+        self.tenant_limits: dict[str, TenantLimits] = {}
+        self.content_scanner = ContentScanner([])
+        self.mtimes: dict[str, int] = {}
+        self.loaded = False
+
+    def scan(self) -> dict[str, int]:
+        """Return the modification time of every policy file, keyed on path."""
+        paths = sorted(glob.glob(os.path.join(self.policies_dir, "*.yml")))
+        if os.path.isfile(self.content_rules_file):
+            paths.append(self.content_rules_file)
+        return {path: os.stat(path).st_mtime_ns for path in paths}
+
+    def load(self):
+        """Parse and compile all policy files, replacing the current table."""
+        mtimes = self.scan()
+        users = set()
+        tool_policies = {}
+        tenant_limits = {}
+        content_scanner = ContentScanner([])
+        for path in mtimes:
+            with open(path, "r") as file:
+                policy = yaml.safe_load(file)
+            if path == self.content_rules_file:
+                content_scanner = ContentScanner.from_config(policy)
+                continue
+            user_id = os.path.splitext(os.path.basename(path))[0]
+            for tool_name, tool_policy in compile_user_policy(policy).items():
+                tool_policies[(user_id, tool_name)] = tool_policy
+            limits = compile_tenant_limits(policy)
+            if limits is not None:
+                tenant_limits[user_id] = limits
+            users.add(user_id)
+
+        self.users, self.tool_policies = frozenset(users), tool_policies
+        self.tenant_limits = tenant_limits
+        self.content_scanner = content_scanner
+        self.mtimes = mtimes
+        self.loaded = True
+        log_event(logging.INFO, "Loaded policies", users=sorted(users))
+
+    def reload_if_changed(self) -> bool:
+        """Reload the policies if a file was added, removed or modified."""
+        if self.scan() == self.mtimes:
+            return False
+        self.load()
+        return True
+
+    def lookup(self, user_id: str, tool_name: str) -> ToolPolicy | None:
+        """Return the compiled policy of a user for a tool, if there is one."""
+        if user_id not in self.users:
+            user_id = DEFAULT_POLICY_USER
+        return self.tool_policies.get((user_id, tool_name))
+
+    def tenant(self, user_id: str) -> str:
+        """Return the policy a user falls under: their own or the defaults."""
+        return user_id if user_id in self.users else DEFAULT_POLICY_USER
+
+    def limits(self, tenant: str) -> "TenantLimits | None":
+        """Return the admission limits of a tenant, falling back to the defaults."""
+        limits = self.tenant_limits.get(tenant)
+        if limits is None:
+            limits = self.tenant_limits.get(DEFAULT_POLICY_USER)
+        return limits
+
+
+policy_store = PolicyStore(POLICIES_DIR, CONTENT_RULES_FILE)
+
+
+def path_allowed(pattern: re.Pattern | None, path: str) -> bool:
+    """Check a path relative to the test data directory against a compiled glob."""
+    path = os.path.normpath(path)
+    if os.path.isabs(path) or path.startswith(".."):
+        return False
+    return pattern is None or pattern.match(path) is not None
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is over its tenant's limits."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket refilled at a fixed rate, holding at most burst tokens."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token, returning 0 or the seconds until a token is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionTicket:
+    """An admitted request, holding its concurrency slot until released."""
+
+    def __init__(self, controller: "AdmissionController", tenant: str, waited: float):
+        self.controller = controller
+        self.tenant = tenant
+        self.waited = waited
+        self.released = False
+
+    def release(self):
+        """Give the slot back, at most once."""
+        if not self.released:
+            self.released = True
+            self.controller.release(self.tenant)
+
+
+class AdmissionController:
+    """
+    Per-tenant rate limiting and concurrency control in front of the backends.
+
+    Every tenant has a token bucket for its request rate and a limit on its
+    concurrent requests, and all tenants together are limited to
+    PROXY_MAX_CONCURRENCY. Requests over the rate are rejected immediately.
+    Requests without a free slot wait in a bounded queue, where higher
+    priority classes are admitted first, and are rejected when the queue is
+    full or they waited too long. Every tenant with queued requests gets an
+    equal share of the queue, so a tenant waiting on its own concurrency
+    limit cannot fill it for the others.
+    """
+
+    def __init__(self, max_concurrency: int, queue_size: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.tenant_active: dict[str, int] = {}
+        self.buckets: dict[str, TokenBucket] = {}
+        self.waiters: list[tuple[int, int, str, TenantLimits, asyncio.Future]] = []
+        self.tenant_waiting: dict[str, int] = {}
+        self.sequence = 0
+        self.rejected = 0
+
+    def has_slot(self, tenant: str, limits: TenantLimits | None) -> bool:
+        """Check whether a request of the tenant may start right now."""
+        if self.active >= self.max_concurrency:
+            return False
+        if limits is None or limits.max_concurrency is None:
+            return True
+        return self.tenant_active.get(tenant, 0) < limits.max_concurrency
+
+    def waiter_could_start(self, priority: int) -> bool:
+        """Check whether a waiting request of at least this priority has a slot."""
+        return any(
+            waiter[0] <= priority and self.has_slot(waiter[2], waiter[3])
+            for waiter in self.waiters
+        )
+
+    def queue_full(self, tenant: str) -> bool:
+        """Check whether the tenant has used up its share of the queue."""
+        tenants = len(self.tenant_waiting) + (tenant not in self.tenant_waiting)
+        share = max(1, self.queue_size // tenants)
+        return self.tenant_waiting.get(tenant, 0) >= share
+
+    def remove_waiter(self, waiter: tuple):
+        """Take a request out of the queue."""
+        self.waiters.remove(waiter)
+        tenant = waiter[2]
+        self.tenant_waiting[tenant] -= 1
+        if not self.tenant_waiting[tenant]:
+            del self.tenant_waiting[tenant]
+
+    def start(self, tenant: str):
+        """Take a slot for a request of the tenant."""
+        self.active += 1
+        self.tenant_active[tenant] = self.tenant_active.get(tenant, 0) + 1
+
+    def check_rate(self, tenant: str, limits: TenantLimits | None):
+        """Take a token from the tenant's bucket, rejecting the request if empty."""
+        if limits is None or limits.requests_per_second is None:
+            return
+        bucket = self.buckets.get(tenant)
+        if bucket is None or (bucket.rate, bucket.burst) != (
+            limits.requests_per_second,
+            limits.burst,
+        ):
+            bucket = TokenBucket(limits.requests_per_second, limits.burst)
+            self.buckets[tenant] = bucket
+        wait = bucket.take()
+        if wait > 0:
+            self.rejected += 1
+            raise AdmissionRejected("Rate limit exceeded.", wait)
+
+    async def admit(self, tenant: str, limits: TenantLimits | None) -> AdmissionTicket:
+        """
+        Admit a request of a tenant, waiting for a slot if needed.
+        Args:
+            tenant (str): The tenant the request is counted against.
+            limits (TenantLimits | None): The limits of the tenant, None for unlimited.
+        Returns:
+            AdmissionTicket: The ticket to release when the request is done.
+        Raises:
+            AdmissionRejected: If the request is over the limits of the tenant.
+        """
+        self.check_rate(tenant, limits)
+        priority = limits.priority if limits is not None else PRIORITY_CLASSES["batch"]
+        if self.has_slot(tenant, limits) and not self.waiter_could_start(priority):
+            self.start(tenant)
+            return AdmissionTicket(self, tenant, 0.0)
+        if self.queue_full(tenant):
+            self.rejected += 1
+            raise AdmissionRejected("Too many requests queued.", 1.0)
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self.sequence += 1
+        waiter = (priority, self.sequence, tenant, limits, future)
+        self.waiters.append(waiter)
+        self.tenant_waiting[tenant] = self.tenant_waiting.get(tenant, 0) + 1
+        self.dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except BaseException as e:
+            if waiter in self.waiters:
+                self.remove_waiter(waiter)
+            if future.done() and not future.cancelled():
+                # The slot was granted just as the request gave up on it
+                self.release(tenant)
+            else:
+                future.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise AdmissionRejected(
+                    "Timed out waiting for a free slot.", 1.0
+                ) from None
+            raise
+        return AdmissionTicket(self, tenant, time.monotonic() - started)
+
+    def dispatch(self):
+        """Start waiting requests, highest priority first, while slots are free."""
+        for waiter in sorted(self.waiters):
+            _, _, tenant, limits, future = waiter
+            if self.active >= self.max_concurrency:
+                return
+            if not self.has_slot(tenant, limits):
+                continue
+            self.remove_waiter(waiter)
+            self.start(tenant)
+            future.set_result(True)
+
+    def release(self, tenant: str):
+        """Free the slot of a finished request and admit the next waiting one."""
+        self.active -= 1
+        self.tenant_active[tenant] -= 1
+        self.dispatch()
+
+    def stats(self) -> dict:
+        """Return the number of active, queued and rejected requests."""
+        return {
+            "active": self.active,
+            "queued": len(self.waiters),
+            "rejected": self.rejected,
+            "tenants": dict(self.tenant_active),
+        }
+
+
+admission_controller = AdmissionController(
+    PROXY_MAX_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT
+)
+
+
+def enforce_user_policy(
+    user_id: str, tool_name, arguments: dict | None = None
+) -> tuple[bool, str]:
+    """
+        Enforce user-specific policies for tool usage.
+
+    This function checks if a specified tool is allowed for a given user based on
+    the compiled policy store. Users without a policy of their own get the policy
+    in `defaults.yml`. File and directory arguments are checked against the
+    `allowed_files` and `allowed_directories` globs of the tool.
+
+    Args:
+        user_id (str): The unique identifier for the user whose policy is being enforced.
+        tool_name (str): The name of the tool for which access is being checked.
+        arguments (dict | None): The arguments the tool is called with.
+
+    Returns:
+        tuple[bool, str]: A tuple containing:
+            - allowed (bool): Indicates whether the tool is allowed for the user.
+            - message (str): A message explaining the result; if not allowed, it specifies the reason.
+    """
+    tool_policy = policy_store.lookup(user_id, tool_name)
+    if tool_policy is None:
+        log_event(
+            logging.INFO,
+            "Tool not found in user policy",
+            tool=tool_name,
+            tenant=policy_store.tenant(user_id),
+        )
+        return False, "Tool not allowed by user policy."
+    if not tool_policy.allowed:
+        return False, "Tool not allowed by user policy."
+
+    if tool_name == "file_content":
+        file_name = str((arguments or {}).get("file_name", ""))
+        if not path_allowed(tool_policy.allowed_files, file_name):
+            return False, "File not allowed by user policy."
+    if tool_name == "list_directory":
+        directory = os.path.basename(os.path.normpath(TEST_DATA_DIR))
+        if not path_allowed(tool_policy.allowed_directories, directory):
+            return False, "Directory not allowed by user policy."
+
+    return True, None
+
+
+def enforce_tenant_policy(payload: dict) -> tuple[bool, str]:
+    """
+    Apply inline policy enforcement on the request.
+    Every message is scanned once against the compiled content rules,
+    stopping at the first violation.
+    Return (allowed: bool, message: str)
+    """
+    scanner = policy_store.content_scanner
+    for msg in payload.get("messages", []):
+        rule = scanner.scan(message_text(msg))
+        if rule is not None:
+            return False, rule.message
+    return True, "Allowed"
+
+
+def estimate_tokens(message: dict) -> int:
+    """
+    Estimate the number of prompt tokens of a chat message.
+    Counts about four characters per token plus the framing of the message;
+    cheap enough to run on every tool loop iteration, and close enough to
+    keep a safety margin below the context window.
+    """
+    content = message.get("content")
+    if isinstance(content, str):
+        chars = len(content)
+    elif content:
+        chars = len(json_dumps(content))
+    else:
+        chars = 0
+    for tool_call in message.get("tool_calls") or ():
+        function = tool_call.get("function") or {}
+        chars += len(function.get("name") or "") + len(function.get("arguments") or "")
+    return chars // CHARS_PER_TOKEN + MESSAGE_TOKEN_OVERHEAD
+
+
+# The tool definitions are sent with every backend call
+TOOLS_TOKENS = len(TOOLS_JSON) // CHARS_PER_TOKEN
+
+
+def cap_tool_result(result):
+    """Truncate a tool result longer than TOOL_RESULT_MAX_TOKENS."""
+    max_chars = TOOL_RESULT_MAX_TOKENS * CHARS_PER_TOKEN
+    if not isinstance(result, str) or len(result) <= max_chars:
+        return result
+    COMPACTIONS.inc(("truncated",))
+    omitted = len(result) - max_chars
+    return f"{result[:max_chars]}\n[... {omitted} characters truncated]"
+
+
+def duplicate_reference(tool_call_id: str) -> str:
+    """The content replacing a tool result that repeats the one of tool_call_id."""
+    return f"[Same result as tool call {tool_call_id}, see above.]"
+
+
+def deduplicate_tool_results(messages: list[dict], new_count: int):
+    """
+    Replace new tool results that repeat an earlier result of the same tool,
+    such as a file read twice with file_content, by a reference to it.
+    The later copy is replaced, so the messages before it stay unchanged.
+    """
+    seen = {}
+    first_new = len(messages) - new_count
+    for index, message in enumerate(messages):
+        content = message.get("content")
+        if (
+            message.get("role") != "tool"
+            or not isinstance(content, str)
+            or len(content) < DEDUPLICATE_MIN_CHARS
+        ):
+            continue
+        key = (message.get("name"), content)
+        if key not in seen:
+            seen[key] = message.get("tool_call_id")
+        elif index >= first_new:
+            COMPACTIONS.inc(("deduplicated",))
+            message["content"] = duplicate_reference(seen[key])
+
+
+def enforce_token_budget(messages: list[dict], budget: int = CONTEXT_TOKEN_BUDGET):
+    """
+    Elide the oldest tool results until the prompt fits the token budget.
+    System and user messages and the tool definitions are never changed, so
+    the prefix the backend has cached stays byte-identical, and the results
+    of the latest tool calls are elided last. When an elided result was
+    referenced by a later duplicate, its content moves to that duplicate
+    instead of being lost.
+    """
+    total = TOOLS_TOKENS + sum(estimate_tokens(message) for message in messages)
+    for index, message in enumerate(messages):
+        if total <= budget:
+            return
+        content = message.get("content")
+        if message.get("role") != "tool" or (
+            isinstance(content, str) and content.startswith(ELIDED_PREFIX)
+        ):
+            continue
+        before = estimate_tokens(message)
+        message["content"] = (
+            f"{ELIDED_PREFIX} to fit the context window, it was about "
+            f"{before - MESSAGE_TOKEN_OVERHEAD} tokens.]"
+        )
+        COMPACTIONS.inc(("elided",))
+        total -= before - estimate_tokens(message)
+        total += restore_duplicates(messages, index, content)
+    if total > budget:
+        log_event(
+            logging.WARNING,
+            "Prompt over the token budget after compaction",
+            estimated_tokens=total,
+            budget=budget,
+        )
+
+
+def restore_duplicates(messages: list[dict], index: int, content) -> int:
+    """
+    Move the content of an elided tool result into its first later duplicate.
+    The other duplicates are pointed at that message instead.
+    Args:
+        messages (list[dict]): The messages of the request, changed in place.
+        index (int): The index of the elided tool result.
+        content: The content of the tool result before it was elided.
+    Returns:
+        int: The estimated tokens added to the prompt.
+    """
+    reference = duplicate_reference(messages[index].get("tool_call_id"))
+    added = 0
+    holder = None
+    for message in messages[index + 1 :]:
+        if message.get("role") != "tool" or message.get("content") != reference:
+            continue
+        before = estimate_tokens(message)
+        if holder is None:
+            holder = message
+            message["content"] = content
+        else:
+            message["content"] = duplicate_reference(holder.get("tool_call_id"))
+        added += estimate_tokens(message) - before
+    return added
+
+
+def compact_messages(messages: list[dict], new_count: int):
+    """
+    Keep the prompt of the tool loop within the context window.
+    Run after the results of a tool round were appended: repeated results are
+    deduplicated, then the oldest tool results are elided while the prompt is
+    over CONTEXT_TOKEN_BUDGET. Single results are capped when they are added.
+    Args:
+        messages (list[dict]): The messages of the request, compacted in place.
+        new_count (int): The number of tool results just appended.
+    """
+    deduplicate_tool_results(messages, new_count)
+    enforce_token_budget(messages)
+
+
+tool_executor = ThreadPoolExecutor(
+    max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool"
+)
+
+
+async def run_tool(
+    name: str, arguments: dict, tool_policy: ToolPolicy | None = None
+) -> str:
+    """
+    Run a single tool and return its result.
+    Tools doing blocking I/O run on the tool thread pool so they do not stall
+    the event loop, and every tool is bounded by TOOL_TIMEOUT. Failures are
+    returned as the tool result so the model can respond to them.
+    Args:
+        name (str): The name of the tool in the tool registry.
+        arguments (dict): The parsed arguments of the tool call.
+        tool_policy (ToolPolicy | None): The policy of the user for the tool,
+            passed to the tools in POLICY_SCOPED_TOOLS.
+    Returns:
+        str: The result of the tool, or a description of why it failed.
+    """
+    tool = TOOL_REGISTRY[name]
+    args = (arguments,) if arguments else ()
+    if name in POLICY_SCOPED_TOOLS:
+        args = (arguments or {}, tool_policy)
+    started = time.perf_counter()
+    try:
+        if name in BLOCKING_TOOLS:
+            loop = asyncio.get_running_loop()
+            call = loop.run_in_executor(tool_executor, tool, *args)
+            return await asyncio.wait_for(call, TOOL_TIMEOUT)
+        return tool(*args)
+    except asyncio.TimeoutError:
+        log_event(logging.WARNING, "Tool timed out", tool=name, timeout=TOOL_TIMEOUT)
+        return f"Tool {name} timed out."
+    except Exception as e:
+        log_event(logging.ERROR, "Error executing tool", tool=name, error=str(e))
+        return f"Tool {name} failed: {str(e)}"
+    finally:
+        TOOL_LATENCY.observe(time.perf_counter() - started, (name,))
+
+
+async def execute_tool_calls(
+    user_id: str, tools_called: list[dict], message: dict, body: dict
+) -> tuple[bool, str]:
+    """
+    Execute the tool calls of an assistant message and record the results.
+    All tool calls are checked against the user policy before any of them is
+    executed, the allowed calls then run concurrently. The assistant message
+    is appended to the messages of the request body once, followed by the
+    tool results in the order of the tool calls, ready to be sent back to the
+    backend. The messages are then compacted to fit the context window.
+    Args:
+        user_id (str): The user the tools are executed for.
+        tools_called (list[dict]): The matched tool calls, as returned by tools_matched.
+        message (dict): The assistant message containing the tool calls.
+        body (dict): The request body of which the messages are updated in place.
+    Returns:
+        tuple[bool, str]: Whether all tools were allowed, and the reason if not.
+    """
+    tenant = policy_store.tenant(user_id)
+    calls = []
+    for tool_call in tools_called:
+        function = tool_call["function"]
+        log_event(logging.INFO, "Tool called", tool=function["name"], tenant=tenant)
+        arguments = json.loads(function["arguments"] or "{}")
+        allowed, reason = enforce_user_policy(user_id, function["name"], arguments)
+        if not allowed:
+            POLICY_DENIALS.inc(("tool",))
+            return False, reason
+        tool_policy = policy_store.lookup(user_id, function["name"])
+        calls.append((tool_call.get("id"), function["name"], arguments, tool_policy))
+
+    results = await asyncio.gather(
+        *(run_tool(name, arguments, policy) for _, name, arguments, policy in calls)
+    )
+
+    body["messages"].append(message)
+    for (tool_call_id, name, _, _), result in zip(calls, results):
+        body["messages"].append(
+            {
+                "role": "tool",
+                "tool_call_id": tool_call_id,
+                "name": name,
+                "content": cap_tool_result(result),
+            }
+        )
+    compact_messages(body["messages"], len(calls))
+    return True, None
+
+
+async def open_llama_stream(
+    client: httpx.AsyncClient, session: BackendSession, body
+) -> httpx.Response:
+    """
+    Send a streaming chat completion request to the Llama backend.
+    The response is returned as soon as the headers arrive, the server-sent
+    events are read from it afterwards. The caller is responsible for closing it.
+    Args:
+        client (httpx.AsyncClient): The shared, pooled client to send the request with.
+        session (BackendSession): The backend session of the client request.
+        body (dict): The request body, with "stream" set to true.
+    Returns:
+        httpx.Response: The open, streaming HTTP response of the backend service.
+    """
+    return await send_to_backend(client, session, body, stream=True)
+
+
+def accumulate_tool_call_deltas(pending: dict[int, dict], deltas: list[dict]):
+    """
+    Build up streamed tool calls from their deltas.
+    The first delta of a tool call carries its id and function name, later
+    deltas carry pieces of the JSON arguments which are concatenated.
+    Args:
+        pending (dict[int, dict]): Tool calls built so far, keyed on their index.
+        deltas (list[dict]): The "tool_calls" list of a streamed delta.
+    """
+    for delta in deltas:
+        tool_call = pending.setdefault(
+            delta.get("index", 0),
+            {"id": None, "type": "function", "function": {"name": "", "arguments": ""}},
+        )
+        if delta.get("id"):
+            tool_call["id"] = delta["id"]
+        function = delta.get("function") or {}
+        tool_call["function"]["name"] += function.get("name") or ""
+        tool_call["function"]["arguments"] += function.get("arguments") or ""
+
+
+def sse_event(payload) -> str:
+    """Format a payload as a server-sent event data line."""
+    if not isinstance(payload, str):
+        payload = json.dumps(payload)
+    return f"data: {payload}\n\n"
+
+
+async def stream_chat_completions(
+    client: httpx.AsyncClient,
+    session: BackendSession,
+    llama_response: httpx.Response,
+    user_id: str,
+    body,
+):
+    """
+    Relay a streamed chat completion from the backend to the client.
+    Content deltas are forwarded as soon as they arrive. Tool call deltas are
+    held back and built up, once the backend finishes its turn the tools are
+    executed and the follow-up completion is streamed in the same response.
+    Args:
+        client (httpx.AsyncClient): The shared, pooled client for follow-up requests.
+        session (BackendSession): The backend session of the client request.
+        llama_response (httpx.Response): The open streaming response of the first request.
+        user_id (str): The user the tools are executed for.
+        body (dict): The request body, updated with tool results between turns.
+    Yields:
+        str: Server-sent events for the client.
+    """
+    tenant = policy_store.tenant(user_id)
+    iterations = 0
+    try:
+        while True:
+            content = ""
+            pending = {}
+            try:
+                async for line in llama_response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:") :].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json_loads(data)
+                    record_usage(tenant, chunk.get("usage"))
+                    choices = chunk.get("choices") or [{}]
+                    delta = choices[0].get("delta") or {}
+                    if delta.get("tool_calls"):
+                        accumulate_tool_call_deltas(pending, delta["tool_calls"])
+                        continue
+                    if pending and choices[0].get("finish_reason"):
+                        # The turn ends in a tool call, the client keeps waiting
+                        continue
+                    content += delta.get("content") or ""
+                    yield sse_event(data)
+            finally:
+                await llama_response.aclose()
+
+            if not pending:
+                break
+            message = {
+                "role": "assistant",
+                "content": content or None,
+                "tool_calls": [pending[index] for index in sorted(pending)],
+            }
+            tools_called = tools_matched(message)
+            if not tools_called:
+                break
+            iterations += 1
+            allowed, reason = await execute_tool_calls(
+                user_id, tools_called, message, body
+            )
+            if not allowed:
+                yield sse_event({"error": f"Forbidden + {reason}"})
+                break
+            llama_response = await open_llama_stream(client, session, body)
+            if llama_response.status_code != 200:
+                error = await llama_response.aread()
+                await llama_response.aclose()
+                yield sse_event({"error": error.decode("utf-8", "replace")})
+                break
+    except Exception as e:
+        log_event(logging.ERROR, "Error during streamed tool execution", error=str(e))
+        yield sse_event({"error": "Server error"})
+    finally:
+        TOOL_LOOP_DEPTH.observe(iterations, ("stream",))
+    yield sse_event("[DONE]")
+
+
+def canonical_request_hash(tenant: str, body: dict) -> str:
+    """
+    Hash a chat completion request into a stable key.
+    The hash covers the tenant and every request field that influences the
+    response: model, messages, the injected tools and the sampling parameters.
+    Keys are serialized sorted and without whitespace, so requests that only
+    differ in field order or formatting get the same hash.
+    Args:
+        tenant (str): The tenant the request is made for.
+        body (dict): The request body, without the tools the proxy injects.
+    Returns:
+        str: The hex SHA-256 digest of the canonical request.
+    """
+    canonical = {k: v for k, v in body.items() if k not in UNCACHED_REQUEST_FIELDS}
+    if orjson is not None:
+        serialized = orjson.dumps([tenant, canonical], option=orjson.OPT_SORT_KEYS)
+    else:
+        serialized = json.dumps(
+            [tenant, canonical],
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+        ).encode("utf-8")
+    digest = hashlib.sha256(serialized)
+    digest.update(TOOLS_JSON)
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    Cache of final chat completion responses with TTL and LRU eviction.
+
+    Entries live in memory, bounded by max_entries, and optionally in a
+    directory on disk so they survive restarts. Keys include the tenant, and
+    on disk every tenant gets its own subdirectory, so cached answers are
+    never served to another tenant. The disk is swept every sweep_interval
+    seconds, and after max_disk_entries / 10 writes, removing the expired
+    entries and the oldest ones beyond max_disk_entries.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: float,
+        directory: str | None = None,
+        max_disk_entries: int = 10000,
+        sweep_interval: float = 60,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self.sweep_interval = sweep_interval
+        self.entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_entries = 0
+        self.writes_since_sweep = 0
+        self.next_sweep = 0.0
+        self.sweeping = False
+
+    def path(self, tenant: str, key: str) -> str:
+        """Return the on-disk location of an entry."""
+        tenant_dir = hashlib.sha256(tenant.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.directory, tenant_dir, f"{key}.json")
+
+    def read_disk(self, path: str) -> tuple[float, bytes] | None:
+        """Read an entry from disk, removing it when it has expired."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry["expires_at"] <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry["expires_at"], entry["content"].encode("utf-8")
+
+    def write_disk(self, path: str, expires_at: float, content: bytes):
+        """Write an entry to disk atomically."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"expires_at": expires_at, "content": content.decode("utf-8")}, f)
+        os.replace(tmp_path, path)
+
+    def sweep_disk(self) -> int:
+        """
+        Remove the expired entries from disk, and the oldest ones beyond
+        max_disk_entries. An entry expires ttl seconds after it was written,
+        so its modification time tells its age without reading it.
+        Returns:
+            int: The number of files removed.
+        """
+        now = time.time()
+        entries = []
+        try:
+            tenant_dirs = [
+                entry.path for entry in os.scandir(self.directory) if entry.is_dir()
+            ]
+        except OSError:
+            return 0
+        for tenant_dir in tenant_dirs:
+            try:
+                with os.scandir(tenant_dir) as files:
+                    for file in files:
+                        entries.append((file.stat().st_mtime, file.path))
+            except OSError:
+                continue
+        entries.sort()
+        # Temporary files are only removed once expired, they may be in use
+        stale = [path for mtime, path in entries if mtime + self.ttl <= now]
+        live = [
+            path
+            for mtime, path in entries
+            if mtime + self.ttl > now and path.endswith(".json")
+        ]
+        excess = live[: max(0, len(live) - self.max_disk_entries)]
+        removed = 0
+        for path in stale + excess:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        self.disk_entries = len(live) - len(excess)
+        return removed
+
+    async def maybe_sweep_disk(self):
+        """Sweep the disk when the interval passed or enough entries were written."""
+        if self.sweeping or (
+            time.monotonic() < self.next_sweep
+            and self.writes_since_sweep < max(1, self.max_disk_entries // 10)
+        ):
+            return
+        self.sweeping = True
+        self.writes_since_sweep = 0
+        self.next_sweep = time.monotonic() + self.sweep_interval
+        try:
+            removed = await asyncio.to_thread(self.sweep_disk)
+        finally:
+            self.sweeping = False
+        if removed:
+            log_event(
+                logging.INFO,
+                "Swept response cache",
+                removed=removed,
+                entries=self.disk_entries,
+            )
+
+    def remember(self, key: str, expires_at: float, content: bytes):
+        """Store an entry in memory, evicting the least recently used ones."""
+        self.entries[key] = (expires_at, content)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get(self, tenant: str, key: str) -> bytes | None:
+        """Return the cached response content, or None on a miss."""
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.entries.pop(key, None)
+        if self.directory:
+            entry = await asyncio.to_thread(self.read_disk, self.path(tenant, key))
+            if entry is not None:
+                self.remember(key, *entry)
+                self.disk_hits += 1
+                return entry[1]
+        self.misses += 1
+        return None
+
+    async def put(self, tenant: str, key: str, content: bytes):
+        """Cache the content of a final response."""
+        expires_at = time.time() + self.ttl
+        self.remember(key, expires_at, content)
+        if self.directory:
+            try:
+                await asyncio.to_thread(
+                    self.write_disk, self.path(tenant, key), expires_at, content
+                )
+            except (OSError, UnicodeDecodeError) as e:
+                log_event(
+                    logging.WARNING, "Error writing response cache entry", error=str(e)
+                )
+            else:
+                self.writes_since_sweep += 1
+            await self.maybe_sweep_disk()
+
+    def stats(self) -> dict:
+        """Return the hit and miss counters and the number of entries."""
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "disk_entries": self.disk_entries,
+            "max_disk_entries": self.max_disk_entries,
+        }
+
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_DIR,
+    RESPONSE_CACHE_DISK_MAX_ENTRIES,
+    RESPONSE_CACHE_SWEEP_INTERVAL,
+)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent executions of identical requests.
+
+    The first request for a key starts the execution as a separate task, and
+    requests with the same key that arrive while it runs wait for that task
+    instead of starting their own. All of them get its result, or its
+    exception. A request that is cancelled, for example because its client
+    disconnected, stops waiting without cancelling the execution for the
+    others; only when every waiter is gone is the execution cancelled.
+    """
+
+    def __init__(self):
+        self.calls: dict[str, asyncio.Task] = {}
+        self.waiters: dict[str, int] = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    def forget(self, key: str, task: asyncio.Task):
+        """Remove a finished execution, so later requests start a new one."""
+        if self.calls.get(key) is task:
+            del self.calls[key]
+            del self.waiters[key]
+
+    async def do(self, key: str, execute):
+        """
+        Return the result of execute for a key, shared with concurrent callers.
+        Args:
+            key (str): The key identifying identical requests.
+            execute (Callable[[], Awaitable]): Starts the execution of the request.
+        Returns:
+            object: The result of the shared execution.
+        """
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.create_task(execute())
+            self.calls[key] = task
+            self.waiters[key] = 0
+            task.add_done_callback(lambda done: self.forget(key, done))
+            self.executions += 1
+        else:
+            self.coalesced += 1
+        self.waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if self.calls.get(key) is task:
+                self.waiters[key] -= 1
+                if self.waiters[key] == 0 and not task.done():
+                    self.forget(key, task)
+                    task.cancel()
+
+    def stats(self) -> dict:
+        """Return the number of executions and of requests that joined one."""
+        return {
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "in_flight": len(self.calls),
+        }
+
+
+single_flight = SingleFlight()
+
+
+def response_cache_opted_in(request: Request) -> bool:
+    """Check whether the client set the x-response-cache header to "allow"."""
+    return request.headers.get(RESPONSE_CACHE_HEADER, "").lower() == "allow"
+
+
+def response_cache_eligible(body: dict, opted_in: bool) -> bool:
+    """
+    Check whether a request may be answered from the response cache.
+    Only buffered requests are eligible, and only deterministic ones: either
+    the temperature is 0, or the client opted in with the x-response-cache
+    header set to "allow".
+    """
+    if not RESPONSE_CACHE_ENABLED or body.get("stream"):
+        return False
+    return opted_in or body.get("temperature") == 0
+
+
+async def complete_chat_completion(
+    client: httpx.AsyncClient, session: BackendSession, user_id: str, body: dict
+) -> tuple[Response, bool]:
+    """
+    Run a buffered chat completion, including the tool loop.
+    Args:
+        client (httpx.AsyncClient): The shared, pooled client for backend requests.
+        session (BackendSession): The backend session of the client request.
+        user_id (str): The user the tools are executed for.
+        body (dict): The request body, updated with tool results between turns.
+    Returns:
+        tuple[Response, bool]: The response for the client, and whether it is a
+        final answer of the backend that may be cached.
+    """
+    tenant = policy_store.tenant(user_id)
+    # Forward to actual LLaMA backend
+    reply = await llama_request(client, session, body)
+    record_usage(tenant, reply.usage)
+
+    iterations = 0
+    try:
+        while reply.tool_calls:
+            iterations += 1
+            allowed, reason = await execute_tool_calls(
+                user_id, reply.tool_calls, reply.message, body
+            )
+            if not allowed:
+                response = JSONResponse(
+                    status_code=403, content=f"Forbidden + {reason}"
+                )
+                return response, False
+            log_debug_payload("Updated body with tool results", body)
+            reply = await llama_request(client, session, body)
+            record_usage(tenant, reply.usage)
+    except Exception as e:
+        log_event(logging.ERROR, "Error during tool execution", error=str(e))
+    finally:
+        TOOL_LOOP_DEPTH.observe(iterations, ("buffered",))
+
+    final = (
+        reply.status_code == 200
+        and bool(reply.message)
+        and not reply.message.get("tool_calls")
+    )
+    response = Response(
+        content=reply.content,
+        status_code=reply.status_code,
+        media_type="application/json",
+    )
+    return response, final
+
+
+async def release_when_done(events, ticket: AdmissionTicket):
+    """Relay a stream of events, releasing the admission ticket when it ends."""
+    try:
+        async for event in events:
+            yield event
+    finally:
+        ticket.release()
+
+
+def set_request_context(request: Request):
+    """Set the correlation ID and debug sampling of the request being handled."""
+    request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+    request_id_var.set(request_id[:64])
+    debug_sampled_var.set(random.random() < LOG_DEBUG_SAMPLE_RATE)
+
+
+def observe_request(started: float, mode: str, status_code: int):
+    """Record the latency of a finished chat completion request."""
+    duration = time.perf_counter() - started
+    REQUESTS_IN_FLIGHT.dec()
+    REQUEST_LATENCY.observe(duration, (mode, str(status_code)))
+    log_event(
+        logging.INFO,
+        "Chat completion finished",
+        mode=mode,
+        status=status_code,
+        duration_ms=round(duration * 1000, 1),
+    )
+
+
+async def observe_stream(events, started: float, mode: str = "stream"):
+    """Relay a streamed response, recording its latency when it ends."""
+    try:
+        async for event in events:
+            yield event
+    finally:
+        observe_request(started, mode, 200)
+
+
+@app.post("/v1/chat/completions")
+async def proxy_chat_completions(request: Request):
+    """
+    Proxy chat completions to the LLaMA backend.
+    This asynchronous function handles incoming requests for chat completions,
+    enforces tenant policies, and forwards the request to the LLaMA backend.
+    It processes the response, executes any tools specified in the request,
+    and updates the message history accordingly. Requests with "stream" set
+    are relayed as server-sent events while the backend generates them.
+    Deterministic requests are answered from the response cache when enabled.
+    Other requests are admitted against the limits of the tenant, and get a
+    429 with Retry-After when they are over them. Identical buffered requests
+    that arrive while one of them runs share its execution. The correlation
+    ID from the x-request-id header, or a new one, is added to the log lines
+    of the request and returned in the response.
+    Args:
+        request (Request): The incoming HTTP request containing the chat completion parameters.
+    Returns:
+        Response: A JSON response containing the chat completion results or an error message.
+    Raises:
+        Exception: Catches and handles exceptions during request processing and tool execution.
+    """
+    started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+    set_request_context(request)
+    try:
+        response = await handle_chat_completion(request)
+    except BaseException:
+        REQUESTS_IN_FLIGHT.dec()
+        raise
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = observe_stream(response.body_iterator, started)
+    else:
+        observe_request(started, "buffered", response.status_code)
+    response.headers[REQUEST_ID_HEADER] = request_id_var.get()
+    return response
+
+
+async def handle_chat_completion(request: Request) -> Response:
+    """Handle a chat completion request, see proxy_chat_completions."""
+    try:
+        # Parse incoming request
+        body = await request.json()
+    except Exception:
+        logger.exception("Error handling chat completion")
+        return JSONResponse(status_code=500, content="Server error")
+    return await chat_completion_response(
+        request.app.state.backend_client,
+        request.headers.get("authorization", "default_user"),
+        body,
+        response_cache_opted_in(request),
+    )
+
+
+async def chat_completion_response(
+    client: httpx.AsyncClient,
+    user_id: str,
+    body: dict,
+    cache_opted_in: bool = False,
+    priority: int | None = None,
+) -> Response:
+    """
+    Run a chat completion request through the policies, the response cache,
+    admission control and the tool loop.
+    Args:
+        client (httpx.AsyncClient): The shared, pooled client for backend requests.
+        user_id (str): The user the request is made for.
+        body (dict): The parsed chat completion request.
+        cache_opted_in (bool): Whether the client allowed cached responses.
+        priority (int | None): A priority class the request is admitted at
+            when it is lower than the priority of the tenant.
+    Returns:
+        Response: The response for the client, errors included.
+    """
+    try:
+        if not isinstance(body, dict):
+            return JSONResponse(
+                status_code=400, content={"error": "Request must be a JSON object."}
+            )
+        policy_started = time.perf_counter()
+        allowed, reason = enforce_tenant_policy(body)
+        TENANT_POLICY_LATENCY.observe(time.perf_counter() - policy_started)
+        if not allowed:
+            POLICY_DENIALS.inc(("tenant",))
+            return JSONResponse(status_code=403, content={"error": reason})
+
+        # The backend always gets the proxy's tools, see encode_backend_body
+        body.pop("tools", None)
+        session = BackendSession(backend_pool)
+
+        cache_key = None
+        if response_cache_eligible(body, cache_opted_in):
+            cache_key = canonical_request_hash(user_id, body)
+            content = await response_cache.get(user_id, cache_key)
+            if content is not None:
+                return Response(
+                    content=content,
+                    media_type="application/json",
+                    headers={RESPONSE_CACHE_HEADER: "hit"},
+                )
+
+        tenant = policy_store.tenant(user_id)
+        limits = policy_store.limits(tenant)
+        if priority is not None and limits is not None:
+            limits = limits._replace(priority=max(limits.priority, priority))
+        if body.get("stream"):
+            ticket = await admission_controller.admit(tenant, limits)
+            streaming = False
+            try:
+                llama_response = await open_llama_stream(client, session, body)
+                if llama_response.status_code != 200:
+                    content = await llama_response.aread()
+                    await llama_response.aclose()
+                    return Response(
+                        content=content,
+                        status_code=llama_response.status_code,
+                        media_type="application/json",
+                    )
+                events = stream_chat_completions(
+                    client, session, llama_response, user_id, body
+                )
+                streaming = True
+                return StreamingResponse(
+                    release_when_done(events, ticket),
+                    media_type="text/event-stream",
+                    headers={"Cache-Control": "no-cache"},
+                    background=BackgroundTask(ticket.release),
+                )
+            finally:
+                if not streaming:
+                    ticket.release()
+
+        async def execute() -> tuple[int, bytes, str]:
+            ticket = await admission_controller.admit(tenant, limits)
+            try:
+                response, final = await complete_chat_completion(
+                    client, session, user_id, body
+                )
+            finally:
+                ticket.release()
+            if cache_key is not None and final:
+                await response_cache.put(user_id, cache_key, response.body)
+            return response.status_code, response.body, response.media_type
+
+        if SINGLE_FLIGHT_ENABLED:
+            flight_key = cache_key or canonical_request_hash(user_id, body)
+            status_code, content, media_type = await single_flight.do(
+                flight_key, execute
+            )
+        else:
+            status_code, content, media_type = await execute()
+        response = Response(
+            content=content, status_code=status_code, media_type=media_type
+        )
+        if cache_key is not None:
+            response.headers[RESPONSE_CACHE_HEADER] = "miss"
+        return response
+
+    except AdmissionRejected as e:
+        return JSONResponse(
+            status_code=429,
+            content={"error": str(e)},
+            headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+        )
+    except NoBackendAvailable as e:
+        return JSONResponse(status_code=503, content={"error": str(e)})
+    except httpx.ReadTimeout:
+        log_event(logging.WARNING, "Backend did not answer in time")
+        return JSONResponse(
+            status_code=504, content={"error": "Backend did not answer in time."}
+        )
+    except Exception:
+        logger.exception("Error handling chat completion")
+        return JSONResponse(status_code=500, content="Server error")
+
+
+def parse_batch_line(index: int, line: bytes) -> tuple[str, dict | None, str | None]:
+    """
+    Parse a line of a batch request.
+    A line is either a chat completion request, optionally with a
+    "custom_id", or a line of the OpenAI batch input format, with the
+    request in "body". Batch requests are never streamed.
+    Args:
+        index (int): The position of the line in the batch, used as id when it has none.
+        line (bytes): The JSON line.
+    Returns:
+        tuple[str, dict | None, str | None]: The id of the request, the request,
+        and why the line could not be parsed if it could not.
+    """
+    request_id = f"request-{index}"
+    try:
+        item = json_loads(line)
+    except ValueError:
+        return request_id, None, "Invalid JSON."
+    if not isinstance(item, dict):
+        return request_id, None, "Request must be a JSON object."
+    request_id = str(item.pop("custom_id", None) or request_id)
+    body = item.get("body") if "body" in item else item
+    if not isinstance(body, dict):
+        return request_id, None, "Request body must be a JSON object."
+    body.pop("stream", None)
+    body.pop("stream_options", None)
+    return request_id, body, None
+
+
+def batch_result(request_id: str, status_code: int, content: bytes) -> bytes:
+    """Format the outcome of a batch request as a JSON line."""
+    try:
+        body = json_loads(content)
+    except ValueError:
+        body = content.decode("utf-8", "replace")
+    error = None
+    if status_code >= 400:
+        message = body.get("error", body) if isinstance(body, dict) else body
+        error = {"code": status_code, "message": message}
+    result = {
+        "custom_id": request_id,
+        "response": {"status_code": status_code, "body": body},
+        "error": error,
+    }
+    return json_dumps(result) + b"\n"
+
+
+async def run_batch_request(
+    client: httpx.AsyncClient, user_id: str, body: dict, cache_opted_in: bool
+) -> Response:
+    """
+    Run a request of a batch at the batch priority.
+    Requests over the rate limit of the tenant are retried after the
+    Retry-After delay, up to BATCH_MAX_RETRIES times, as a batch has no
+    client waiting to retry them.
+    """
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        response = await chat_completion_response(
+            client, user_id, body, cache_opted_in, PRIORITY_CLASSES["batch"]
+        )
+        if response.status_code != 429 or attempt == BATCH_MAX_RETRIES:
+            return response
+        await asyncio.sleep(float(response.headers.get("retry-after", "1")))
+    return response
+
+
+async def run_batch(
+    client: httpx.AsyncClient, user_id: str, lines: list[bytes], cache_opted_in: bool
+):
+    """
+    Run the requests of a batch concurrently, yielding their results.
+    At most BATCH_CONCURRENCY requests run at once. Results are yielded as
+    JSON lines in the order the requests finish; when the client goes away
+    the remaining requests are cancelled.
+    Args:
+        client (httpx.AsyncClient): The shared, pooled client for backend requests.
+        user_id (str): The user the batch is run for.
+        lines (list[bytes]): The JSON lines of the batch.
+        cache_opted_in (bool): Whether the client allowed cached responses.
+    Yields:
+        bytes: A JSON line with the id and the response or error of a request.
+    """
+    pending = iter(enumerate(lines))
+    results = asyncio.Queue()
+
+    async def worker():
+        for index, line in pending:
+            request_id, body, error = parse_batch_line(index, line)
+            if error is not None:
+                content = json_dumps({"error": error})
+                await results.put(batch_result(request_id, 400, content))
+                continue
+            response = await run_batch_request(client, user_id, body, cache_opted_in)
+            result = batch_result(request_id, response.status_code, response.body)
+            await results.put(result)
+
+    workers = [
+        asyncio.create_task(worker()) for _ in range(min(BATCH_CONCURRENCY, len(lines)))
+    ]
+    try:
+        for _ in lines:
+            yield await results.get()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+@app.post("/v1/chat/completions/batch")
+async def batch_chat_completions(request: Request):
+    """
+    Run a batch of chat completion requests and stream back their results.
+    The body holds one chat completion request per line (JSONL). Every
+    request goes through the same policies, admission control and tool loop
+    as a single request, at the batch priority. The response is streamed as
+    JSONL in completion order, one line per request, tagged with its
+    "custom_id" and holding either the response or the error of the request.
+    Args:
+        request (Request): The incoming HTTP request with the JSONL batch.
+    Returns:
+        Response: A streamed JSONL response, or an error for the whole batch.
+    """
+    set_request_context(request)
+    content = await request.body()
+    lines = [line for line in content.splitlines() if line.strip()]
+    if len(lines) > BATCH_MAX_REQUESTS:
+        return JSONResponse(
+            status_code=413,
+            content={"error": f"A batch holds at most {BATCH_MAX_REQUESTS} requests."},
+        )
+    started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+    results = run_batch(
+        request.app.state.backend_client,
+        request.headers.get("authorization", "default_user"),
+        lines,
+        response_cache_opted_in(request),
+    )
+    return StreamingResponse(
+        observe_stream(results, started, "batch"),
+        media_type="application/x-ndjson",
+        headers={REQUEST_ID_HEADER: request_id_var.get()},
+    )
+
+
+def admin_allowed(request: Request) -> bool:
+    """
+    Check access to the admin endpoints.
+    When ADMIN_TOKEN is set the request needs a matching x-admin-token header.
+    """
+    return not ADMIN_TOKEN or request.headers.get("x-admin-token") == ADMIN_TOKEN
+
+
+@app.post("/admin/policies/reload")
+async def reload_policies(request: Request):
+    """Reload the policy files from disk without waiting for the watcher."""
+    if not admin_allowed(request):
+        return JSONResponse(status_code=403, content={"error": "Forbidden"})
+    try:
+        await asyncio.to_thread(policy_store.load)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    return {"status": "reloaded", "users": sorted(policy_store.users)}
+
+
+@app.get("/admin/cache")
+async def cache_stats(request: Request):
+    """Report the counters of the tool result and response caches, and the search index."""
+    if not admin_allowed(request):
+        return JSONResponse(status_code=403, content={"error": "Forbidden"})
+    return {
+        "tool_cache": tool_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "search_index": document_index.stats(),
+    }
+
+
+@app.get("/admin/backends")
+async def backend_stats(request: Request):
+    """Report the load and circuit breaker state of every backend."""
+    if not admin_allowed(request):
+        return JSONResponse(status_code=403, content={"error": "Forbidden"})
+    return {"backends": backend_pool.stats()}
+
+
+@app.get("/admin/admission")
+async def admission_stats(request: Request):
+    """Report the active, queued and rejected requests of the admission control."""
+    if not admin_allowed(request):
+        return JSONResponse(status_code=403, content={"error": "Forbidden"})
+    return admission_controller.stats()
+
+
+@app.get("/admin/coalescing")
+async def coalescing_stats(request: Request):
+    """Report how many requests were executed and how many joined an execution."""
+    if not admin_allowed(request):
+        return JSONResponse(status_code=403, content={"error": "Forbidden"})
+    return single_flight.stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    """Expose the proxy metrics in the Prometheus text format."""
+    LOG_RECORDS_DROPPED.values[()] = log_handler.dropped
+    return PlainTextResponse(
+        render_metrics(METRICS), media_type="text/plain; version=0.0.4"
+    )
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+@app.get("/health/live")
+async def liveness():
+    """Report that the proxy is running; it does not depend on the backends."""
+    return {"status": "ok"}
+
+
+@app.get("/health/ready")
+async def readiness():
+    """
+    Report whether the proxy can serve requests.
+    The proxy is ready once the policies and the search index are loaded, a
+    health probe reached a backend, and the warm-up of the backends finished
+    or is disabled. The response includes how long the warm-up took.
+    Returns:
+        JSONResponse: 200 when ready, 503 otherwise, with the result of every check.
+    """
+    checks = {
+        "backend_reachable": backend_pool.reachable(),
+        "policies_loaded": policy_store.loaded,
+        "search_index_loaded": document_index.ready,
+        "warmup_finished": backend_warmup.finished(),
+    }
+    ready = all(checks.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else "not_ready",
+            "checks": checks,
+            "warmup": backend_warmup.stats(),
+        },
+    )
 
 
 if __name__ == "__main__":
@@ -1,41 +1,389 @@
 import json
+import operator
+import os
+import signal
+import socket
+import sys
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import parse_qs, urlparse
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Serving mode: "pooled" serves HTTP/1.1 keep-alive connections from a bounded
+# pool of worker threads, "legacy" is the single-threaded HTTP/1.0 server
+SERVER_MODE = os.getenv("SERVER_MODE", "pooled")
+PORT = int(os.getenv("PORT", "80"))
+
+# Worker pool
+WORKERS = int(os.getenv("WORKERS", "32"))
+# Connections accepted while every worker is busy; beyond that they get a 503
+MAX_PENDING_CONNECTIONS = int(os.getenv("MAX_PENDING_CONNECTIONS", "256"))
+# Seconds an idle keep-alive connection is kept open
+KEEPALIVE_TIMEOUT = float(os.getenv("KEEPALIVE_TIMEOUT", "5"))
+# Seconds in-flight requests get to finish after a SIGTERM
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "20"))
+ACCESS_LOG = os.getenv("ACCESS_LOG", "false").lower() == "true"
+
+# Batch endpoint, bodies above this size are refused with a 413
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_BYTES", str(64 * 1024 * 1024)))
+FLOAT64_SIZE = 8
+
+OVERLOADED_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Type: application/json\r\n"
+    b"Content-Length: 23\r\n"
+    b"Connection: close\r\n\r\n"
+    b'{"error": "overloaded"}'
+)
+
+
+def multiply_binary(body: bytes) -> bytes:
+    """
+    Multiply two vectors of little-endian float64 values element-wise.
+    Args:
+        body (bytes): The values of vector a followed by those of vector b.
+    Returns:
+        bytes: The products, as little-endian float64 values.
+    Raises:
+        ValueError: When the body does not hold two vectors of equal length.
+    """
+    if len(body) % (2 * FLOAT64_SIZE):
+        raise ValueError(
+            "The body must hold two float64 vectors of equal length, "
+            f"got {len(body)} bytes which is not a multiple of {2 * FLOAT64_SIZE}."
+        )
+    count = len(body) // (2 * FLOAT64_SIZE)
+    if numpy is not None:
+        values = numpy.frombuffer(body, dtype="<f8")
+        return (values[:count] * values[count:]).astype("<f8", copy=False).tobytes()
+    if sys.byteorder == "little":
+        # Reads the doubles in place, without copying the body
+        values = memoryview(body).cast("d")
+    else:
+        values = array("d", body)
+        values.byteswap()
+    result = array("d", map(operator.mul, values[:count], values[count:]))
+    if sys.byteorder != "little":
+        result.byteswap()
+    return result.tobytes()
+
+
+def float_vector(values, name: str):
+    """
+    Convert a JSON array of numbers to a float64 vector.
+    Args:
+        values: The decoded JSON value.
+        name (str): The name of the vector, for error messages.
+    Returns:
+        numpy.ndarray | array: The vector.
+    Raises:
+        TypeError: When the value is not an array.
+        ValueError: When the array holds other values than numbers.
+    """
+    error = f'"{name}" must be an array of numbers.'
+    if not isinstance(values, list):
+        raise TypeError(error)
+    if numpy is not None:
+        try:
+            vector = numpy.asarray(values)
+        except ValueError:
+            raise ValueError(error) from None
+        # Strings, booleans, nested arrays and nulls give another dtype
+        if vector.ndim != 1 or vector.dtype.kind not in "iuf":
+            raise ValueError(error)
+        return vector.astype(numpy.float64, copy=False)
+    # array() takes booleans as numbers, numpy does not
+    if any(isinstance(value, bool) for value in values):
+        raise ValueError(error)
+    try:
+        return array("d", values)
+    except TypeError:
+        raise ValueError(error) from None
+
+
+def multiply_json(body: bytes) -> bytes:
+    """
+    Multiply the vectors "a" and "b" of a JSON object element-wise.
+    Args:
+        body (bytes): A JSON object with the arrays "a" and "b".
+    Returns:
+        bytes: A JSON object with the products in "result".
+    Raises:
+        TypeError: When the body or "a" or "b" is not of the expected JSON type.
+        ValueError: When the body is not valid JSON, the arrays hold other
+            values than numbers or differ in length, or a product is not a
+            finite number, which JSON cannot represent.
+    """
+    try:
+        payload = json.loads(body)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"The body is not valid JSON: {e}") from None
+    if not isinstance(payload, dict):
+        raise TypeError('The body must be a JSON object with arrays "a" and "b".')
+    a = float_vector(payload.get("a"), "a")
+    b = float_vector(payload.get("b"), "b")
+    if len(a) != len(b):
+        raise ValueError(
+            f'"a" and "b" must have the same length, got {len(a)} and {len(b)}.'
+        )
+    if numpy is not None:
+        # Overflow is reported as an error below, not as a warning on stderr
+        with numpy.errstate(over="ignore", invalid="ignore"):
+            result = (a * b).tolist()
+    else:
+        result = list(map(operator.mul, a, b))
+    try:
+        return json.dumps({"result": result}, allow_nan=False).encode("utf-8")
+    except ValueError:
+        raise ValueError("The products must be finite float64 numbers.") from None
+
+
+BATCH_FORMATS = {
+    "application/json": multiply_json,
+    "application/octet-stream": multiply_binary,
+}
+
 
 class SimpleAddHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         parsed_path = urlparse(self.path)
 
+        if parsed_path.path == "/health":
+            self.reply(200, {"status": "ok"})
+            return
+
         if parsed_path.path != "/multiply":
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write(b"Not Found")
+            self.reply(404, b"Not Found", "text/plain")
             return
 
         query = parse_qs(parsed_path.query)
         try:
             a = float(query.get("a", [None])[0])
             b = float(query.get("b", [None])[0])
-            result = {"a": a, "b": b, "result": a * b}
-            response = json.dumps(result).encode("utf-8")
-
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(response)
+            self.reply(200, {"a": a, "b": b, "result": a * b})
         except (TypeError, ValueError):
-            self.send_response(400)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
             error_msg = {
                 "error": 'Please provide valid numeric values for "a" and "b".'
             }
-            self.wfile.write(json.dumps(error_msg).encode("utf-8"))
+            self.reply(400, error_msg)
 
+    def do_POST(self):
+        if urlparse(self.path).path != "/multiply/batch":
+            self.reply(404, b"Not Found", "text/plain")
+            return
 
-if __name__ == "__main__":
-    server_address = ("", 80)
-    httpd = HTTPServer(server_address, SimpleAddHandler)
-    print("Serving on port 80...")
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip()
+        multiply = BATCH_FORMATS.get(content_type.lower())
+        length = self.headers.get("Content-Length")
+        if multiply is None:
+            # The unread body would be parsed as the next request
+            self.close_connection = True
+            self.reply(
+                415,
+                {"error": "Content-Type must be one of " + ", ".join(BATCH_FORMATS)},
+            )
+            return
+        if length is None or not length.isdigit():
+            self.close_connection = True
+            self.reply(411, {"error": "A valid Content-Length header is required."})
+            return
+        if int(length) > MAX_BATCH_BYTES:
+            self.close_connection = True
+            self.reply(
+                413, {"error": f"The body must not exceed {MAX_BATCH_BYTES} bytes."}
+            )
+            return
+
+        body = self.rfile.read(int(length))
+        if len(body) != int(length):
+            self.close_connection = True
+            return
+        try:
+            result = multiply(body)
+        except (TypeError, ValueError) as e:
+            self.reply(400, {"error": str(e)})
+            return
+        self.reply(200, result, content_type)
+
+    def reply(
+        self, status: int, body: dict | bytes, content_type: str = "application/json"
+    ):
+        """
+        Send a complete response.
+        The Content-Length header lets HTTP/1.1 clients reuse the connection.
+        Args:
+            status (int): The HTTP status code.
+            body (dict | bytes): The response body, dicts are sent as JSON.
+            content_type (str): The Content-Type of the body.
+        """
+        if isinstance(body, dict):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection and self.protocol_version == "HTTP/1.1":
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if ACCESS_LOG:
+            super().log_message(format, *args)
+
+
+class KeepAliveHandler(SimpleAddHandler):
+    """
+    Handler for the pooled server.
+    Keeps connections open between requests, closes connections that stay
+    idle for KEEPALIVE_TIMEOUT, and tells the server which connections are
+    idle so they can be closed when it drains.
+    """
+
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+    # Headers and body are written separately, without this the body waits
+    # for the ACK of the headers on a reused connection
+    disable_nagle_algorithm = True
+
+    def handle_one_request(self):
+        self.server.mark_idle(self.connection, True)
+        super().handle_one_request()
+
+    def parse_request(self) -> bool:
+        self.server.mark_idle(self.connection, False)
+        parsed = super().parse_request()
+        if self.server.draining:
+            # Let the client open its next connection to another pod
+            self.close_connection = True
+        return parsed
+
+    def do_GET(self):
+        if self.server.draining and urlparse(self.path).path == "/health":
+            self.reply(503, {"status": "draining"})
+            return
+        super().do_GET()
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTP server handing each connection to a bounded pool of worker threads.
+    At most WORKERS connections are served at once and MAX_PENDING_CONNECTIONS
+    more wait for a worker; further connections are answered with a 503 so a
+    burst can not exhaust threads or memory.
+    """
+
+    def __init__(self, server_address, handler_class, workers: int, max_pending: int):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="multiply"
+        )
+        self.slots = threading.BoundedSemaphore(workers + max_pending)
+        self.draining = False
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            try:
+                request.sendall(OVERLOADED_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        with self.lock:
+            # None until the first request was read from the connection
+            self.connections[request] = None
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.lock:
+                self.connections.pop(request, None)
+                self.finished.notify_all()
+            self.slots.release()
+
+    def mark_idle(self, connection, idle: bool):
+        with self.lock:
+            if connection not in self.connections:
+                return
+            served = self.connections[connection] is not None
+            # A new connection stays None while it waits for its first request
+            if served or not idle:
+                self.connections[connection] = idle
+        # Connections accepted before the drain still get their first request
+        if idle and served and self.draining:
+            self.close_idle(connection)
+
+    @staticmethod
+    def close_idle(connection):
+        # The blocked read of the next request returns end of file
+        try:
+            connection.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def drain(self, timeout: float):
+        """
+        Finish the requests in flight and close the connections.
+        Call after serve_forever() returned, so no new connections are accepted.
+        Idle keep-alive connections are closed at once, busy ones after their
+        response, which carries "Connection: close". Connections still waiting
+        for a worker are served one request.
+        Args:
+            timeout (float): Seconds to wait for the requests in flight.
+        """
+        self.draining = True
+        with self.lock:
+            idle = [conn for conn, state in self.connections.items() if state is True]
+        for connection in idle:
+            self.close_idle(connection)
+        with self.lock:
+            self.finished.wait_for(lambda: not self.connections, timeout)
+            remaining = list(self.connections)
+        for connection in remaining:
+            self.close_idle(connection)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_server() -> HTTPServer:
+    server_address = ("", PORT)
+    if SERVER_MODE == "legacy":
+        return HTTPServer(server_address, SimpleAddHandler)
+    return PooledHTTPServer(
+        server_address, KeepAliveHandler, WORKERS, MAX_PENDING_CONNECTIONS
+    )
+
+
+def main():
+    httpd = create_server()
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it can not be
+        # called from the thread running it
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"Serving on port {PORT} ({SERVER_MODE})...", flush=True)
     httpd.serve_forever()
+    print("Shutting down...", flush=True)
+    if isinstance(httpd, PooledHTTPServer):
+        httpd.drain(DRAIN_TIMEOUT)
+    httpd.server_close()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
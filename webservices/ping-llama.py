@@ -1,14 +1,43 @@
+import http.client
 import json
 import os
+import random
+import threading
 import time
-import urllib.request
+from collections import deque
 from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
 
 LLAMA_URL = os.getenv(
     "LLAMA_URL", "http://llama-proxy.default.svc.cluster.local:80/v1/chat/completions"
 )
 PROMPT = os.getenv("PROMPT", "Hello, what is the current time?")
+# Prompts probed concurrently, a JSON object of name to prompt
+PROMPTS = json.loads(os.getenv("PROMPTS", "null") or "null") or {"default": PROMPT}
+MODEL = os.getenv("MODEL", "Qwen/Qwen2.5-14B-Instruct-AWQ")
+AUTHORIZATION = os.getenv("AUTHORIZATION", "ping")
 INTERVAL = int(os.getenv("INTERVAL", "90"))  # seconds
+# Each interval is varied by up to this fraction, so pods do not probe in lockstep
+JITTER = float(os.getenv("JITTER", "0.2"))
+CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", "5"))
+# Seconds without a byte from the proxy before a probe fails
+READ_TIMEOUT = float(os.getenv("READ_TIMEOUT", "120"))
+# Seconds an idle connection is reused for, below the proxy's keep-alive timeout
+KEEPALIVE_IDLE = float(os.getenv("KEEPALIVE_IDLE", "4"))
+# Errors of a reused keep-alive connection that the server closed while idle
+STALE_CONNECTION_ERRORS = (
+    BrokenPipeError,
+    ConnectionResetError,
+    http.client.RemoteDisconnected,
+)
+
+# Rolling summary of the probes of the last SUMMARY_WINDOW seconds, printed
+# every SUMMARY_INTERVAL seconds and served on METRICS_PORT
+SUMMARY_WINDOW = int(os.getenv("SUMMARY_WINDOW", "3600"))
+SUMMARY_INTERVAL = int(os.getenv("SUMMARY_INTERVAL", "900"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "80"))
+QUANTILES = (0.5, 0.9, 0.99)
 
 
 def extract_final_message(raw_text: str) -> str:
@@ -21,52 +50,292 @@ def extract_final_message(raw_text: str) -> str:
     return raw_text.strip()  # fallback to full text if marker missing
 
 
-def ping_llama():
-    try:
-        # Prepare OpenAI-style chat request
-        payload = json.dumps(
+def percentile(sorted_values: list[float], fraction: float) -> float | None:
+    """Return a nearest-rank percentile of sorted values."""
+    if not sorted_values:
+        return None
+    index = min(
+        len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1)
+    )
+    return sorted_values[index]
+
+
+class ProbeWindow:
+    """
+    Results of the probes of the last SUMMARY_WINDOW seconds, per prompt,
+    with the totals since the start for the Prometheus summaries.
+    """
+
+    def __init__(self, window: int):
+        self.window = window
+        self.results = deque()
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def add(self, result: dict):
+        with self.lock:
+            self.results.append(result)
+            totals = self.totals.setdefault(
+                result["prompt"],
+                {"ok": 0, "error": 0, "ttft_sum": 0.0, "total_sum": 0.0},
+            )
+            totals["ok" if result["ok"] else "error"] += 1
+            if result["ok"]:
+                totals["ttft_sum"] += result["ttft"]
+                totals["total_sum"] += result["total"]
+
+    def summary(self) -> dict:
+        """
+        Summarize the probes in the window.
+        Returns:
+            dict: Per prompt the probe and error counts and the quantiles of
+                the connect time, time to first token and total time, in seconds.
+        """
+        cutoff = time.time() - self.window
+        with self.lock:
+            while self.results and self.results[0]["time"] < cutoff:
+                self.results.popleft()
+            results = list(self.results)
+        summary = {}
+        for name in PROMPTS:
+            probes = [result for result in results if result["prompt"] == name]
+            succeeded = [result for result in probes if result["ok"]]
+            entry = {"probes": len(probes), "errors": len(probes) - len(succeeded)}
+            for key in ("connect", "ttft", "total"):
+                values = sorted(result[key] for result in succeeded)
+                entry[key] = {
+                    f"p{round(quantile * 100)}": percentile(values, quantile)
+                    for quantile in QUANTILES
+                }
+            summary[name] = entry
+        return summary
+
+    def render_metrics(self) -> str:
+        """Render the window quantiles and the totals in the Prometheus text format."""
+        summary = self.summary()
+        with self.lock:
+            totals = {name: dict(values) for name, values in self.totals.items()}
+        lines = []
+        for metric, key, help_text in (
+            (
+                "ping_llama_time_to_first_token_seconds",
+                "ttft",
+                "Time from sending the request to the first streamed token.",
+            ),
+            (
+                "ping_llama_request_seconds",
+                "total",
+                "Time from sending the request to the end of the stream.",
+            ),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} summary")
+            for name, entry in summary.items():
+                for quantile in QUANTILES:
+                    value = entry[key][f"p{round(quantile * 100)}"]
+                    if value is not None:
+                        lines.append(
+                            f'{metric}{{prompt="{name}",quantile="{quantile}"}} {value}'
+                        )
+                total = totals.get(name, {})
+                lines.append(
+                    f'{metric}_sum{{prompt="{name}"}} {total.get(f"{key}_sum", 0.0)}'
+                )
+                lines.append(f'{metric}_count{{prompt="{name}"}} {total.get("ok", 0)}')
+        lines.append("# HELP ping_llama_probes_total Probes sent, by outcome.")
+        lines.append("# TYPE ping_llama_probes_total counter")
+        for name in PROMPTS:
+            for outcome in ("ok", "error"):
+                count = totals.get(name, {}).get(outcome, 0)
+                lines.append(
+                    f'ping_llama_probes_total{{prompt="{name}",outcome="{outcome}"}} {count}'
+                )
+        return "\n".join(lines) + "\n"
+
+
+probe_window = ProbeWindow(SUMMARY_WINDOW)
+
+
+class Prober:
+    """
+    Probes the proxy with one prompt over a persistent connection.
+    The request is streamed, so the time to the first token, which includes
+    queueing and the tool loop in the proxy, is measured apart from the
+    generation of the rest of the answer.
+    """
+
+    def __init__(self, name: str, prompt: str):
+        self.name = name
+        self.prompt = prompt
+        url = urlparse(LLAMA_URL)
+        connection_class = (
+            http.client.HTTPSConnection
+            if url.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self.connection = connection_class(
+            url.hostname, url.port, timeout=CONNECT_TIMEOUT
+        )
+        self.path = url.path or "/"
+        self.body = json.dumps(
             {
-                "model": "Qwen/Qwen2.5-14B-Instruct-AWQ",
+                "model": MODEL,
                 "messages": [
                     {"role": "system", "content": "You are friendly and very concise."},
-                    {"role": "user", "content": PROMPT},
+                    {"role": "user", "content": self.prompt},
                 ],
+                "stream": True,
             }
         ).encode("utf-8")
+        self.idle_since = 0.0
 
-        headers = {"Content-Type": "application/json", "authorization": "ping"}
-
-        req = urllib.request.Request(
-            LLAMA_URL,
-            data=payload,
-            headers=headers,
-            method="POST",
+    def send(self, result: dict) -> tuple[http.client.HTTPResponse, float]:
+        """
+        Send the request, connecting first when there is no open connection.
+        A connection idle for longer than KEEPALIVE_IDLE is closed first, the
+        proxy has closed it already.
+        Args:
+            result (dict): The probe result, the connect time is added to it.
+        Returns:
+            tuple[http.client.HTTPResponse, float]: The response, of which only
+                the headers are read, and the perf_counter() time it was sent at.
+        """
+        if time.monotonic() - self.idle_since > KEEPALIVE_IDLE:
+            self.connection.close()
+        started = time.perf_counter()
+        result["reused"] = self.connection.sock is not None
+        if not result["reused"]:
+            self.connection.connect()
+            self.connection.sock.settimeout(READ_TIMEOUT)
+        result["connect"] = time.perf_counter() - started
+        self.connection.request(
+            "POST",
+            self.path,
+            body=self.body,
+            headers={
+                "Content-Type": "application/json",
+                "authorization": AUTHORIZATION,
+            },
         )
+        return self.connection.getresponse(), started
 
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            data = json.load(resp)
+    def probe(self) -> dict:
+        """
+        Send the prompt and read the streamed answer.
+        Returns:
+            dict: The outcome, the connect time, time to first token and total
+                time in seconds, and the answer or the error.
+        """
+        result = {"time": time.time(), "prompt": self.name, "ok": False}
+        try:
+            try:
+                response, started = self.send(result)
+            except STALE_CONNECTION_ERRORS:
+                if not result["reused"]:
+                    raise
+                # The proxy closed the idle connection, reconnect once
+                self.connection.close()
+                response, started = self.send(result)
+            if response.status != 200:
+                result["error"] = f"HTTP {response.status}: {response.read()[:200]!r}"
+                return result
+            parts = []
+            for line in response:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                chunk = json.loads(data)
+                if "error" in chunk:
+                    result["error"] = str(chunk["error"])
+                    self.connection.close()
+                    return result
+                for choice in chunk.get("choices") or []:
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        if not parts:
+                            result["ttft"] = time.perf_counter() - started
+                        parts.append(content)
+            response.read()
+            result["total"] = time.perf_counter() - started
+            result.setdefault("ttft", result["total"])
+            result["message"] = extract_final_message("".join(parts))
+            result["ok"] = True
+        except (http.client.HTTPException, OSError, ValueError) as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+            self.connection.close()
+        self.idle_since = time.monotonic()
+        return result
 
-            # Extract assistant message
-            choices = data.get("choices", [])
-            if choices:
-                assistant_msg = choices[0].get("message", {}).get("content", "").strip()
-            else:
-                assistant_msg = "No response"
+    def run(self, stop: threading.Event):
+        # Start at a random point of the interval, so prompts and pods spread out
+        if stop.wait(random.uniform(0, INTERVAL)):
+            return
+        while not stop.is_set():
+            result = self.probe()
+            probe_window.add(result)
+            log_probe(result)
+            stop.wait(INTERVAL * random.uniform(1 - JITTER, 1 + JITTER))
 
-        assistant_msg = extract_final_message(assistant_msg)
-        log_entry = f"[{datetime.now(timezone.utc).isoformat()}] {assistant_msg}"
-        print(log_entry, flush=True)
 
-    except Exception as e:
-        error_msg = f"[{datetime.now(timezone.utc).isoformat()}] ERROR: {e}"
-        print(error_msg, flush=True)
+def log_probe(result: dict):
+    timestamp = datetime.now(timezone.utc).isoformat()
+    if result["ok"]:
+        print(
+            f"[{timestamp}] {result['prompt']}: ttft={result['ttft']:.3f}s "
+            f"total={result['total']:.3f}s connect={result['connect']:.3f}s "
+            f"reused={result['reused']} {result['message']}",
+            flush=True,
+        )
+    else:
+        print(f"[{timestamp}] {result['prompt']}: ERROR: {result['error']}", flush=True)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            body = probe_window.render_metrics().encode("utf-8")
+            content_type = "text/plain; version=0.0.4"
+        elif path == "/summary":
+            body = json.dumps(probe_window.summary()).encode("utf-8")
+            content_type = "application/json"
+        elif path == "/health":
+            body = b'{"status": "ok"}'
+            content_type = "application/json"
+        else:
+            self.send_response(404)
+            self.end_headers()
+            self.wfile.write(b"Not Found")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
 
 def main():
     print("Starting LLaMA ping service...", flush=True)
+    server = ThreadingHTTPServer(("", METRICS_PORT), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    stop = threading.Event()
+    for name, prompt in PROMPTS.items():
+        threading.Thread(
+            target=Prober(name, prompt).run, args=(stop,), daemon=True
+        ).start()
     while True:
-        ping_llama()
-        time.sleep(INTERVAL)
+        time.sleep(SUMMARY_INTERVAL)
+        summary = json.dumps(probe_window.summary())
+        print(
+            f"[{datetime.now(timezone.utc).isoformat()}] SUMMARY {summary}", flush=True
+        )
 
 
 if __name__ == "__main__":
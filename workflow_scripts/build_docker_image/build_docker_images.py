@@ -2,6 +2,9 @@ import argparse
 import json
 import os
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 
 import docker
@@ -21,6 +24,24 @@ def parse_arguments():
         required=True,
         help="Docker registry to push the images to.",
     )
+    parser.add_argument(
+        "--build-workers",
+        type=int,
+        default=min(4, os.cpu_count() or 1),
+        help="Images built concurrently.",
+    )
+    parser.add_argument(
+        "--push-workers",
+        type=int,
+        default=2,
+        help="Images pushed concurrently, while other images are still building.",
+    )
+    parser.add_argument(
+        "--image-tags-json",
+        type=str,
+        default="generated_dockerfiles/image_tags.json",
+        help="File mapping each service to its image tag.",
+    )
     return parser.parse_args()
 
 
@@ -42,55 +63,180 @@ def set_github_env_var(name, value):
         f.write(f"{name}={value}\n")
 
 
-def build_and_push_image(client, dockerfile_path, docker_registry):
-    try:
-        # Build the Docker image
-        print(f"Building image from {dockerfile_path}...")
-        dockerfile_path = Path(dockerfile_path)
-        image, build_logs = client.images.build(
-            path=str(Path.cwd()), dockerfile=str(dockerfile_path)
-        )
+class ServiceBuild:
+    """
+    Build and push of the image of one service.
+    The log lines are collected and printed together when the service is
+    done, so the output of concurrent builds does not interleave.
+    """
+
+    def __init__(self, dockerfile_path, docker_registry, previous_tag=None):
+        self.dockerfile_path = Path(dockerfile_path)
+        self.name = self.dockerfile_path.parent.name.lower()
+        self.docker_registry = docker_registry
+        self.previous_tag = previous_tag
+        self.image = None
+        self.tag = None
+        self.error = None
+        self.log = []
+
+    @property
+    def repository(self):
+        return f"{self.docker_registry}/{self.name}"
+
+    @property
+    def image_name_tagged(self):
+        return f"{self.repository}:{self.tag}"
 
-        # Extract the image SHA
-        image_name = dockerfile_path.parent.name.lower()
-        image_tag = str(image.id).split(":")[1]
-        image_name_tagged = f"{docker_registry}/{image_name}:{image_tag}"
+    def cache_from(self, client):
+        """
+        Pull the previous image of the service, so its layers can be reused.
+        The classic builder of the Docker SDK only uses cache_from images that
+        are present locally.
+        """
+        if not self.previous_tag:
+            return []
+        previous = f"{self.repository}:{self.previous_tag}"
+        try:
+            client.images.pull(self.repository, tag=self.previous_tag)
+        except docker.errors.APIError as e:
+            self.log.append(f"No cache image {previous}: {e.explanation or e}")
+            return []
+        return [previous]
 
-        # Tag the image with the SHA
-        image.tag(image_name_tagged)
+    def build(self, client):
+        self.log.append(f"Building image from {self.dockerfile_path}...")
+        try:
+            self.image, build_logs = client.images.build(
+                path=str(Path.cwd()),
+                dockerfile=str(self.dockerfile_path),
+                cache_from=self.cache_from(client),
+            )
+        except docker.errors.BuildError as e:
+            self.add_build_log(e.build_log)
+            raise
+        self.add_build_log(build_logs)
 
-        set_github_env_var("DOCKER_IMAGE", image_name_tagged)
+        # Tag the image with its SHA
+        self.tag = str(self.image.id).split(":")[1]
+        self.image.tag(self.image_name_tagged)
 
-        # Push the Docker image to the registry
-        print(f"Pushing image {image_name_tagged} to registry...")
-        for line in client.images.push(image_name_tagged, stream=True, decode=True):
+    def add_build_log(self, build_logs):
+        for chunk in build_logs:
+            if "stream" in chunk and chunk["stream"].strip():
+                self.log.append(chunk["stream"].rstrip())
+
+    def push(self, client):
+        self.log.append(f"Pushing image {self.image_name_tagged} to registry...")
+        for line in client.images.push(
+            self.repository, tag=self.tag, stream=True, decode=True
+        ):
+            if "error" in line:
+                raise docker.errors.APIError(line["error"])
+            if "status" in line and "id" not in line:
+                self.log.append(line["status"])
+        self.log.append(
+            f"Successfully pushed {self.image_name_tagged} to {self.docker_registry}"
+        )
+
+    def print_log(self):
+        status = "FAILED" if self.error else "OK"
+        print(f"===== {self.name}: {status} =====")
+        for line in self.log:
             print(line)
-        print(f"Successfully pushed {image_name_tagged} to {docker_registry}")
-    except docker.errors.BuildError as e:
-        print(f"Build error for {dockerfile_path}: {e}")
-        sys.exit(1)
-    except docker.errors.APIError as e:
-        print(f"API error for {dockerfile_path}: {e}")
-        sys.exit(2)
+        if self.error:
+            print(self.error)
+        print(flush=True)
 
-    update_image_tag(image_name, image_tag)
 
+class BuildExecutor:
+    """
+    Builds the images on a pool of build workers and pushes each image on a
+    separate pool of push workers as soon as it is built, so pushes overlap
+    with the remaining builds. Every worker thread uses its own Docker client.
+    """
 
-def update_image_tag(
-    service_name, new_tag, json_path="generated_dockerfiles/image_tags.json"
-):
-    json_path = Path(json_path)
+    def __init__(self, docker_registry, build_workers, push_workers):
+        self.docker_registry = docker_registry
+        self.build_pool = ThreadPoolExecutor(
+            max_workers=build_workers, thread_name_prefix="build"
+        )
+        self.push_pool = ThreadPoolExecutor(
+            max_workers=push_workers, thread_name_prefix="push"
+        )
+        self.local = threading.local()
+        self.print_lock = threading.Lock()
+        self.push_futures = []
+        self.futures_lock = threading.Lock()
+
+    def client(self):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = docker.from_env()
+            client.login(
+                username=os.getenv("DOCKER_REGISTRY_USERNAME"),
+                password=os.getenv("DOCKER_REGISTRY_PASSWORD"),
+                registry=self.docker_registry,
+            )
+            self.local.client = client
+        return client
+
+    def finish(self, service, error=None):
+        if error is not None:
+            service.error = f"{type(error).__name__}: {error}"
+        with self.print_lock:
+            service.print_log()
+
+    def build(self, service):
+        try:
+            service.build(self.client())
+        except Exception as e:
+            self.finish(service, e)
+            return
+        with self.futures_lock:
+            self.push_futures.append(self.push_pool.submit(self.push, service))
+
+    def push(self, service):
+        try:
+            service.push(self.client())
+        except Exception as e:
+            self.finish(service, e)
+            return
+        self.finish(service)
+
+    def run(self, services):
+        """Build and push every service, waiting until all are done."""
+        wait([self.build_pool.submit(self.build, service) for service in services])
+        self.build_pool.shutdown()
+        with self.futures_lock:
+            push_futures = list(self.push_futures)
+        wait(push_futures)
+        self.push_pool.shutdown()
 
+
+def load_image_tags(json_path):
+    json_path = Path(json_path)
     if json_path.exists():
         with json_path.open("r") as f:
-            existing_tags = json.load(f)
-    else:
-        existing_tags = {}
+            return json.load(f)
+    return {}
 
-    existing_tags[service_name] = new_tag
 
-    with json_path.open("w") as f:
-        json.dump(existing_tags, f, indent=2)
+def write_image_tags(image_tags, json_path):
+    """
+    Write the image tags, replacing the file atomically.
+    The tags are written to a temporary file in the same directory, which is
+    then renamed over the old file, so readers never see a partial file.
+    """
+    json_path = Path(json_path)
+    fd, tmp_path = tempfile.mkstemp(dir=json_path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(image_tags, f, indent=2)
+        os.replace(tmp_path, json_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
 
 def main():
@@ -102,20 +248,33 @@ def main():
         print(f"Directory '{dockerfiles_dir}' does not exist.")
         return
 
-    client = docker.from_env()
+    image_tags = load_image_tags(args.image_tags_json)
+    services = [
+        ServiceBuild(dockerfile_path, docker_registry)
+        for dockerfile_path in find_dockerfiles(dockerfiles_dir)
+    ]
+    for service in services:
+        service.previous_tag = image_tags.get(service.name)
+
+    BuildExecutor(docker_registry, args.build_workers, args.push_workers).run(services)
 
-    client.login(
-        username=os.getenv("DOCKER_REGISTRY_USERNAME"),
-        password=os.getenv("DOCKER_REGISTRY_PASSWORD"),
-        registry=docker_registry,
+    failed = [service for service in services if service.error]
+    pushed = sorted(
+        (service for service in services if not service.error),
+        key=lambda service: service.name,
     )
+    for service in pushed:
+        image_tags[service.name] = service.tag
+    write_image_tags(image_tags, args.image_tags_json)
+    if os.getenv("GITHUB_ENV"):
+        for service in pushed:
+            set_github_env_var("DOCKER_IMAGE", service.image_name_tagged)
 
-    try:
-        dockerfile_paths = find_dockerfiles(dockerfiles_dir)
-        for dockerfile_path in dockerfile_paths:
-            build_and_push_image(client, dockerfile_path, docker_registry)
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    print(f"Pushed {len(pushed)} of {len(services)} images.")
+    for service in failed:
+        print(f"  {service.name}: {service.error}")
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":